@@ -0,0 +1,530 @@
+"""
+    Peasauce - interactive disassembler
+    Copyright (C) 2012-2017 Richard Tew
+    Licensed using the MIT license.
+"""
+
+"""
+Performance benchmarks.
+
+These are run by hand, and report their results rather than test them.  Each benchmark
+generates its own synthetic fixture, so no test data is required.
+
+    python benchmark.py [benchmark_name ...]
+"""
+
+import gc
+import logging
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import disassembly
+import disassembly_data
+import disassembly_util
+import disassemblylib
+import editor_state
+import loaderlib
+import toolapi
+
+
+def make_m68k_instruction_stream(arch, length):
+    """ Generate a stream of decodable non-final m68k instructions of at least the given length. """
+    padding = b"\0" * 16
+    instructions = []
+    for word in range(0, 0x10000, 7):
+        data = bytearray([ word >> 8, word & 0xFF ]) + padding
+        try:
+            match, data_idx = arch.function_disassemble_one_line(data, 0, 0)
+        except Exception:
+            # Some unusual encodings are not handled by the decoder, they are of no use here.
+            continue
+        if match is not None and not arch.function_is_final_instruction(match):
+            instructions.append(bytes(data[:data_idx]))
+    stream = bytearray()
+    while len(stream) < length:
+        for instruction_bytes in instructions:
+            stream += instruction_bytes
+    return stream
+
+def make_m68k_program(arch, length, load_address, function_length=64):
+    """ Generate a program of at least the given length, made of functions which each call the next one. """
+    padding = b"\0" * 16
+    instructions = []
+    for word in range(0, 0x10000, 7):
+        data = bytearray([ word >> 8, word & 0xFF ]) + padding
+        try:
+            match, data_idx = arch.function_disassemble_one_line(data, 0, 0)
+            if match is not None:
+                for operand in match.opcodes:
+                    arch.function_get_operand_string(match, operand, lookup_symbol=lambda address, absolute_info=None: None)
+        except Exception:
+            # Some unusual encodings are not handled by the decoder or its formatting, they are of no use here.
+            continue
+        # Instructions that refer to addresses would lead the disassembly out of the program.
+        if match is not None and not arch.function_is_final_instruction(match) and not arch.function_get_match_addresses(match):
+            instructions.append(bytes(data[:data_idx]))
+    JSR_ABSL = struct.pack(">H", 0x4EB9)
+    RTS = struct.pack(">H", 0x4E75)
+    program = bytearray()
+    instruction_idx = 0
+    while len(program) < length:
+        function_offset = len(program)
+        body = bytearray()
+        while len(body) < function_length - 8:
+            body += instructions[instruction_idx % len(instructions)]
+            instruction_idx += 1
+        next_function_address = load_address + len(program) + len(JSR_ABSL) + 4 + len(body) + len(RTS)
+        program += JSR_ABSL + struct.pack(">I", next_function_address) + body + RTS
+    # The last function calls the first, rather than past the end of the program.
+    struct.pack_into(">I", program, function_offset + len(JSR_ABSL), load_address)
+    return program
+
+def load_m68k_binary(data, load_address=0x10000):
+    """ Load the data as a binary file with the entrypoint at its start, returning the disassembly api. """
+    with tempfile.NamedTemporaryFile(delete=False) as input_file:
+        input_file.write(data)
+    try:
+        toolapiob = toolapi.ToolAPI()
+        result = toolapiob.load_binary_file(input_file.name, loaderlib.constants.PROCESSOR_M680x0, load_address, 0)
+        # The worker thread is only needed for loading, and would otherwise keep the process alive.
+        toolapiob.editor_state.on_app_exit()
+        if type(result) is not tuple:
+            raise RuntimeError("loading error (%s)" % result)
+        return toolapiob.editor_state.disassembly_state
+    finally:
+        os.remove(input_file.name)
+
+def make_amiga_hunk_file(code, data, symbol_offsets):
+    """ Generate an Amiga hunk executable with a code and a data hunk, with symbols at the given data hunk offsets. """
+    HUNK_HEADER, HUNK_CODE, HUNK_DATA, HUNK_SYMBOL, HUNK_END = 0x3F3, 0x3E9, 0x3EA, 0x3F0, 0x3F2
+    code = bytes(code) + b"\0" * (-len(code) % 4)
+    data = bytes(data) + b"\0" * (-len(data) % 4)
+    hunk_file = bytearray(struct.pack(">6I", HUNK_HEADER, 0, 2, 0, 1, len(code) // 4))
+    hunk_file += struct.pack(">I", len(data) // 4)
+    hunk_file += struct.pack(">2I", HUNK_CODE, len(code) // 4) + code + struct.pack(">I", HUNK_END)
+    hunk_file += struct.pack(">2I", HUNK_DATA, len(data) // 4) + data + struct.pack(">I", HUNK_SYMBOL)
+    for i, symbol_offset in enumerate(symbol_offsets):
+        symbol_name = ("symbol%d" % i).encode("ascii")
+        symbol_name += b"\0" * (-len(symbol_name) % 4)
+        hunk_file += struct.pack(">I", len(symbol_name) // 4) + symbol_name + struct.pack(">I", symbol_offset)
+    hunk_file += struct.pack(">2I", 0, HUNK_END)
+    return hunk_file
+
+def load_file(data, suffix=""):
+    """ Load the data as a file of an automatically identified format, returning the disassembly api. """
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as input_file:
+        input_file.write(data)
+    try:
+        toolapiob = toolapi.ToolAPI()
+        result = toolapiob.load_file(input_file.name)
+        toolapiob.editor_state.on_app_exit()
+        if type(result) is not tuple:
+            raise RuntimeError("loading error (%s)" % result)
+        return toolapiob.editor_state.disassembly_state
+    finally:
+        os.remove(input_file.name)
+
+def report(name, value, units):
+    print("%-48s %12.1f %s" % (name, value, units))
+
+
+def benchmark_decode():
+    """ Instructions decoded per second, one at a time and as a linear run. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    data = memoryview(make_m68k_instruction_stream(arch, 512 * 1024))
+
+    def decode_one_line():
+        instruction_count = 0
+        data_idx = 0
+        while data_idx < len(data):
+            match, data_idx = arch.function_disassemble_one_line(data, data_idx, data_idx)
+            instruction_count += 1
+        return instruction_count
+
+    def decode_range():
+        instruction_count = 0
+        for match, data_idx, is_final in arch.disassemble_range(data, 0, len(data), 0):
+            instruction_count += 1
+        return instruction_count
+
+    for use_decode_cache in (False, True):
+        arch.variable_use_decode_cache = use_decode_cache
+        suffix = "" if use_decode_cache else " (uncached)"
+        for name, function in (("function_disassemble_one_line", decode_one_line), ("disassemble_range", decode_range)):
+            disassemblylib.util.decode_cache.clear()
+            t0 = time.time()
+            instruction_count = function()
+            report("decode/"+ name + suffix, instruction_count / (time.time() - t0), "instructions/s")
+    del arch.variable_use_decode_cache
+    report("decode/decode_cache_hits", disassemblylib.util.decode_cache.hits, "")
+    report("decode/decode_cache_misses", disassemblylib.util.decode_cache.misses, "")
+    report("decode/decode_cache_evictions", disassemblylib.util.decode_cache.evictions, "")
+
+
+def benchmark_match_memory():
+    """ Memory held per decoded instruction, once all the instructions in a large fixture are kept. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    data = memoryview(make_m68k_instruction_stream(arch, 512 * 1024))
+
+    for use_decode_cache in (False, True):
+        arch.variable_use_decode_cache = use_decode_cache
+        suffix = "" if use_decode_cache else " (uncached)"
+        disassemblylib.util.decode_cache.clear()
+        gc.collect()
+        tracemalloc.start()
+        size0 = tracemalloc.get_traced_memory()[0]
+        matches = [ match for (match, data_idx, is_final) in arch.disassemble_range(data, 0, len(data), 0) ]
+        gc.collect()
+        size1 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report("match_memory/per_instruction"+ suffix, (size1 - size0) / float(len(matches)), "bytes")
+        del matches
+    del arch.variable_use_decode_cache
+    disassemblylib.util.decode_cache.clear()
+
+
+def benchmark_edit():
+    """ Random data type changes made to a loaded project, each of which splits blocks and changes line counts. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    data = make_m68k_instruction_stream(arch, 64 * 1024)
+    load_address = 0x10000
+    t0 = time.time()
+    disassembly_api = load_m68k_binary(data, load_address)
+    report("edit/load", time.time() - t0, "s")
+
+    random.seed(0)
+    edit_count = 10000
+    data_types = (disassembly_data.DATA_TYPE_DATA08, disassembly_data.DATA_TYPE_DATA16, disassembly_data.DATA_TYPE_DATA32)
+    # Edits that would split an instruction are expected to fail, and log errors saying so.
+    logging.disable(logging.ERROR)
+    try:
+        t0 = time.time()
+        for i in range(edit_count):
+            address = load_address + (random.randrange(len(data)) & ~1)
+            disassembly_api.set_data_type_at_address(address, random.choice(data_types))
+            disassembly_api.get_line_number_for_address(address)
+        report("edit/random_data_type_changes", edit_count / (time.time() - t0), "edits/s")
+    finally:
+        logging.disable(logging.NOTSET)
+    report("edit/block_count", len(disassembly_api._program_data.blocks), "")
+
+
+def benchmark_load():
+    """ Load time for programs of increasing size, each made of thousands of small functions. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    for length in (256 * 1024, 512 * 1024, 1024 * 1024, 2048 * 1024):
+        data = make_m68k_program(arch, length, load_address)
+        t0 = time.time()
+        disassembly_api = load_m68k_binary(data, load_address)
+        report("load/%dKB" % (length // 1024), time.time() - t0, "s")
+        report("load/%dKB_block_count" % (length // 1024), len(disassembly_api._program_data.blocks), "")
+
+
+def benchmark_instruction_cache():
+    """ Memory retained and load time for a program, as the budget of materialised instructions changes. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 256 * 1024, load_address)
+    default_max_instructions = disassembly_data.InstructionCache.MAX_INSTRUCTIONS
+    for max_instructions in (default_max_instructions, 16384):
+        disassembly_data.InstructionCache.MAX_INSTRUCTIONS = max_instructions
+        try:
+            gc.collect()
+            tracemalloc.start()
+            t0 = time.time()
+            disassembly_api = load_m68k_binary(data, load_address)
+            t1 = time.time()
+            gc.collect()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        finally:
+            disassembly_data.InstructionCache.MAX_INSTRUCTIONS = default_max_instructions
+        stats = disassembly_api.get_instruction_cache_stats()
+        report("instruction_cache/%d/load" % max_instructions, t1 - t0, "s")
+        report("instruction_cache/%d/retained" % max_instructions, size / (1024.0 * 1024.0), "MB")
+        report("instruction_cache/%d/materialisations" % max_instructions, stats["materialisations"], "")
+        report("instruction_cache/%d/demotions" % max_instructions, stats["demotions"], "")
+        del disassembly_api
+
+
+def benchmark_concurrent_reads():
+    """ Time taken to read the rows of a view, while other threads export the program or change its data types. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 128 * 1024, load_address)
+    disassembly_api = load_m68k_binary(data, load_address)
+    program_data = disassembly_api._program_data
+    view_row_count = 40
+    data_types = (disassembly_data.DATA_TYPE_DATA08, disassembly_data.DATA_TYPE_DATA16, disassembly_data.DATA_TYPE_DATA32)
+
+    def export_source_code(stop_event):
+        while not stop_event.is_set():
+            with tempfile.TemporaryFile() as export_file:
+                disassembly_api.export_source_code(export_file)
+
+    def change_data_types(stop_event):
+        rng = random.Random(0)
+        while not stop_event.is_set():
+            address = load_address + (rng.randrange(len(data)) & ~1)
+            disassembly_api.set_data_type_at_address(address, rng.choice(data_types))
+
+    # Edits that would split an instruction are expected to fail, and log errors saying so.
+    logging.disable(logging.ERROR)
+    try:
+        for name, function in (("idle", None), ("export", export_source_code), ("edits", change_data_types)):
+            stop_event = threading.Event()
+            threads = []
+            if function is not None:
+                # There is only ever one thread changing data types, but any number reading.
+                thread_count = 1 if function is change_data_types else 2
+                threads = [ threading.Thread(target=function, args=(stop_event,)) for i in range(thread_count) ]
+                for thread in threads:
+                    thread.start()
+            random.seed(0)
+            timings = []
+            try:
+                for i in range(200):
+                    # The view is redrawn at an unpredictable place, from rows which are not cached.
+                    program_data.file_line_cache = disassembly_data.FileLineCache()
+                    line_count = disassembly_api.get_file_line_count()
+                    t0 = time.time()
+                    disassembly_api.get_file_lines(random.randrange(line_count - view_row_count), view_row_count)
+                    timings.append(time.time() - t0)
+                    time.sleep(0.001)
+            finally:
+                stop_event.set()
+                for thread in threads:
+                    thread.join()
+            timings.sort()
+            report("concurrent_reads/%s (median)" % name, timings[len(timings) // 2] * 1000, "ms")
+            report("concurrent_reads/%s (worst)" % name, timings[-1] * 1000, "ms")
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def benchmark_cross_references():
+    """ Referring address lookups, queries for the references made from address ranges, and saved project size. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 256 * 1024, load_address, function_length=16)
+    disassembly_api = load_m68k_binary(data, load_address)
+    program_data = disassembly_api._program_data
+    addresses = list(program_data.branch_addresses)
+    report("cross_references/referred_addresses", len(addresses), "")
+
+    t0 = time.time()
+    for address in addresses:
+        disassembly_api.get_referring_addresses(address)
+    report("cross_references/referring_lookups", len(addresses) / (time.time() - t0), "lookups/s")
+
+    window_size = 0x1000
+    t0 = time.time()
+    reference_count = 0
+    for address in range(load_address, load_address + len(data), window_size):
+        reference_count += len(disassembly_api.get_references_from_range(address, address + window_size))
+    report("cross_references/range_queries", (len(data) // window_size) / (time.time() - t0), "queries/s")
+    report("cross_references/range_references", reference_count, "")
+
+    save_options = disassembly_api.get_save_project_options()
+    save_file = tempfile.TemporaryFile()
+    save_options.input_file = tempfile.TemporaryFile()
+    save_options.input_file.write(data)
+    save_options.input_file.seek(0)
+    t0 = time.time()
+    disassembly_api.save_project_file(save_file, save_options)
+    report("cross_references/project_save", time.time() - t0, "s")
+    report("cross_references/project_save_size", save_file.tell() / 1024.0, "KB")
+    save_options.input_file.close()
+    save_file.close()
+
+
+def benchmark_search():
+    """ Time to search a program for text which it does not contain, before and after its lines have been searched once. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 256 * 1024, load_address)
+    state = editor_state.EditorState()
+    state.disassembly_state = load_m68k_binary(data, load_address)
+    report("search/lines", state.disassembly_state.get_file_line_count(), "")
+    state.last_search_text = "no such text"
+    try:
+        for name in ("cold", "warm"):
+            t0 = time.time()
+            result = state._search_text(None, 1, work_state=disassembly_util.WorkState())
+            report("search/%s" % name, (time.time() - t0) * 1000, "ms")
+            assert result == editor_state.ERRMSG_NO_IDENTIFIABLE_DESTINATION
+    finally:
+        state.on_app_exit()
+
+
+def benchmark_line_data():
+    """ Memory held per line of code blocks without their instructions, and the time taken to split large code blocks. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 256 * 1024, load_address, function_length=16 * 1024)
+    default_max_instructions = disassembly_data.InstructionCache.MAX_INSTRUCTIONS
+    disassembly_data.InstructionCache.MAX_INSTRUCTIONS = 0
+    try:
+        gc.collect()
+        tracemalloc.start()
+        size0 = tracemalloc.get_traced_memory()[0]
+        disassembly_api = load_m68k_binary(data, load_address)
+        gc.collect()
+        size1 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        disassembly_data.InstructionCache.MAX_INSTRUCTIONS = default_max_instructions
+    line_count = disassembly_api.get_file_line_count()
+    report("line_data/retained_per_line", (size1 - size0) / float(line_count), "bytes")
+
+    program_data = disassembly_api._program_data
+    random.seed(0)
+    split_count = 0
+    t0 = time.time()
+    for i in range(2000):
+        address = load_address + (random.randrange(len(data)) & ~1)
+        block, result = disassembly.split_block(program_data, address)
+        if result >= 0:
+            split_count += 1
+    report("line_data/splits", split_count / (time.time() - t0), "splits/s")
+
+
+def benchmark_project():
+    """ Time to load a saved project, and to then number its lines and index its code blocks. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 256 * 1024, load_address)
+    disassembly_api = load_m68k_binary(data, load_address)
+    save_options = disassembly_api.get_save_project_options()
+    save_file = tempfile.TemporaryFile()
+    save_options.input_file = tempfile.TemporaryFile()
+    save_options.input_file.write(data)
+    save_options.input_file.seek(0)
+    disassembly_api.save_project_file(save_file, save_options)
+    save_options.input_file.close()
+    report("project/save_size", save_file.tell() / 1024.0, "KB")
+
+    save_file.seek(0)
+    t0 = time.time()
+    disassembly_api = disassembly.load_project_file(save_file, "benchmark")
+    report("project/load", time.time() - t0, "s")
+    save_file.close()
+
+    program_data = disassembly_api._program_data
+    t0 = time.time()
+    disassembly_api.get_file_line_count()
+    for block in program_data.blocks:
+        if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE:
+            disassembly.get_block_line_index(program_data, block)
+    report("project/line_index", (time.time() - t0) * 1000, "ms")
+
+
+def benchmark_render():
+    """ Cells rendered per second, for a view scrolling through a program and reading each column of its rows. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    load_address = 0x10000
+    data = make_m68k_program(arch, 128 * 1024, load_address)
+    disassembly_api = load_m68k_binary(data, load_address)
+    program_data = disassembly_api._program_data
+    line_count = disassembly_api.get_file_line_count()
+    view_row_count = 40
+    column_idxs = (disassembly.LI_OFFSET, disassembly.LI_BYTES, disassembly.LI_LABEL, disassembly.LI_INSTRUCTION, disassembly.LI_OPERANDS)
+
+    for max_rows in (0, disassembly_data.FileLineCache.MAX_ROWS):
+        suffix = "" if max_rows else " (uncached)"
+        program_data.file_line_cache = disassembly_data.FileLineCache(max_rows)
+        cell_count = 0
+        t0 = time.time()
+        # Each scroll step moves the view by a quarter, redrawing the rows already seen.
+        for first_line_idx in range(0, min(line_count, 20000) - view_row_count, view_row_count // 4):
+            for line_idx in range(first_line_idx, first_line_idx + view_row_count):
+                for column_idx in column_idxs:
+                    disassembly_api.get_file_line(line_idx, column_idx)
+                    cell_count += 1
+        report("render/scrolling_view"+ suffix, cell_count / (time.time() - t0), "cells/s")
+    report("render/file_line_cache_hit_rate", disassembly_api.get_file_line_cache_stats()["hit_rate"] * 100, "%")
+
+    # Exporting reads every line once, so the cache is of no help and only the per-cell overhead matters.
+    program_data.file_line_cache = disassembly_data.FileLineCache()
+    t0 = time.time()
+    for line_idx in range(line_count):
+        for column_idx in column_idxs:
+            disassembly_api.get_file_line(line_idx, column_idx)
+    report("render/export_by_cell", line_count / (time.time() - t0), "lines/s")
+    program_data.file_line_cache = disassembly_data.FileLineCache()
+    t0 = time.time()
+    for line0 in range(0, line_count, 1024):
+        disassembly_api.get_file_lines(line0, 1024)
+    report("render/export_by_batch", line_count / (time.time() - t0), "lines/s")
+    for worker_count in (1, 2):
+        t0 = time.time()
+        with tempfile.TemporaryFile() as export_file:
+            disassembly_api.export_source_code(export_file, worker_count=worker_count)
+        report("render/export_source_code (%d workers)" % worker_count, line_count / (time.time() - t0), "lines/s")
+
+
+def benchmark_symbols():
+    """ Load time for a hunk file with many symbols, and symbol lookups by name. """
+    arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+    symbol_count = 50000
+    code = make_m68k_program(arch, 4096, 0)
+    data = bytearray(symbol_count * 8)
+    t0 = time.time()
+    disassembly_api = load_file(make_amiga_hunk_file(code, data, range(0, len(data), 8)))
+    report("symbols/load_50000_symbols", time.time() - t0, "s")
+    report("symbols/symbol_count", len(disassembly_api.get_symbols()), "")
+
+    t0 = time.time()
+    for i in range(0, symbol_count, 10):
+        disassembly_api.get_address_for_symbol("SYMBOL%d" % i)
+    report("symbols/get_address_for_symbol", (symbol_count // 10) / (time.time() - t0), "lookups/s")
+
+
+def benchmark_data_references():
+    """ Candidate pointers found per second, in a large data block of a binary file where a few words are addresses. """
+    load_address = 0x10000
+    data_length = 1024 * 1024
+    random.seed(0)
+    data = bytearray(struct.pack(">H", 0x4E75))
+    data += bytearray(random.getrandbits(8) for i in range(data_length))
+    for i in range(2, len(data) - 4, 400):
+        data[i:i+4] = struct.pack(">I", load_address + random.randrange(len(data)))
+    t0 = time.time()
+    disassembly_api = load_m68k_binary(bytes(data), load_address)
+    report("data_references/load", time.time() - t0, "s")
+
+    program_data = disassembly_api._program_data
+    block = program_data.blocks[-1]
+    t0 = time.time()
+    references = disassembly._locate_uncertain_data_references(program_data, block.address, block)
+    report("data_references/scan", (block.length // 2) / (time.time() - t0), "words/s")
+    report("data_references/reference_count", len(references), "")
+
+    t0 = time.time()
+    rows = disassembly_api.get_uncertain_data_references()
+    report("data_references/rows", len(rows) / (time.time() - t0), "rows/s")
+
+    query_count = 1000
+    t0 = time.time()
+    for i in range(query_count):
+        address0 = block.address + random.randrange(block.length)
+        disassembly_api.get_uncertain_data_references(address0, address0 + 0x1000)
+    report("data_references/window_queries", query_count / (time.time() - t0), "queries/s")
+
+
+def run_benchmarks(names):
+    for name, function in sorted(globals().items()):
+        if name.startswith("benchmark_") and (not names or name[10:] in names):
+            function()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    run_benchmarks(sys.argv[1:])
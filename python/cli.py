@@ -76,6 +76,19 @@ def command_help(toolapiob, arg_string):
     for each in l:
         print(each)
 
+def editor_command_export(toolapiob, arg_string):
+    "Export - Write the source code to the given file"
+    if not arg_string:
+        print("Usage: export <file path>")
+        return
+    result = toolapiob.export_source_code(arg_string)
+    if type(result) is str:
+        print("ERROR: unable to export source code -", result)
+    elif result:
+        print("success")
+    else:
+        print("cancelled")
+
 def default_command_no_file_loaded(toolapiob, arg_string):
     print("ERROR: no file loaded.")
 
@@ -123,9 +136,11 @@ def create_command_mapping(toolapiob):
         d["<number>"] = editor_command_go_to_line
         d["p"] = editor_command_print_current_line
         d[""] = editor_command_print_next_line
+        d["export"] = d["e"] = editor_command_export
     else:
         d["<number>"] = default_command_no_file_loaded
         d["p"] = default_command_no_file_loaded
+        d["export"] = d["e"] = default_command_no_file_loaded
         d[""] = lambda: None
     return d
 
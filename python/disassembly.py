@@ -17,21 +17,25 @@ MAF_CERTAIN = 16
 
 import binascii
 import bisect
+import collections
+import concurrent.futures
 import copy
 import io
 import logging
 import operator
 import os
+import re
 import threading
 import types
 # mypy-lang support
-from typing import Tuple, List, Set, Union, Any, Callable
+from typing import Tuple, List, Set, Dict, Union, Any, Callable, Iterator
 
 import loaderlib
 import disassemblylib
 import disassemblylib.util
 import disassembly_data
 import disassembly_persistence
+import disassembly_util
 import persistence
 import util
 # mypy-lang support
@@ -40,19 +44,25 @@ from disassembly_util import WorkState
 logger = logging.getLogger("disassembly")
 
 #
-# TODO(rmtew):  The locking conundrum.  Currently we have enough locking to avoid problems.  But it's correct, and likely does not solve real problems.
+# The locking model.
 #
-# There are two actors that can be involved in race conditions.
-# 1) The main thread which receives events and reacts by asking for display data from the state manager (this file) on the main thread.
+# There are two kinds of actors that can be involved in race conditions.
+# 1) Readers, like the main thread asking for display data from the state manager (this file), or exporting and searching on other threads.
 # 2) The active logic thread in progress, which is changing data types and may be in the act of modifying data.
-# 
-# The active logic thread cannot lock everything for the duration of it's action, or the main thread will not be able to do it's job of continually updating the display.
-# The main thread will already be doing an abstract isolated action (get line count, get detail for some line in the display) so can lock for the duration of it's action.
 #
-# The implication seems to be that the active logic should be inverted and prolonged actions where possible divided into individually locked sub-steps.
-# 
+# Readers take `line_count_lock` for reading and do not block each other.  The active logic thread cannot lock everything
+# for the duration of it's action, or the readers would not be able to do their job of continually updating the display.
+# Instead it takes the lock for writing for each individual sub-step (splitting a block, putting a block's new data in place),
+# and waiting readers get in between them.
+#
+# Reading still fills in lazily calculated state: the line numbering after changed blocks, the file line cache, the search
+# index and the instruction entries.  These are shared by all readers, and are changed with `line_cache_lock` held.  Nothing
+# done while holding it waits for `line_count_lock`.  The file line cache is only ever accessed with it held, so that rows
+# which are already cached can be used without taking `line_count_lock` at all.
+#
 
-line_count_rlock = threading.RLock()
+line_count_lock = disassembly_util.ReadWriteLock()
+line_cache_lock = threading.RLock()
 
 LI_OFFSET = 0
 LI_BYTES = 1
@@ -61,6 +71,9 @@ LI_INSTRUCTION = 3
 LI_OPERANDS = 4
 if DEBUG_ANNOTATE_DISASSEMBLY:
     LI_ANNOTATIONS = 5
+    LI_COLUMN_COUNT = 6
+else:
+    LI_COLUMN_COUNT = 5
 
 
 ## TODO: Move elsewhere and make per-arch.
@@ -79,6 +92,7 @@ InstructionEntry = Tuple[int, Instruction]
 Address = int
 LineNumber = int
 UncertainReference = Tuple[int, int, str]
+UncertainReferenceMatch = Tuple[int, int, int]
 
 ## disassembly_data.SegmentBlock flag helpers
 
@@ -95,23 +109,46 @@ def create_instruction_entry(program_data, block, block_offset):
     return match
 
 def get_instruction_entry(program_data, block, line_data, idx, cache=True):
-    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock, List[InstructionEntryLite], int, bool) -> Instruction
+    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock, disassembly_data.LineData, int, bool) -> Instruction
     """
     An instruction entry is runtime data.  There's nothing in there that cannot be recreated by redisassembling
     the data at the given address.  So, if the entry is the segment data offset, then that can in turn be
     used to recreate the instruction at that address.
 
-    Calling this function will check for the lite entry, and replace it with the real one.
+    Calling this function will check for the lite entry, and replace it with the real one.  The number of
+    real entries is bounded by the instruction cache, and the least recently used blocks get theirs demoted.
     """
-    entry = line_data[idx][1]
-    if isinstance(entry, int):
-        entry = create_instruction_entry(program_data, block, entry)
+    entry = line_data.get_instruction(idx)
+    if entry is None:
+        # Readers decode without the lock, so another may have stored the same entry meanwhile.
+        entry = create_instruction_entry(program_data, block, line_data.get_block_offset(idx))
         if cache:
-            line_data[idx] = (disassembly_data.SLD_INSTRUCTION, entry)
+            with line_cache_lock:
+                stored_entry = line_data.get_instruction(idx)
+                if stored_entry is None:
+                    line_data.set_instruction(idx, entry)
+                    _demote_instruction_entries(program_data, program_data.instruction_cache.insert(block, 1))
+                else:
+                    entry = stored_entry
+    else:
+        program_data.instruction_cache.touch(block)
     return entry
 
+def _count_instruction_entries(line_data):
+    # type: (disassembly_data.LineData) -> int
+    """ The number of real instruction entries in the line data of a code block. """
+    return line_data.get_instruction_count()
+
+def _demote_instruction_entries(program_data, blocks):
+    # type: (disassembly_data.ProgramData, List[disassembly_data.SegmentBlock]) -> None
+    """ Replace the real instruction entries in the line data of the given code blocks with lite ones. """
+    for block in blocks:
+        if block.line_data is None or disassembly_data.get_block_data_type(block) != disassembly_data.DATA_TYPE_CODE:
+            continue
+        block.line_data.demote_instructions()
+
 def find_previous_instruction(program_data, block, line_data, idx):
-    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock, List[InstructionEntryLite], int) -> Tuple[int, Union[None, Instruction]]
+    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock, disassembly_data.LineData, int) -> Tuple[int, Union[None, Instruction]]
     """
     Get the preceding instruction of the given type and it's line index within the block.
     This will generate the instruction entry if it does not exist.
@@ -133,14 +170,45 @@ def get_block_header_line_count(program_data, block):
 
 def get_instruction_line_count(program_data, match):
     # type: (disassembly_data.ProgramData, Instruction) -> int
-    line_count = 1
+    return get_instruction_metadata_line_count(get_instruction_metadata(program_data, match))
+
+def get_instruction_metadata(program_data, match):
+    # type: (disassembly_data.ProgramData, Instruction) -> int
+    """ The length of the instruction, along with whether it is of a kind that may be followed by a blank line. """
+    metadata = match.num_bytes
+    if metadata > disassembly_data.IMD_LENGTH_MASK:
+        raise RuntimeError("instruction length %d exceeds the metadata length bits" % metadata)
     # TODO(rmtew): Make non-architecture specific.  m68k = should be a per-instruction configuration?
-    if display_configuration.trailing_line_trap and match.specification.key == "TRAP":
+    if match.specification.key == "TRAP":
+        metadata |= disassembly_data.IMD_TRAILING_LINE_TRAP
+    elif match.specification.key in ("Bcc", "DBcc",):
+        metadata |= disassembly_data.IMD_TRAILING_LINE_BRANCH
+    return metadata
+
+def get_instruction_metadata_line_count(metadata):
+    # type: (int) -> int
+    line_count = 1
+    if display_configuration.trailing_line_trap and metadata & disassembly_data.IMD_TRAILING_LINE_TRAP:
         line_count += 1
-    elif display_configuration.trailing_line_branch and match.specification.key in ("Bcc", "DBcc",):
+    elif display_configuration.trailing_line_branch and metadata & disassembly_data.IMD_TRAILING_LINE_BRANCH:
         line_count += 1
     return line_count
 
+def get_block_instruction_metadata(program_data, block):
+    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock) -> bytearray
+    # Locking: line_count_lock, held for reading.
+    """
+    Get the metadata for the instructions of a code block.  This is recorded when the block is disassembled,
+    and only projects saved before it was persisted need to have their instructions disassembled again for it.
+    """
+    instruction_metadata = block.instruction_metadata
+    if instruction_metadata is None:
+        line_data = block.line_data
+        instruction_metadata = bytearray(get_instruction_metadata(program_data, get_instruction_entry(program_data, block, line_data, line_idx, cache=False))
+            for line_idx, (type_id, entry) in enumerate(line_data) if type_id == disassembly_data.SLD_INSTRUCTION)
+        block.instruction_metadata = instruction_metadata
+    return instruction_metadata
+
 
 def get_block_line_count(program_data, block):
     # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock) -> int
@@ -149,12 +217,7 @@ def get_block_line_count(program_data, block):
 
     data_type = disassembly_data.get_block_data_type(block)
     if data_type == disassembly_data.DATA_TYPE_CODE:
-        for line_idx, (type_id, entry) in enumerate(block.line_data):
-            if type_id == disassembly_data.SLD_INSTRUCTION:
-                entry = get_instruction_entry(program_data, block, block.line_data, line_idx)
-                line_count += get_instruction_line_count(program_data, entry)
-            elif type_id in (disassembly_data.SLD_COMMENT_FULL_LINE, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
-                line_count += 1
+        line_count += get_block_line_index(program_data, block).line_count
     elif data_type in disassembly_data.NUMERIC_DATA_TYPES:
         sizes = get_data_type_sizes(block)
         for data_size, num_bytes, size_count, size_lines in sizes:
@@ -179,40 +242,65 @@ def get_block_line_count(program_data, block):
 
 def api_get_code_block_info_for_address(program_data, address):
     # type: (disassembly_data.ProgramData, int) -> Union[None, InstructionEntry]
-    with line_count_rlock:
+    with line_count_lock.read:
         return get_code_block_info_for_address(program_data, address)
 
+def get_block_line_index(program_data, block):
+    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock) -> disassembly_data.BlockLineIndex
+    """ Get the line index for the line data of a code block, calculating it if it is not cached. """
+    line_index = block.line_index
+    if line_index is None:
+        entry_indexes = []
+        line_offsets = []
+        byte_offsets = []
+        line_count = 0
+        byte_count = 0
+        line_data = block.line_data
+        instruction_metadata = get_block_instruction_metadata(program_data, block)
+        instruction_idx = 0
+        for line_idx, (type_id, entry) in enumerate(line_data):
+            if type_id == disassembly_data.SLD_INSTRUCTION:
+                metadata = instruction_metadata[instruction_idx]
+                instruction_idx += 1
+                entry_indexes.append(line_idx)
+                line_offsets.append(line_count)
+                byte_offsets.append(byte_count)
+                line_count += get_instruction_metadata_line_count(metadata)
+                byte_count += metadata & disassembly_data.IMD_LENGTH_MASK
+            elif type_id in (disassembly_data.SLD_COMMENT_FULL_LINE, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
+                entry_indexes.append(line_idx)
+                line_offsets.append(line_count)
+                byte_offsets.append(byte_count)
+                line_count += 1
+        line_index = disassembly_data.BlockLineIndex()
+        line_index.entry_indexes.extend(entry_indexes)
+        line_index.line_offsets.extend(line_offsets)
+        line_index.byte_offsets.extend(byte_offsets)
+        line_index.line_count = line_count
+        block.line_index = line_index
+    return line_index
+
 # NOTE(rmtew): Called from two locations, guarded by line count lock.
 def get_code_block_info_for_address(program_data, address):
     # type: (disassembly_data.ProgramData, int) -> Union[None, InstructionEntry]
     block, block_idx = lookup_block_by_address(program_data, address)
-    base_address = program_data.block_addresses[block_idx]
-
-    bytes_used = 0
-    line_number = get_block_line_number(program_data, block_idx) + get_block_header_line_count(program_data, block)
-    previous_result = None
-    for line_idx, (type_id, entry) in enumerate(block.line_data):
-        if type_id == disassembly_data.SLD_INSTRUCTION:
-            # Within but not at the start of the previous instruction.
-            if address < base_address + bytes_used:
-                return previous_result
-
-            entry = get_instruction_entry(program_data, block, block.line_data, line_idx)
-            current_result = line_number, entry
-
-            # Exactly this instruction.
-            if address == base_address + bytes_used:
-                return current_result
-
-            previous_result = current_result
-            bytes_used += entry.num_bytes
-            line_number += get_instruction_line_count(program_data, entry)
-        elif type_id in (disassembly_data.SLD_COMMENT_FULL_LINE, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
-            line_number += 1
+    if disassembly_data.get_block_data_type(block) != disassembly_data.DATA_TYPE_CODE:
+        return None
+    line_index = get_block_line_index(program_data, block)
+
+    # Locate the last instruction starting at or before the address.
+    block_offset = address - block.address
+    position = bisect.bisect_right(line_index.byte_offsets, block_offset) - 1
+    while position >= 0 and block.line_data[line_index.entry_indexes[position]][0] != disassembly_data.SLD_INSTRUCTION:
+        position -= 1
+    if position < 0:
+        return None
 
-    # Within but not at the start of the previous instruction.
-    if address < base_address + bytes_used:
-        return previous_result
+    entry = get_instruction_entry(program_data, block, block.line_data, line_index.entry_indexes[position])
+    # Either exactly this instruction, or within but not at the start of it.
+    if block_offset < line_index.byte_offsets[position] + entry.num_bytes:
+        line_number = get_block_line_number(program_data, block_idx) + get_block_header_line_count(program_data, block)
+        return line_number + line_index.line_offsets[position], entry
 
 # NOTE(rmtew): All users at this time use line count locking.
 def get_code_block_info_for_line_number(program_data, line_number):
@@ -220,44 +308,21 @@ def get_code_block_info_for_line_number(program_data, line_number):
     block, block_idx = lookup_block_by_line_count(program_data, line_number)
     if disassembly_data.get_block_data_type(block) != disassembly_data.DATA_TYPE_CODE:
         return None
-    base_address = program_data.block_addresses[block_idx]
+    line_index = get_block_line_index(program_data, block)
 
-    bytes_used = 0
-    line_count = get_block_line_number(program_data, block_idx) + get_block_header_line_count(program_data, block)
-    previous_result = None # type: Union[None, InstructionEntry]
-    for line_idx, (type_id, entry) in enumerate(block.line_data):
-        if type_id == disassembly_data.SLD_INSTRUCTION:
-            # Within but not at the start of the previous instruction.
-            if line_number < line_count:
-                line_type = None
-                if previous_result is not None:
-                    line_type = hex(previous_result[0])
-                #logger.debug("get_code_block_info_for_line_number.1: %d, %d = %s", line_number, line_count, line_type)
-                return previous_result
+    line_offset = line_number - get_block_line_number(program_data, block_idx) - get_block_header_line_count(program_data, block)
+    if line_offset < 0 or line_offset >= line_index.line_count:
+        return None
 
-            entry = get_instruction_entry(program_data, block, block.line_data, line_idx)
-            current_result = base_address + bytes_used, entry
-
-            # Exactly this instruction.
-            if line_number == line_count:
-                #logger.debug("get_code_block_info_for_line_number.1: %d, %d = %s (code)", line_number, line_count, hex(current_result[0]))
-                return current_result
-
-            previous_result = current_result
-            bytes_used += entry.num_bytes
-            line_count += get_instruction_line_count(program_data, entry)
-        elif type_id in (disassembly_data.SLD_COMMENT_FULL_LINE, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
-            if line_number == line_count:
-                #logger.debug("get_code_block_info_for_line_number.1: %d, %d = %s (comment/location-relative)", line_number, line_count, hex(base_address + entry))
-                return base_address + entry, previous_result[1]
-            line_count += 1
-    # Within but not at the start of the previous instruction.
-    if line_number < line_count:
-        logger.debug("get_code_block_info_for_line_number.2: %d, %d = %s", line_number, line_count, hex(previous_result[0]))
-        return previous_result
-
-    #logger.debug("get_code_block_info_for_line_number.3: %d, %d", line_number, line_count)
-    # return None, previous_result
+    position = bisect.bisect_right(line_index.line_offsets, line_offset) - 1
+    line_idx = line_index.entry_indexes[position]
+    type_id, entry = block.line_data[line_idx]
+    if type_id == disassembly_data.SLD_INSTRUCTION:
+        # Either exactly this instruction, or one of the trailing lines that follow it.
+        return block.address + line_index.byte_offsets[position], get_instruction_entry(program_data, block, block.line_data, line_idx)
+    # Comment or relative location, along with the instruction it follows.
+    discard, previous_entry = find_previous_instruction(program_data, block, block.line_data, line_idx)
+    return block.address + entry, previous_entry
 
 # NOTE(rmtew): Called from three places, all guarded by line count lock.
 def get_line_number_for_address(program_data, address):
@@ -302,7 +367,7 @@ def get_line_number_for_address(program_data, address):
 
 def api_get_address_for_line_number(program_data, line_number):
     # type: (disassembly_data.ProgramData, int) -> Union[int, None]
-    with line_count_rlock:
+    with line_count_lock.read:
         return get_address_for_line_number(program_data, line_number)
 
 # NOTE(rmtew): Called from two functions which are guarded by line count lock.
@@ -423,13 +488,13 @@ def get_file_footer_line_count(program_data):
 
 def api_get_file_line_count(program_data):
     # type: (disassembly_data.ProgramData) -> int
-    with line_count_rlock:
+    with line_count_lock.read:
         return get_file_line_count(program_data)
 
 def get_file_line_count(program_data):
     # type: (disassembly_data.ProgramData) -> int
     """ Get the total number of lines (with 0 being the first) in the 'file'. """
-    if program_data.block_line0s is None:
+    if len(program_data.blocks) == 0:
         return 0
     last_block_idx = len(program_data.blocks)-1
     last_block = program_data.blocks[last_block_idx]
@@ -447,21 +512,111 @@ def DEBUG_check_file_line_count(program_data):
     #print "LINE COUNTS", result, line_count0, line_count1
 
 def api_get_file_line(program_data, line_idx, column_idx):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int, int) -> str
+    # Locking: line_count_lock, held for reading.
     return get_file_line(program_data, line_idx, column_idx)
 
 def get_file_line(program_data, line_idx, column_idx): # Zero-based
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int, int) -> str
+    # Locking: line_count_lock, held for reading.
     if line_idx is None:
         return "BAD ROW"
     if column_idx is None:
         return "BAD COLUMN"
-    with line_count_rlock:
-        block, block_idx = lookup_block_by_line_count(program_data, line_idx)
+    return get_file_line_row(program_data, line_idx)[column_idx]
+
+def get_file_line_row(program_data, line_idx):
+    # type: (disassembly_data.ProgramData, int) -> Tuple[str, ...]
+    # Locking: line_count_lock, held for reading.
+    # Writing discards the rows it changes, so cached rows can be used without waiting for it.
+    with line_cache_lock:
+        is_numbered = not program_data.block_line_count_dirty_addresses
+        row = program_data.file_line_cache.get(line_idx) if is_numbered else None
+    if row is None:
+        with line_count_lock.read:
+            _recalculate_line_count_index(program_data)
+            if not is_numbered:
+                with line_cache_lock:
+                    row = program_data.file_line_cache.get(line_idx)
+            if row is None:
+                row = tuple(_render_file_line(program_data, line_idx))
+                with line_cache_lock:
+                    program_data.file_line_cache.insert(line_idx, row)
+    return row
+
+def api_get_file_lines(program_data, line0, line_count):
+    # type: (disassembly_data.ProgramData, int, int) -> List[Tuple[str, ...]]
+    # Locking: line_count_lock, held for reading.
+    return get_file_lines(program_data, line0, line_count)
+
+def get_file_lines(program_data, line0, line_count):
+    # type: (disassembly_data.ProgramData, int, int) -> List[Tuple[str, ...]]
+    # Locking: line_count_lock, held for reading.
+    """
+    The rows of all the columns for a range of lines, clipped to the lines in the file.  Lines
+    that are not already cached are rendered in contiguous runs, walking each block once.
+    """
+    with line_count_lock.read:
+        _recalculate_line_count_index(program_data)
+        line0 = max(line0, 0)
+        lineN = min(line0 + line_count, get_file_line_count(program_data))
+        file_line_cache = program_data.file_line_cache
+        with line_cache_lock:
+            rows = [ file_line_cache.get(line_idx) for line_idx in range(line0, lineN) ]
+        missing_idx = 0
+        while missing_idx < len(rows):
+            if rows[missing_idx] is not None:
+                missing_idx += 1
+                continue
+            missing_idxN = missing_idx + 1
+            while missing_idxN < len(rows) and rows[missing_idxN] is None:
+                missing_idxN += 1
+            missing_rows = _render_file_lines(program_data, line0 + missing_idx, missing_idxN - missing_idx)
+            with line_cache_lock:
+                for i, row in enumerate(missing_rows):
+                    rows[missing_idx + i] = row = tuple(row)
+                    file_line_cache.insert(line0 + missing_idx + i, row)
+            missing_idx = missing_idxN
+        return rows
+
+def _make_file_line_row(instruction_text="", operands_text=""):
+    # type: (str, str) -> List[str]
+    row = [ "" ] * LI_COLUMN_COUNT
+    row[LI_INSTRUCTION] = instruction_text
+    row[LI_OPERANDS] = operands_text
+    return row
+
+def _render_file_line(program_data, line_idx):
+    # type: (disassembly_data.ProgramData, int) -> List[str]
+    # Locking: line_count_lock, held for reading.
+    return _render_file_lines(program_data, line_idx, 1)[0]
+
+def _render_file_lines(program_data, line0, line_count):
+    # type: (disassembly_data.ProgramData, int, int) -> List[List[str]]
+    # Locking: line_count_lock, held for reading.
+    rows = []
+    with line_count_lock.read:
+        final_block_idx = len(program_data.blocks)-1
+        final_block = program_data.blocks[final_block_idx]
+        file_footer_line_idx = get_block_line_number(program_data, final_block_idx) + get_block_line_count_cached(program_data, final_block)
+        file_footer_line_count = get_file_footer_line_count(program_data)
+
+        block, block_idx = lookup_block_by_line_count(program_data, line0)
         block_line_count0 = get_block_line_number(program_data, block_idx)
         block_line_countN = block_line_count0 + get_block_line_count_cached(program_data, block)
+        for line_idx in range(line0, line0 + line_count):
+            # The file footer lines follow the final block, and are generated with it.
+            while line_idx >= block_line_countN and block_idx < final_block_idx:
+                block_idx += 1
+                block = program_data.blocks[block_idx]
+                block_line_count0 = block_line_countN
+                block_line_countN = block_line_count0 + get_block_line_count_cached(program_data, block)
+            rows.append(_render_block_file_line(program_data, block, block_line_count0, block_line_countN, file_footer_line_idx, file_footer_line_count, line_idx))
+    return rows
+
+def _render_block_file_line(program_data, block, block_line_count0, block_line_countN, file_footer_line_idx, file_footer_line_count, line_idx):
+    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock, int, int, int, int, int) -> List[str]
+    # Locking: line_count_lock, held for reading.
     segments = program_data.loader_segments
 
     # If the line is at the start of the first segment, check if it is a segment header.
@@ -472,15 +627,10 @@ def get_file_line(program_data, line_idx, column_idx): # Zero-based
             segment_address = loaderlib.get_segment_address(segments, block.segment_id)
             segment_header = loaderlib.get_segment_header(program_data.loader_system_name, block.segment_id, program_data.loader_internal_data)
             i = segment_header.find(" ")
-            if column_idx == LI_INSTRUCTION:
-                return segment_header[0:i]
-            elif column_idx == LI_OPERANDS:
-                return segment_header[i+1:].format(address=segment_address)
-            else:
-                return ""
+            return _make_file_line_row(segment_header[0:i], segment_header[i+1:].format(address=segment_address))
         # Second line is a blank one separating the header from what follows.
         if line_idx == block_line_count0+1:
-            return ""
+            return _make_file_line_row()
         leading_line_count += SEGMENT_HEADER_LINE_COUNT
 
     if block.segment_offset + block.length == loaderlib.get_segment_length(segments, block.segment_id):
@@ -492,66 +642,45 @@ def get_file_line(program_data, line_idx, column_idx): # Zero-based
         if address_idx > -1:
             # Whether there are trailing post-segment labels.
             if address_idx < len(addresses):
-                if column_idx == LI_OFFSET:
-                    return "%08X" % addresses[address_idx]
-                elif column_idx == LI_LABEL:
-                    return get_symbol_for_address(program_data, addresses[address_idx])
-                elif column_idx == LI_INSTRUCTION:
-                    return "EQU"
-                elif column_idx == LI_OPERANDS:
-                    last_address = loaderlib.get_segment_address(segments, block.segment_id)
-                    last_address += block.segment_offset + block.length
-                    address_offset = addresses[address_idx] - last_address
-                    if address_offset == 0:
-                        return "*"
-                    return "*+$%X" % address_offset
-                return ""
+                last_address = loaderlib.get_segment_address(segments, block.segment_id)
+                last_address += block.segment_offset + block.length
+                address_offset = addresses[address_idx] - last_address
+                if address_offset == 0:
+                    row = _make_file_line_row("EQU", "*")
+                else:
+                    row = _make_file_line_row("EQU", "*+$%X" % address_offset)
+                row[LI_OFFSET] = "%08X" % addresses[address_idx]
+                row[LI_LABEL] = get_symbol_for_address(program_data, addresses[address_idx])
+                return row
             # Whether there is am inter-segment blank line.
             if address_idx == len(addresses) and address_idx+1 == trailing_line_count:
-                return ""
+                return _make_file_line_row()
 
     ## End of list "special" line generation.
-    with line_count_rlock:
-        final_block_idx = len(program_data.blocks)-1
-        final_block = program_data.blocks[final_block_idx]
-        file_footer_line_idx = get_block_line_number(program_data, final_block_idx) + get_block_line_count_cached(program_data, final_block)
-        file_footer_line_count = get_file_footer_line_count(program_data)
-
     # Potential trailing footer separating blank line between last block and END directive.
     if file_footer_line_count == 2 and line_idx == file_footer_line_idx:
-        return ""
+        return _make_file_line_row()
     # Potential trailing footer END directive.
     if line_idx == file_footer_line_idx+file_footer_line_count-1:
-        if column_idx == LI_INSTRUCTION:
-            return "END"
-        return ""
+        return _make_file_line_row("END")
 
     data_type = disassembly_data.get_block_data_type(block)
 
     ## Block content line generation.
     if data_type == disassembly_data.DATA_TYPE_CODE:
-        block_offset0 = 0
-        block_offsetN = 0
-        line_count = block_line_count0 + leading_line_count
-        line_type_id = None
-        line_match = None
-        line_num_bytes = None
-        for idx_e, (type_id, entry) in enumerate(block.line_data):
-            if type_id == disassembly_data.SLD_INSTRUCTION:
-                entry = get_instruction_entry(program_data, block, block.line_data, idx_e)
-                block_offsetN += entry.num_bytes
-            if line_count == line_idx:
-                line_type_id = type_id
-                line_match = entry
-                break
-            if type_id == disassembly_data.SLD_INSTRUCTION:
-                block_offset0 = block_offsetN
-                line_count += get_instruction_line_count(program_data, entry)
-            elif type_id in (disassembly_data.SLD_COMMENT_FULL_LINE, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
-                line_count += 1
-        else:
+        line_index = get_block_line_index(program_data, block)
+        line_offset = line_idx - (block_line_count0 + leading_line_count)
+        position = bisect.bisect_right(line_index.line_offsets, line_offset) - 1
+        if position < 0 or line_index.line_offsets[position] != line_offset:
             # Trailing blank lines.
-            return ""
+            return _make_file_line_row()
+
+        idx_e = line_index.entry_indexes[position]
+        line_type_id, line_match = block.line_data[idx_e]
+        block_offset0 = block_offsetN = line_index.byte_offsets[position]
+        if line_type_id == disassembly_data.SLD_INSTRUCTION:
+            line_match = get_instruction_entry(program_data, block, block.line_data, idx_e)
+            block_offsetN += line_match.num_bytes
 
         address0 = block.address + block_offset0
         addressN = block.address + block_offsetN
@@ -561,40 +690,26 @@ def get_file_line(program_data, line_idx, column_idx): # Zero-based
             address0 = segment_address + block.segment_offset + block_offset0
         line_num_bytes = addressN - address0
 
-        if column_idx == LI_OFFSET:
-            return "%08X" % address0
-        elif column_idx == LI_BYTES:
-            if line_type_id in (disassembly_data.SLD_INSTRUCTION, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
-                data = loaderlib.get_segment_data(segments, block.segment_id)
-                data_offset = block.segment_offset + block_offset0
-                return binascii.hexlify(data[data_offset:data_offset+line_num_bytes])
-            return ""
-        elif column_idx == LI_LABEL:
-            label = get_symbol_for_address(program_data, address0)
-            if label is None:
-                return ""
-            return label
-        elif column_idx == LI_INSTRUCTION:
-            if line_type_id == disassembly_data.SLD_INSTRUCTION:
-                return program_data.dis_get_instruction_string_func(line_match, line_match.vars)
-            elif line_type_id == disassembly_data.SLD_EQU_LOCATION_RELATIVE:
-                return "EQU"
-            return ""
-        elif column_idx == LI_OPERANDS:
-            if line_type_id == disassembly_data.SLD_INSTRUCTION:
-                lookup_symbol = lambda address, absolute_info=None: get_symbol_for_address(program_data, address, absolute_info)
-                operand_string = ""
-                # TODO(rmtew): Make non-architecture specific.  m68k = operand seperator, configurable spacing, assembler-specific setting?
-                for i, operand in enumerate(line_match.opcodes):
-                    if i > 0:
-                        operand_string += ", "
-                    operand_string += program_data.dis_get_operand_string_func(line_match, operand, lookup_symbol=lookup_symbol)
-                return operand_string
-            elif line_type_id == disassembly_data.SLD_EQU_LOCATION_RELATIVE:
-                return "*-%d" % line_num_bytes
-            return ""
-        elif DEBUG_ANNOTATE_DISASSEMBLY and column_idx == LI_ANNOTATIONS:
-            if line_type_id == disassembly_data.SLD_INSTRUCTION:
+        row = _make_file_line_row()
+        row[LI_OFFSET] = "%08X" % address0
+        if line_type_id in (disassembly_data.SLD_INSTRUCTION, disassembly_data.SLD_EQU_LOCATION_RELATIVE):
+            data = loaderlib.get_segment_data(segments, block.segment_id)
+            data_offset = block.segment_offset + block_offset0
+            row[LI_BYTES] = binascii.hexlify(data[data_offset:data_offset+line_num_bytes])
+        label = get_symbol_for_address(program_data, address0)
+        if label is not None:
+            row[LI_LABEL] = label
+        if line_type_id == disassembly_data.SLD_INSTRUCTION:
+            row[LI_INSTRUCTION] = program_data.dis_get_instruction_string_func(line_match, line_match.vars)
+            lookup_symbol = lambda address, absolute_info=None: get_symbol_for_address(program_data, address, absolute_info)
+            operand_string = ""
+            # TODO(rmtew): Make non-architecture specific.  m68k = operand seperator, configurable spacing, assembler-specific setting?
+            for i, operand in enumerate(line_match.opcodes):
+                if i > 0:
+                    operand_string += ", "
+                operand_string += program_data.dis_get_operand_string_func(line_match, operand, lookup_symbol=lookup_symbol)
+            row[LI_OPERANDS] = operand_string
+            if DEBUG_ANNOTATE_DISASSEMBLY:
                 l = []
                 for o in line_match.opcodes:
                     key = o.specification.key
@@ -602,8 +717,11 @@ def get_file_line(program_data, line_idx, column_idx): # Zero-based
                         l.append(o.key)
                     else:
                         l.append(key)
-                return line_match.specification.key +" "+ ",".join(l)
-            return ""
+                row[LI_ANNOTATIONS] = line_match.specification.key +" "+ ",".join(l)
+        elif line_type_id == disassembly_data.SLD_EQU_LOCATION_RELATIVE:
+            row[LI_INSTRUCTION] = "EQU"
+            row[LI_OPERANDS] = "*-%d" % line_num_bytes
+        return row
     elif data_type in disassembly_data.NUMERIC_DATA_TYPES:
         block_lineN = block_line_count0 + leading_line_count
         block_offsetN = block.segment_offset
@@ -616,95 +734,243 @@ def get_file_line(program_data, line_idx, column_idx): # Zero-based
 
             if line_idx >= block_line0 and line_idx < block_lineN:
                 data_idx = block_offset0 + (line_idx - block_line0) * num_bytes
-                if column_idx == LI_OFFSET:
-                    return "%08X" % (loaderlib.get_segment_address(segments, block.segment_id) + data_idx)
-                elif column_idx == LI_BYTES:
-                    if block.flags & disassembly_data.BLOCK_FLAG_ALLOC:
-                        return ""
-                    data = loaderlib.get_segment_data(segments, block.segment_id)
-                    return binascii.hexlify(data[data_idx:data_idx+num_bytes])
-                elif column_idx == LI_LABEL:
-                    symbol_address = loaderlib.get_segment_address(segments, block.segment_id) + data_idx
-                    label = get_symbol_for_address(program_data, symbol_address)
-                    if label is None:
-                        return ""
-                    return label
-                elif column_idx == LI_INSTRUCTION:
-                    with_file_data = (block.flags & disassembly_data.BLOCK_FLAG_ALLOC) != disassembly_data.BLOCK_FLAG_ALLOC
-                    return loaderlib.get_data_instruction_string(program_data.loader_system_name, segments, block.segment_id, data_size, with_file_data)
-                elif column_idx == LI_OPERANDS:
-                    if block.flags & disassembly_data.BLOCK_FLAG_ALLOC:
-                        return str(size_count)
+                with_file_data = (block.flags & disassembly_data.BLOCK_FLAG_ALLOC) != disassembly_data.BLOCK_FLAG_ALLOC
+                row = _make_file_line_row(loaderlib.get_data_instruction_string(program_data.loader_system_name, segments, block.segment_id, data_size, with_file_data))
+                symbol_address = loaderlib.get_segment_address(segments, block.segment_id) + data_idx
+                row[LI_OFFSET] = "%08X" % symbol_address
+                label = get_symbol_for_address(program_data, symbol_address)
+                if label is not None:
+                    row[LI_LABEL] = label
+                if block.flags & disassembly_data.BLOCK_FLAG_ALLOC:
+                    row[LI_OPERANDS] = str(size_count)
+                else:
                     data = loaderlib.get_segment_data(segments, block.segment_id)
+                    row[LI_BYTES] = binascii.hexlify(data[data_idx:data_idx+num_bytes])
                     value = program_data.loader_data_types.sized_value(data_size, data, data_idx)
                     label = None
 
                     # TODO(rmtew): Should this be per-architecture pointer sized, not just 32 bit?
                     if data_size == disassembly_data.DATA_TYPE_DATA32:
-                        referring_address = loaderlib.get_segment_address(segments, block.segment_id) + data_idx
-                        label = get_potential_symbol_for_address(program_data, value, referring_address)
-                        
+                        label = get_potential_symbol_for_address(program_data, value, symbol_address)
+
                     if label is None:
                         label = ("$%0"+ str(num_bytes<<1) +"X") % value
-                    return label
-                elif DEBUG_ANNOTATE_DISASSEMBLY and column_idx == LI_ANNOTATIONS:
-                    return "-"
+                    row[LI_OPERANDS] = label
+                if DEBUG_ANNOTATE_DISASSEMBLY:
+                    row[LI_ANNOTATIONS] = "-"
+                return row
     elif data_type == disassembly_data.DATA_TYPE_ASCII:
-        block_lineN = block_line_count0 + leading_line_count
-        block_offsetN = block.segment_offset
-        for i, (byte_offset, byte_length) in enumerate(block.line_data):
-            block_offset0 = block_offsetN
-            block_offsetN += byte_length
-            block_line0 = block_lineN
-            block_lineN += 1
-
-            if line_idx >= block_line0 and line_idx < block_lineN:
-                data_idx = block_offset0
-                if column_idx == LI_OFFSET:
-                    return "%08X" % (loaderlib.get_segment_address(segments, block.segment_id) + data_idx)
-                elif column_idx == LI_BYTES:
-                    data = loaderlib.get_segment_data(segments, block.segment_id)
-                    return binascii.hexlify(data[data_idx:data_idx+byte_length])
-                elif column_idx == LI_LABEL:
-                    label = get_symbol_for_address(program_data, loaderlib.get_segment_address(segments, block.segment_id) + data_idx)
-                    if label is None:
-                        return ""
-                    return label
-                elif column_idx == LI_INSTRUCTION:
-                    return loaderlib.get_data_instruction_string(program_data.loader_system_name, segments, block.segment_id, disassembly_data.DATA_TYPE_DATA08, True)
-                elif column_idx == LI_OPERANDS:
-                    string = ""
-                    last_value = None
-                    data = loaderlib.get_segment_data(segments, block.segment_id)
-                    # TODO(rmtew): Make non-architecture specific.  m68k = comma separation?
-                    for byte in data[data_idx:data_idx+byte_length]:
-                        if type(byte) is str:
-                            byte = ord(byte)
-                        if byte >= 32 and byte < 127:
-                            # Sequential displayable characters get collected into a contiguous string.
-                            value = chr(byte)
-                            if type(last_value) is not str:
-                                if last_value is not None:
-                                    string += ","
-                                string += "'"
-                            string += value
-                        else:
-                            # Non-displayable characters are appended as separate pieces of data.
-                            value = byte
-                            if last_value is not None:
-                                if type(last_value) is str:
-                                    string += "'"
-                                string += ","
-                            string += _get_byte_representation(byte)
-                        last_value = value
+        # Each entry in the line data is one line, of the given bytes.
+        i = line_idx - (block_line_count0 + leading_line_count)
+        if i >= 0 and i < len(block.line_data):
+            byte_offset, byte_length = block.line_data[i]
+            data_idx = block.segment_offset + byte_offset
+            data = loaderlib.get_segment_data(segments, block.segment_id)
+            row = _make_file_line_row(loaderlib.get_data_instruction_string(program_data.loader_system_name, segments, block.segment_id, disassembly_data.DATA_TYPE_DATA08, True))
+            row[LI_OFFSET] = "%08X" % (loaderlib.get_segment_address(segments, block.segment_id) + data_idx)
+            row[LI_BYTES] = binascii.hexlify(data[data_idx:data_idx+byte_length])
+            label = get_symbol_for_address(program_data, loaderlib.get_segment_address(segments, block.segment_id) + data_idx)
+            if label is not None:
+                row[LI_LABEL] = label
+
+            string = ""
+            last_value = None
+            # TODO(rmtew): Make non-architecture specific.  m68k = comma separation?
+            for byte in data[data_idx:data_idx+byte_length]:
+                if type(byte) is str:
+                    byte = ord(byte)
+                if byte >= 32 and byte < 127:
+                    # Sequential displayable characters get collected into a contiguous string.
+                    value = chr(byte)
+                    if type(last_value) is not str:
+                        if last_value is not None:
+                            string += ","
+                        string += "'"
+                    string += value
+                else:
+                    # Non-displayable characters are appended as separate pieces of data.
+                    value = byte
                     if last_value is not None:
                         if type(last_value) is str:
                             string += "'"
-                    return string
-                elif DEBUG_ANNOTATE_DISASSEMBLY and column_idx == LI_ANNOTATIONS:
-                    return "-"
+                        string += ","
+                    string += _get_byte_representation(byte)
+                last_value = value
+            if last_value is not None:
+                if type(last_value) is str:
+                    string += "'"
+            row[LI_OPERANDS] = string
+            if DEBUG_ANNOTATE_DISASSEMBLY:
+                row[LI_ANNOTATIONS] = "-"
+            return row
     raise Exception("unhandled case")
 
+""" How many lines are searched together, each time the lock is taken. """
+SEARCH_LINE_BATCH_SIZE = 4096
+
+def _get_search_text(row):
+    # type: (Tuple[str, ...]) -> str
+    text = row[LI_LABEL] +" "+ row[LI_INSTRUCTION] +" "+ row[LI_OPERANDS]
+    if DEBUG_ANNOTATE_DISASSEMBLY:
+        text += " "+ row[LI_ANNOTATIONS]
+    return text.lower()
+
+def _prepare_search_index(program_data):
+    # type: (disassembly_data.ProgramData) -> disassembly_data.SearchIndex
+    # Locking: line_count_lock, held for reading.
+    with line_count_lock.read:
+        _recalculate_line_count_index(program_data)
+        with line_cache_lock:
+            search_index = program_data.search_index
+            search_index.resize(get_file_line_count(program_data))
+            search_index.apply_pending_texts()
+            return search_index
+
+def get_search_texts(program_data, line0, line_count):
+    # type: (disassembly_data.ProgramData, int, int) -> List[str]
+    # Locking: line_count_lock, held for reading.
+    """
+    The search text for a range of lines, clipped to the lines in the file.  Lines that are
+    not already indexed are rendered in contiguous runs, directly rather than through the file
+    line cache.
+    """
+    with line_count_lock.read:
+        search_index = _prepare_search_index(program_data)
+        line0 = max(line0, 0)
+        lineN = min(line0 + line_count, len(search_index))
+        lines = search_index.lines
+        with line_cache_lock:
+            line_idx = search_index.get_stale_line(line0, lineN)
+        while line_idx is not None:
+            line_idxN = line_idx + 1
+            while line_idxN < lineN and lines[line_idxN] is None:
+                line_idxN += 1
+            texts = [ _get_search_text(row) for row in _render_file_lines(program_data, line_idx, line_idxN - line_idx) ]
+            with line_cache_lock:
+                lines[line_idx:line_idxN] = texts
+                line_idx = search_index.get_stale_line(line_idxN, lineN)
+        with line_cache_lock:
+            return lines[line0:lineN]
+
+def api_update_search_index(program_data, line_count):
+    # type: (disassembly_data.ProgramData, int) -> bool
+    """ Index the first run of lines that are not yet indexed, returning whether there were any. """
+    with line_count_lock.read:
+        search_index = _prepare_search_index(program_data)
+        with line_cache_lock:
+            line0 = search_index.get_stale_line()
+        if line0 is None:
+            return False
+        get_search_texts(program_data, line0, line_count)
+        return True
+
+def search_file_lines(program_data, text, line_idx, direction, is_regex=False, work_state=None):
+    # type: (disassembly_data.ProgramData, str, int, int, bool, WorkState) -> Union[None, int]
+    """
+    The first line from `line_idx` on in the given direction (1 or -1), which contains the text
+    ignoring case, or matches the text as a regular expression.  Raises re.error if the regular
+    expression is invalid.
+    """
+    if is_regex:
+        match = re.compile(text, re.IGNORECASE).search
+    else:
+        lower_case_text = text.lower()
+        match = lambda line_text: lower_case_text in line_text
+    while line_idx >= 0:
+        if work_state is not None and work_state.is_cancelled():
+            return None
+        if direction == 1:
+            batch_line0 = line_idx
+        else:
+            batch_line0 = max(line_idx - SEARCH_LINE_BATCH_SIZE + 1, 0)
+        line_texts = get_search_texts(program_data, batch_line0, SEARCH_LINE_BATCH_SIZE)
+        if not line_texts:
+            break
+        if direction == 1:
+            idxs = range(line_idx - batch_line0, len(line_texts))
+            next_line_idx = batch_line0 + len(line_texts)
+        else:
+            idxs = range(min(line_idx - batch_line0, len(line_texts) - 1), -1, -1)
+            next_line_idx = batch_line0 - 1
+        for idx in idxs:
+            if match(line_texts[idx]):
+                return batch_line0 + idx
+        line_idx = next_line_idx
+        if work_state is not None:
+            line_count = len(program_data.search_index)
+            if direction == 1:
+                work_state.set_completeness(line_idx / float(line_count))
+            else:
+                work_state.set_completeness((line_count - line_idx) / float(line_count))
+            work_state.set_description("Line %d" % line_idx)
+    return None
+
+""" How many lines are rendered together when exporting source code. """
+EXPORT_LINE_BATCH_SIZE = 1024
+
+def get_source_code_text(program_data, line0, line_count):
+    # type: (disassembly_data.ProgramData, int, int) -> str
+    # Locking: line_count_lock, held for reading.
+    """
+    The exported source code for a range of lines.  These are rendered directly rather than
+    through the file line cache, as the rows would only displace those being viewed.  They are
+    clipped to the lines in the file, which may have changed since the range was decided on.
+    """
+    with line_count_lock.read:
+        line_count = min(line_count, get_file_line_count(program_data) - line0)
+        rows = _render_file_lines(program_data, line0, line_count) if line_count > 0 else []
+    lines = []
+    for row in rows:
+        label_text, instruction_text, operands_text = row[LI_LABEL], row[LI_INSTRUCTION], row[LI_OPERANDS]
+        line = label_text or ""
+        if instruction_text or operands_text:
+            line += "\t"+ instruction_text
+        if operands_text:
+            line += "\t"+ operands_text
+        lines.append(line)
+    lines.append("")
+    return "\n".join(lines)
+
+def generate_source_code_text(program_data, work_state=None, worker_count=1):
+    # type: (disassembly_data.ProgramData, WorkState, int) -> Iterator[str]
+    """
+    Yield the exported source code in file order, a batch of lines at a time.  With more than
+    one worker, batches are rendered ahead of time by a pool of threads, so that rendering
+    overlaps with whatever the caller does with the text it is given.
+    """
+    line_count = api_get_file_line_count(program_data)
+    line0s = range(0, line_count, EXPORT_LINE_BATCH_SIZE)
+    if worker_count > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(worker_count)
+        futures = collections.deque()
+    try:
+        for i, line0 in enumerate(line0s):
+            if work_state is not None and work_state.check_exit_update(i / float(len(line0s)), "TEXT_EXPORT_WRITING_LINES"):
+                return
+            if worker_count > 1:
+                # Keep the pool busy with the batches that follow.
+                for line0_ahead in line0s[i + len(futures):i + worker_count * 2]:
+                    futures.append(executor.submit(get_source_code_text, program_data, line0_ahead, min(EXPORT_LINE_BATCH_SIZE, line_count - line0_ahead)))
+                yield futures.popleft().result()
+            else:
+                yield get_source_code_text(program_data, line0, min(EXPORT_LINE_BATCH_SIZE, line_count - line0))
+    finally:
+        if worker_count > 1:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+def api_export_source_code(program_data, f, work_state=None, worker_count=1):
+    # type: (disassembly_data.ProgramData, io.IOBase, WorkState, int) -> bool
+    """ Write the source code to the file, returning whether it was completed rather than cancelled. """
+    is_text_file = isinstance(f, io.TextIOBase)
+    for text in generate_source_code_text(program_data, work_state, worker_count):
+        if is_text_file:
+            f.write(text)
+        else:
+            f.write(text.encode("latin-1"))
+    return work_state is None or not work_state.is_cancelled()
+
 def check_known_address(program_data, address):
     # type: (disassembly_data.ProgramData, int) -> bool
     """
@@ -715,51 +981,56 @@ def check_known_address(program_data, address):
     NOTE(rmtew): I'm not sure how well this works, given we only accept post segment addresses
     at 1 byte higher than the end of the any segment that precedes it.
     """
-    pre_ids = set() # type: Set[int]
-    for address0, addressN, segment_ids in program_data.address_ranges:
-        if address < address0:
-            pass
-        elif address > addressN:
-            pre_ids.update(segment_ids)
-            break
-        else:
-            return True
-
+    range_idx = bisect.bisect_right(program_data.address_range_starts, address) - 1
+    if range_idx < 0:
+        return False
+    address0, addressN, segment_ids = program_data.address_ranges[range_idx]
+    if address <= addressN:
+        return True
     if address == addressN + 1:
         # At this point we have an address that lies outside segment address spaces.
-        pre_segment_id = -1
-        if len(pre_ids):
-            pre_segment_id = max(pre_ids)
-            addresses = program_data.post_segment_addresses.get(pre_segment_id, None)
-            if addresses is None:
-                program_data.post_segment_addresses[pre_segment_id] = [ address ]
-            elif address not in addresses:
-                addresses.append(address)
-                addresses = sorted(addresses)
+        _insert_post_segment_address(program_data, max(segment_ids), address)
         return True
-    else:
-        pass # logger.debug("Found address not within segment address spaces: %X, excess: %d, pre segment_id: %s", address, address - addressN, pre_ids)
+    # logger.debug("Found address not within segment address spaces: %X, excess: %d, pre segment_id: %s", address, address - addressN, segment_ids)
     return False
 
+def check_known_addresses(program_data, addresses):
+    # type: (disassembly_data.ProgramData, List[int]) -> List[bool]
+    """ check_known_address for each of a sequence of addresses, returning whether each is valid. """
+    range_starts = program_data.address_range_starts
+    range_ends = program_data.address_range_ends
+    bisect_right = bisect.bisect_right
+    results = []
+    for address in addresses:
+        range_idx = bisect_right(range_starts, address) - 1
+        results.append(range_idx >= 0 and address <= range_ends[range_idx] + 1)
+    # The few addresses just past the end of segments are registered as trailing labels.
+    for address, result in zip(addresses, results):
+        if result and address > range_ends[bisect_right(range_starts, address) - 1]:
+            check_known_address(program_data, address)
+    return results
+
+def _insert_post_segment_address(program_data, segment_id, address):
+    # type: (disassembly_data.ProgramData, int, int) -> None
+    addresses = program_data.post_segment_addresses.setdefault(segment_id, [])
+    address_idx = bisect.bisect_left(addresses, address)
+    if address_idx == len(addresses) or addresses[address_idx] != address:
+        addresses.insert(address_idx, address)
+
 def insert_branch_address(program_data, address, src_abs_idx, pending_symbol_addresses):
     # type: (disassembly_data.ProgramData, int, int, Set[int]) -> bool
     if not check_known_address(program_data, address):
         return False
     # These get split as their turn to be disassembled comes up.
-    program_data.branch_addresses.setdefault(address, set()).add(src_abs_idx)
+    program_data.branch_addresses.add(address, src_abs_idx)
     pending_symbol_addresses.add(address)
     return True
 
 def remove_uncertain_reference(program_data, data_type, referring_address1, referred_address1):
     new_block, new_block_idx = lookup_block_by_address(program_data, referring_address1)
-    for t in new_block.references:
-        referring_address2, referred_address2, text = t
-        if referring_address1 == referring_address2:
-            if referred_address1 == referred_address2:
-                new_block.references.remove(t)
-                if program_data.uncertain_reference_modification_func is not None:
-                    program_data.uncertain_reference_modification_func(data_type, data_type, referring_address1, 4)
-                break
+    if disassembly_data.program_data_remove_block_reference(program_data, new_block, referring_address1, referred_address1):
+        if program_data.uncertain_reference_modification_func is not None:
+            program_data.uncertain_reference_modification_func(data_type, data_type, referring_address1, 4)
 
 def insert_reference_address(program_data, address, src_abs_idx, pending_symbol_addresses):
     # type: (disassembly_data.ProgramData, int, int, Set[int]) -> bool
@@ -770,21 +1041,26 @@ def insert_reference_address(program_data, address, src_abs_idx, pending_symbol_
     return True
 
 def _insert_reference_address(program_data, at_address, value):
-    program_data.reference_addresses.setdefault(at_address, set()).add(value)
+    program_data.reference_addresses.add(at_address, value)
 
 def api_get_referring_addresses(program_data, address):
     return get_referring_addresses(program_data, address)
 
 def get_referring_addresses(program_data, address):
     # type: (disassembly_data.ProgramData, int) -> Set[int]
-    referring_addresses = set() # type: Set[int]
-    referring_addresses.update(program_data.branch_addresses.get(address, set()))
-    referring_addresses.update(program_data.reference_addresses.get(address, set()))
-    other_addresses = program_data.loader_relocated_addresses.get(address, None)
-    if other_addresses is not None:
-        referring_addresses.update(other_addresses)
+    referring_addresses = set(program_data.branch_addresses.get(address, ())) # type: Set[int]
+    referring_addresses.update(program_data.reference_addresses.get(address, ()))
+    referring_addresses.update(program_data.loader_relocated_addresses.get(address, ()))
     return referring_addresses
 
+def get_references_from_range(program_data, address0, addressN):
+    # type: (disassembly_data.ProgramData, int, int) -> List[Tuple[int, int]]
+    """ The ( referring address, referred address ) pairs of the references made from within the address range, in address order. """
+    references = set() # type: Set[Tuple[int, int]]
+    for cross_references in (program_data.branch_addresses, program_data.reference_addresses, program_data.loader_relocated_addresses):
+        references.update(cross_references.get_reverse_items_in_range(address0, addressN))
+    return sorted(references)
+
 def api_set_symbol_insert_func(program_data, f):
     # type: (disassembly_data.ProgramData, Callable[[int, str], None]) -> None
     program_data.symbol_insert_func = f
@@ -798,16 +1074,56 @@ def set_symbol_for_address(program_data, address, symbol_label):
     if not check_known_address(program_data, address):
         return False
 
-    for existing_symbol_label in program_data.symbols_by_address.values():
-        if symbol_label == existing_symbol_label:
-            return False
+    if symbol_label in program_data.symbol_addresses_by_name:
+        return False
 
-    program_data.symbols_by_address[address] = symbol_label
+    old_symbol_label = program_data.symbols_by_address.get(address, None)
+    disassembly_data.program_data_set_symbol(program_data, address, symbol_label)
+    with line_count_lock.write:
+        _invalidate_symbol_lines(program_data, address, old_symbol_label)
     if program_data.symbol_insert_func:
         program_data.symbol_insert_func(address, symbol_label)
 
     return True
 
+def remove_symbol_for_address(program_data, address):
+    # type: (disassembly_data.ProgramData, int) -> bool
+    symbol_label = disassembly_data.program_data_remove_symbol(program_data, address)
+    if symbol_label is None:
+        return False
+
+    with line_count_lock.write:
+        _invalidate_symbol_lines(program_data, address, symbol_label)
+    if program_data.symbol_delete_func:
+        program_data.symbol_delete_func(address, symbol_label)
+
+    return True
+
+def _invalidate_symbol_lines(program_data, address, old_symbol_label):
+    # type: (disassembly_data.ProgramData, int, str) -> None
+    # Locking: line_count_lock, held for writing.
+    """ Discard the rendered rows and search text of the line of the address, and the lines referring to it. """
+    file_line_cache = program_data.file_line_cache
+    search_index = program_data.search_index
+    if not len(file_line_cache) and not len(search_index):
+        return
+    # Lines which refer to the address show the old symbol, or otherwise the address in hexadecimal.
+    search_index.invalidate_text(old_symbol_label or "%x" % address)
+    # Known references may instead show the address relative to the referring instruction.
+    for line_address in get_referring_addresses(program_data, address) | { address }:
+        line_idx = get_line_number_for_address(program_data, line_address)
+        if line_idx is not None:
+            with line_cache_lock:
+                file_line_cache.invalidate_lines(line_idx, 1)
+            search_index.invalidate_lines(line_idx, 1)
+
+def get_address_for_symbol(program_data, symbol_name):
+    # type: (disassembly_data.ProgramData, str) -> int
+    """ The address of the symbol with the given name, ignoring case. """
+    addresses = program_data.symbol_addresses_by_folded_name.get(symbol_name.lower())
+    if addresses:
+        return addresses[0]
+
 def get_symbol_for_address(program_data, address, absolute_info=None):
     # type: (disassembly_data.ProgramData, int, Tuple[int, int]) -> str
     # If the address we want a symbol was relocated somewhere, verify the instruction got relocated.
@@ -873,39 +1189,40 @@ def process_pending_symbol_address(program_data, address):
         return set_symbol_for_address(program_data, address, _get_auto_label_for_block(program_data, block, address))
     return False
 
-def _recalculate_line_count_index(program_data, dirtyidx=None):
-    # type: (disassembly_data.ProgramData, int) -> None
-    with line_count_rlock:
-        if dirtyidx is None:
-            dirtyidx = program_data.block_line0s_dirtyidx
-        elif program_data.block_line0s_dirtyidx is not None:
-            dirtyidx = min(dirtyidx, program_data.block_line0s_dirtyidx)
-
-        if dirtyidx is not None:
-            # logger.debug("Recalculated line counts, from idx %d", dirtyidx)
-            line_count_start = 0
-            if dirtyidx > 0:
-                line_count_start = program_data.block_line0s[dirtyidx-1] + get_block_line_count_cached(program_data, program_data.blocks[dirtyidx-1])
-            for i in range(dirtyidx, len(program_data.block_line0s)):
-                program_data.block_line0s[i] = line_count_start
-                line_count_start += get_block_line_count_cached(program_data, program_data.blocks[i])
-            program_data.block_line0s_dirtyidx = None
+def _recalculate_line_count_index(program_data):
+    # type: (disassembly_data.ProgramData) -> None
+    # Only writing marks blocks as dirty, and readers do not need to wait to see there are none.
+    if not program_data.block_line_count_dirty_addresses:
+        return
+    with line_count_lock.read, line_cache_lock:
+        dirty_addresses = program_data.block_line_count_dirty_addresses
+        if dirty_addresses:
+            # logger.debug("Recalculated line counts, for %d blocks", len(dirty_addresses))
+            blocks = program_data.blocks
+            for address in dirty_addresses:
+                block, block_idx = lookup_block_by_address(program_data, address)
+                blocks.set_line_count(block_idx, get_block_line_count_cached(program_data, block))
+            # Rendered lines from the first changed block on may differ, or have moved.
+            if len(program_data.file_line_cache) or len(program_data.search_index):
+                block, block_idx = lookup_block_by_address(program_data, min(dirty_addresses))
+                line0 = blocks.get_line_number(block_idx)
+                program_data.file_line_cache.invalidate_lines(line0)
+                program_data.search_index.invalidate_lines(line0)
+            dirty_addresses.clear()
 
 def get_block_line_number(program_data, block_idx):
     # type: (disassembly_data.ProgramData, int) -> int
-    with line_count_rlock:
+    with line_count_lock.read:
         _recalculate_line_count_index(program_data)
-        return program_data.block_line0s[block_idx]
+        return program_data.blocks.get_line_number(block_idx)
 
 def clear_block_line_count(program_data, block, block_idx=None):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock, int) -> None
-    with line_count_rlock:
-        if block_idx is None:
-            discard, block_idx = lookup_block_by_address(program_data, block.address)
+    # Locking: line_count_lock, held for writing.
+    with line_count_lock.write:
         block.line_count = 0
-        if program_data.block_line0s_dirtyidx is None or block_idx < program_data.block_line0s_dirtyidx:
-            program_data.block_line0s_dirtyidx = block_idx
+        block.line_index = None
+        program_data.block_line_count_dirty_addresses.add(block.address)
 
 def get_block_line_count_cached(program_data, block):
     # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock) -> int
@@ -914,29 +1231,22 @@ def get_block_line_count_cached(program_data, block):
     return block.line_count
 
 def lookup_block_by_line_count(program_data, lookup_key):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int) -> Tuple[disassembly_data.SegmentBlock, int]
-    with line_count_rlock:
+    # Locking: line_count_lock, held for reading.
+    with line_count_lock.read:
         _recalculate_line_count_index(program_data)
-        lookup_index = bisect.bisect_right(program_data.block_line0s, lookup_key)
-    return program_data.blocks[lookup_index-1], lookup_index-1
+        return program_data.blocks.lookup_line_number(lookup_key)
 
 def lookup_block_by_address(program_data, lookup_key):
     # type: (disassembly_data.ProgramData, int) -> Tuple[disassembly_data.SegmentBlock, int]
-    lookup_index = bisect.bisect_right(program_data.block_addresses, lookup_key)
-    return program_data.blocks[lookup_index-1], lookup_index-1
+    return program_data.blocks.lookup_address(lookup_key)
 
 def insert_block(program_data, insert_idx, block):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int, disassembly_data.SegmentBlock) -> None
-    with line_count_rlock:
-        program_data.block_addresses.insert(insert_idx, block.address)
+    # Locking: line_count_lock, held for writing.
+    with line_count_lock.write:
         program_data.blocks.insert(insert_idx, block)
-
-        program_data.block_line0s.insert(insert_idx, None)
-        # Update how much of the sorted line number index needs to be recalculated.
-        if program_data.block_line0s_dirtyidx is None or insert_idx < program_data.block_line0s_dirtyidx:
-            program_data.block_line0s_dirtyidx = insert_idx
+        program_data.block_line_count_dirty_addresses.add(block.address)
 
 ERR_SPLIT_EXISTING = -1
 ERR_SPLIT_BOUNDS = -2
@@ -947,14 +1257,19 @@ def IS_SPLIT_ERR(value):
     return value < 0
 
 def split_block(program_data, address, own_midinstruction=False):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int, bool) -> Tuple[disassembly_data.SegmentBlock, int]
+    # Locking: line_count_lock, held for writing.
     """
     Locate the block at `address` and split it if possible.
     own_midinstruction: Where something refers to an address mid-instruction in a code block, split it and add a relative EQU to deal with it.
 
     CONSTRAINT: This function should preserve line count.
     """
+    with line_count_lock.write:
+        return _split_block(program_data, address, own_midinstruction)
+
+def _split_block(program_data, address, own_midinstruction):
+    # type: (disassembly_data.ProgramData, int, bool) -> Tuple[disassembly_data.SegmentBlock, int]
     block, block_idx = lookup_block_by_address(program_data, address)
     if block.address == address:
         return block, ERR_SPLIT_EXISTING
@@ -975,6 +1290,8 @@ def split_block(program_data, address, own_midinstruction=False):
 
     # Do some pre-split code block validation.
     if block_data_type == disassembly_data.DATA_TYPE_CODE:
+        instruction_metadata = get_block_instruction_metadata(program_data, block)
+        instruction_idx = 0
         offsetN = 0
         for i, (type_id, entry) in enumerate(block.line_data):
             # Comments are assumed to be related to succeeding instruction lines, so are grouped for purposes of splitting.
@@ -983,12 +1300,12 @@ def split_block(program_data, address, own_midinstruction=False):
                     break
 
             if type_id == disassembly_data.SLD_INSTRUCTION:
-                entry = get_instruction_entry(program_data, block, block.line_data, i)
-                offsetN += entry.num_bytes
+                offsetN += instruction_metadata[instruction_idx] & disassembly_data.IMD_LENGTH_MASK
+                instruction_idx += 1
                 if block_length_reduced < offsetN:
                     if own_midinstruction:
                         # Multiple consecutive entries of this type will be out of order.  Not worth bothering about.
-                        block.line_data.insert(i+1, (disassembly_data.SLD_EQU_LOCATION_RELATIVE, split_offset))
+                        block.line_data.insert(i+1, disassembly_data.SLD_EQU_LOCATION_RELATIVE, split_offset)
                         clear_block_line_count(program_data, block, block_idx)
                     else:
                         logger.debug("Attempting to split block mid-instruction (not handled here): %06X", address)
@@ -997,20 +1314,17 @@ def split_block(program_data, address, own_midinstruction=False):
         # Line data: divide between blocks at the given point.
         block_line_data = block.line_data[:i]
         split_block_line_data = block.line_data[i:]
+        split_instruction_idx = block_line_data.type_ids.count(disassembly_data.SLD_INSTRUCTION)
 
         # Line data: rebase block offsets within new block entries.
-        for i, (type_id, entry) in enumerate(split_block_line_data):
-            if type_id in (disassembly_data.SLD_EQU_LOCATION_RELATIVE, disassembly_data.SLD_INSTRUCTION) and type(entry) is int:
-                split_block_line_data[i] = (type_id, entry-split_offset)
+        split_block_line_data.rebase(split_offset)
 
         if address & 1:
             logger.debug("Splitting code block at odd address: %06X", address)
 
     # References: divide between blocks at the given address.
     if block.references is not None and len(block.references):
-        for i, entry in enumerate(block.references):
-            if entry[0] >= address:
-                break
+        i = bisect.bisect_left(block.references, (address,))
         new_block_references = block.references[i:]
         block.references[i:] = []
     else:
@@ -1031,44 +1345,66 @@ def split_block(program_data, address, own_midinstruction=False):
     if block_data_type == disassembly_data.DATA_TYPE_CODE:
         block.line_data = block_line_data
         new_block.line_data = split_block_line_data
+        block.instruction_metadata = instruction_metadata[:split_instruction_idx]
+        new_block.instruction_metadata = instruction_metadata[split_instruction_idx:]
+        program_data.instruction_cache.set_count(block, _count_instruction_entries(block_line_data))
+        program_data.instruction_cache.set_count(new_block, _count_instruction_entries(split_block_line_data))
     elif block_data_type == disassembly_data.DATA_TYPE_ASCII:
         _process_block_as_ascii(program_data, block)
         _process_block_as_ascii(program_data, new_block)
 
     insert_block(program_data, block_idx + 1, new_block)
     clear_block_line_count(program_data, block, block_idx)
+    # The bytes stay with the same data type, there is just one more block of it.
+    disassembly_data.program_data_update_block_data_type_counts(program_data, block_data_type, 1, 0)
     on_block_created(program_data, new_block)
 
     return new_block, block_idx + 1
 
 def _locate_uncertain_data_references(program_data, address, block=None):
-    """ line_count_rlock """
-    # type: (disassembly_data.ProgramData, int, disassembly_data.SegmentBlock) -> List[UncertainReference]
+    # type: (disassembly_data.ProgramData, int, disassembly_data.SegmentBlock) -> List[UncertainReferenceMatch]
     """ Check for valid 32 bit addresses at all 16 bit aligned offsets within the data block from address onwards. """
     if block is None:
         block, block_idx = lookup_block_by_address(program_data, address)
     data = loaderlib.get_segment_data(program_data.loader_segments, block.segment_id)
     data_idx_start = block.segment_offset + (address - block.address)
     data_idx_end = block.segment_offset + block.length
-    address_offset = 0
-    matches = []
-    f = program_data.loader_data_types.uint32_value
-    while data_idx_start + address_offset + 4 <= data_idx_end:
-        value = f(data, data_idx_start + address_offset)
-        if check_known_address(program_data, value):
-            with line_count_rlock:
-                line_idx = get_line_number_for_address(program_data, address + address_offset)
-                code_string = get_file_line(program_data, line_idx, LI_INSTRUCTION)
-                operands_text = get_file_line(program_data, line_idx, LI_OPERANDS)
-            if len(operands_text):
-                code_string += " "+ operands_text
-            matches.append((address + address_offset, value, code_string))
-        address_offset += 2
-    return matches
+    if data is None:
+        return []
+    pairs = _scan_known_address_words(program_data, data, data_idx_start, data_idx_end)
+    return [ (address + (data_idx - data_idx_start), value, MAF_ABSOLUTE_ADDRESS) for (data_idx, value) in pairs ]
+
+def _scan_known_address_words(program_data, data, data_idx_start, data_idx_end):
+    # type: (disassembly_data.ProgramData, Any, int, int) -> List[Tuple[int, int]]
+    """
+    Decode the 32 bit words at all 16 bit aligned offsets in the given range of segment data,
+    returning (data_idx, value) for those whose value is a known address.
+
+    The words at 4 byte aligned offsets and those in between are each decoded in a single call,
+    and anything outside the span of all address ranges is discarded before the bisecting check.
+    """
+    if data_idx_end - data_idx_start < 4 or not program_data.address_range_starts:
+        return []
+    uint32_values = program_data.loader_data_types.uint32_values
+    even_count = (data_idx_end - data_idx_start) // 4
+    odd_count = (data_idx_end - data_idx_start - 2) // 4
+    lowest_address = program_data.address_range_starts[0]
+    highest_address = program_data.address_range_ends[-1] + 1
+    candidates = []
+    for phase_offset, count in ((0, even_count), (2, odd_count)):
+        if count <= 0:
+            continue
+        data_idx0 = data_idx_start + phase_offset
+        values = uint32_values(data, data_idx0, count)
+        candidates.extend((data_idx0 + 4 * i, value) for i, value in enumerate(values) if lowest_address <= value <= highest_address)
+    if not candidates:
+        return []
+    candidates.sort()
+    is_knowns = check_known_addresses(program_data, [ value for (data_idx, value) in candidates ])
+    return [ candidate for candidate, is_known in zip(candidates, is_knowns) if is_known ]
 
 def _locate_uncertain_code_references(program_data, address, is_binary_file, block=None):
-    """ line_count_rlock """
-    # type: (disassembly_data.ProgramData, int, bool, disassembly_data.SegmentBlock) -> List[UncertainReference]
+    # type: (disassembly_data.ProgramData, int, bool, disassembly_data.SegmentBlock) -> List[UncertainReferenceMatch]
     """ Check for candidate operand values in instructions within the code block from address onwards. """
     if block is None:
         block, block_idx = lookup_block_by_address(program_data, address)
@@ -1088,24 +1424,62 @@ def _locate_uncertain_code_references(program_data, address, is_binary_file, blo
                     elif match_address not in program_data.loader_relocated_addresses:
                         do_match = flags & MAF_ABSOLUTE_ADDRESS
                     if do_match:
-                        with line_count_rlock:
-                            line_idx = get_line_number_for_address(program_data, address0)
-                            code_string = get_file_line(program_data, line_idx, LI_INSTRUCTION)
-                            operands_text = get_file_line(program_data, line_idx, LI_OPERANDS)
-                        if len(operands_text):
-                            code_string += " "+ operands_text
-                        matches.append((address0, match_address, code_string))
+                        matches.append((address0, match_address, flags))
+    # Kept in address order, so that individual references can be found by bisection.
+    matches.sort()
     return matches
 
+def get_uncertain_references_in_range(references, address0=None, addressN=None):
+    # type: (List[UncertainReferenceMatch], int, int) -> List[UncertainReferenceMatch]
+    """ The references from an address ordered index, with referring addresses from address0 up to but excluding addressN. """
+    idx0 = 0 if address0 is None else bisect.bisect_left(references, (address0,))
+    idxN = len(references) if addressN is None else bisect.bisect_left(references, (addressN,))
+    return references[idx0:idxN]
+
+def get_uncertain_reference_rows(program_data, references):
+    # type: (disassembly_data.ProgramData, List[UncertainReferenceMatch]) -> List[UncertainReference]
+    # Locking: line_count_lock, held for reading.
+    """
+    Uncertain references only record the addresses involved, and the source code of the referring
+    line is rendered when they are displayed.  It comes from the cached rows of those lines.
+    """
+    rows = [] # type: List[UncertainReference]
+    with line_count_lock.read:
+        for (referring_address, referred_address, flags) in references:
+            line_idx = get_line_number_for_address(program_data, referring_address)
+            if line_idx is None:
+                # As for the rows of lines which cannot be located, when rendered by cell.
+                code_string = "BAD ROW"
+            else:
+                row = get_file_line_row(program_data, line_idx)
+                code_string = row[LI_INSTRUCTION]
+                if len(row[LI_OPERANDS]):
+                    code_string += " "+ row[LI_OPERANDS]
+            rows.append((referring_address, referred_address, code_string))
+    return rows
+
 def set_data_type_at_address(program_data, address, data_type, work_state=None):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int, int, WorkState) -> None
+    # Locking: line_count_lock, held for writing.
     block, block_idx = lookup_block_by_address(program_data, address)
     set_block_data_type(program_data, data_type, block, block_idx=block_idx, work_state=work_state, address=address)
 
+def _remove_code_block_references(program_data, block):
+    # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock) -> None
+    # Locking: line_count_lock, held for writing.
+    """ Remove the branches and references made by the instructions of a code block, before it becomes data. """
+    removed_items = [] # type: List[Tuple[int, int]]
+    for i, (type_id, entry) in enumerate(block.line_data):
+        if type_id == disassembly_data.SLD_INSTRUCTION:
+            entry = get_instruction_entry(program_data, block, block.line_data, i, cache=False)
+            entry_address = entry.pc - program_data.dis_constant_pc_offset
+            removed_items.extend((match_address, entry_address) for (match_address, opcode_idx, flags) in program_data.dis_get_match_addresses_func(entry))
+    program_data.branch_addresses.remove_items(removed_items)
+    program_data.reference_addresses.remove_items(removed_items)
+
 def set_block_data_type(program_data, data_type, block, block_idx=None, work_state=None, address=None):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData, int, disassembly_data.SegmentBlock, int, WorkState, int) -> None
+    # Locking: line_count_lock, held for writing.
     if address is None:
         address = block.address
     if block_idx is None:
@@ -1137,6 +1511,8 @@ def set_block_data_type(program_data, data_type, block, block_idx=None, work_sta
         # This can fail, so we do not explicitly change the block ourselves.
         _process_address_as_code(program_data, address, set([ ]), work_state)
     else:
+        if block_data_type == disassembly_data.DATA_TYPE_CODE:
+            _remove_code_block_references(program_data, block)
         _internal_set_block_data(program_data, block, block_idx, data_type, old_block_length)
 
     event_blocks = {} # type: Dict[int, Tuple[disassembly_data.SegmentBlock, int, int, Union[int, None]]]
@@ -1168,11 +1544,15 @@ def set_block_data_type(program_data, data_type, block, block_idx=None, work_sta
         do_broadcast = False
         old_references = affected_block.references
         if data_type_new == disassembly_data.DATA_TYPE_CODE:
-            affected_block.references = _locate_uncertain_code_references(program_data, affected_block.address, is_binary_file, affected_block)
+            new_references = _locate_uncertain_code_references(program_data, affected_block.address, is_binary_file, affected_block)
         else:
-            affected_block.references = _locate_uncertain_data_references(program_data, affected_block.address)
+            new_references = _locate_uncertain_data_references(program_data, affected_block.address)
+        disassembly_data.program_data_set_block_references(program_data, affected_block, new_references)
         if old_references != affected_block.references:
             do_broadcast = True
+        elif data_type_old != data_type_new and (old_references or affected_block.references):
+            # The references are the same, but the rendered rows of the referring lines are not.
+            do_broadcast = True
         if do_broadcast and program_data.uncertain_reference_modification_func is not None:
             #if program_data.state == disassembly_data.STATE_LOADED:
             #    print "BROADCAST", affected_block.sequence_id, hex(affected_block.address), "dt:", data_type_old, "->", data_type_new
@@ -1185,8 +1565,8 @@ def set_block_data_type(program_data, data_type, block, block_idx=None, work_sta
 
 
 def _process_block_as_ascii(program_data, block):
-    """ line_count_rlock: irrelevant """
     # type: (disassembly_data.ProgramData, disassembly_data.SegmentBlock) -> None
+    # Locking: line_count_lock is irrelevant.
     """
     Ensure that the block line data contans metadata suitable for rendering the lines,
     and counting how many there are for the given data.
@@ -1282,8 +1662,8 @@ def DEBUG_get_instruction_repr(program_data, instruction):
         result += " "+ program_data.dis_get_operand_string_func(instruction, operand, lookup_symbol=lookup_symbol)
     return result
 
-def _internal_set_block_data(program_data, block, block_idx, new_data_type, old_block_length, line_data=None):
-    with line_count_rlock:
+def _internal_set_block_data(program_data, block, block_idx, new_data_type, old_block_length, line_data=None, instruction_metadata=None):
+    with line_count_lock.write:
         line0 = get_block_line_number(program_data, block_idx)
         old_line_count = get_block_line_count_cached(program_data, block)
         old_data_type = disassembly_data.get_block_data_type(block)
@@ -1292,6 +1672,8 @@ def _internal_set_block_data(program_data, block, block_idx, new_data_type, old_
         temp_block = disassembly_data.SegmentBlock(block)
         disassembly_data.set_block_data_type(temp_block, new_data_type)
 
+        temp_block.line_index = None
+        temp_block.instruction_metadata = instruction_metadata
         if new_data_type == disassembly_data.DATA_TYPE_CODE:
             temp_block.line_data = line_data
         else:
@@ -1305,6 +1687,13 @@ def _internal_set_block_data(program_data, block, block_idx, new_data_type, old_
 
         # 3. Notify listeners the change is about to happen (with metadata).
         line_count_delta = temp_block.line_count - old_line_count
+        with line_cache_lock:
+            if line_count_delta != 0:
+                # The lines of all following blocks move.
+                program_data.file_line_cache.invalidate_lines(line0)
+            else:
+                program_data.file_line_cache.invalidate_lines(line0, old_line_count)
+        program_data.search_index.replace_lines(line0, old_line_count, temp_block.line_count)
         if line_count_delta != 0:
             if program_data.pre_line_change_func:
                 if line_count_delta > 0:
@@ -1314,11 +1703,15 @@ def _internal_set_block_data(program_data, block, block_idx, new_data_type, old_
 
         # 4. Make the change.
         temp_block.copy_to(block)
+        program_data.instruction_cache.set_count(block, 0)
+        if new_data_type == disassembly_data.DATA_TYPE_CODE:
+            _demote_instruction_entries(program_data, program_data.instruction_cache.insert(block, _count_instruction_entries(block.line_data)))
+        disassembly_data.program_data_update_block_data_type_counts(program_data, old_data_type, -1, -block.length)
+        disassembly_data.program_data_update_block_data_type_counts(program_data, new_data_type, 1, block.length)
 
         if line_count_delta != 0:
-            # We changed the line count, we need to flag a block line numbering recalculation.
-            if program_data.block_line0s_dirtyidx is None or program_data.block_line0s_dirtyidx > block_idx+1:
-                program_data.block_line0s_dirtyidx = block_idx+1
+            # We changed the line count, the line numbering of following blocks depends on it.
+            program_data.blocks.set_line_count(block_idx, block.line_count)
 
             if program_data.post_line_change_func:
                 program_data.post_line_change_func(None, line_count_delta)
@@ -1332,8 +1725,7 @@ def _process_address_as_code(program_data, address, pending_symbol_addresses, wo
     disassembly_offsets = set([ address ])
     while len(disassembly_offsets):
         if work_state is not None:
-            extra_fraction = sum(block.length for block in program_data.blocks if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE) / float(program_data.file_size) * 0.6
-            if work_state.check_exit_update(0.2 + extra_fraction, "TEXT_LOAD_DISASSEMBLY_PASS"):
+            if work_state.check_exit_throttled_update(0.2 + program_data.data_type_byte_counts[disassembly_data.DATA_TYPE_CODE] / float(program_data.file_size) * 0.6, "TEXT_LOAD_DISASSEMBLY_PASS"):
                 return
 
         address = disassembly_offsets.pop()
@@ -1356,13 +1748,12 @@ def _process_address_as_code(program_data, address, pending_symbol_addresses, wo
         # Disassemble as much of the block's data as possible.
         bytes_consumed = 0
         data_bytes_to_skip = 0
-        line_data = []
+        line_data = disassembly_data.LineData()
         found_terminating_instruction = False
-        while bytes_consumed < block.length:
-            data = loaderlib.get_segment_data(program_data.loader_segments, block.segment_id)
-            data_offset_start = block.segment_offset + bytes_consumed
+        data = loaderlib.get_segment_data(program_data.loader_segments, block.segment_id)
+        data_offset_start = block.segment_offset
+        for match, data_offset_end, is_final_instruction in program_data.dis_disassemble_range_func(data, data_offset_start, data_offset_start + block.length, address):
             match_address = address + bytes_consumed
-            match, data_offset_end = program_data.dis_disassemble_one_line_func(data, data_offset_start, match_address)
             if match is None:
                 # Likely bad disassembly.
                 if data_offset_start >= len(data):
@@ -1377,19 +1768,16 @@ def _process_address_as_code(program_data, address, pending_symbol_addresses, wo
             if bytes_consumed + bytes_matched > block.length:
                 logger.error("unable to disassemble due to a block length overrun at %X (started at %X)", match_address, address)
                 break
-            line_data.append((disassembly_data.SLD_INSTRUCTION, match))
-            current_idx = len(line_data)-1
+            line_data.append_instruction(bytes_consumed, match)
             for label_offset in range(1, bytes_matched):
                 label_address = match_address + label_offset
                 label = program_data.symbols_by_address.get(label_address)
                 if label is not None:
-                    line_data.append((disassembly_data.SLD_EQU_LOCATION_RELATIVE, label_address - address))
+                    line_data.append(disassembly_data.SLD_EQU_LOCATION_RELATIVE, label_address - address)
                     #logger.debug("%06X: mid-instruction label = '%s' %d", match_address, label, label_address-match_address)
             bytes_consumed += bytes_matched
-            discard, preceding_match = find_previous_instruction(program_data, block, line_data, current_idx)
-            found_terminating_instruction = program_data.dis_is_final_instruction_func(match, preceding_match)
-            if found_terminating_instruction:
-                break
+            data_offset_start = data_offset_end
+            found_terminating_instruction = is_final_instruction
 
         # Discard any unprocessed block / jump over isolatible unprocessed instructions.
         if bytes_consumed < block.length:
@@ -1441,7 +1829,8 @@ def _process_address_as_code(program_data, address, pending_symbol_addresses, wo
         if len(line_data) == 0:
             continue
 
-        _internal_set_block_data(program_data, block, block_idx, disassembly_data.DATA_TYPE_CODE, old_block_length, line_data)
+        instruction_metadata = bytearray(get_instruction_metadata(program_data, entry) for (type_id, entry) in line_data if type_id == disassembly_data.SLD_INSTRUCTION)
+        _internal_set_block_data(program_data, block, block_idx, disassembly_data.DATA_TYPE_CODE, old_block_length, line_data, instruction_metadata)
 
         # Extract any addresses which are referred to, for later use.
         is_binary_file = (program_data.flags & disassembly_data.PDF_BINARY_FILE) == disassembly_data.PDF_BINARY_FILE
@@ -1516,6 +1905,7 @@ def api_load_project_file(save_file, file_name, work_state=None):
         return None, 0
 
     program_data.file_name = file_name
+    disassembly_data.program_data_count_block_data_types(program_data)
 
     for block in program_data.blocks:
         if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_ASCII:
@@ -1530,8 +1920,8 @@ def api_load_project_file(save_file, file_name, work_state=None):
     return program_data, get_file_line_count(program_data)
 
 def api_load_file(input_file, new_options, file_name, work_state=None):
-    """ line_count_rlock """
     # type: (file, disassembly_data.NewProjectOptions, str, WorkState) -> Tuple[disassembly_data.ProgramData, int]
+    # Locking: line_count_lock, held for writing.
     loader_options = None
     if new_options.is_binary_file:
         loader_options = loaderlib.BinaryFileOptions()
@@ -1553,14 +1943,11 @@ def api_load_file(input_file, new_options, file_name, work_state=None):
     if new_options.is_binary_file:
         flags |= disassembly_data.PDF_BINARY_FILE
     program_data.flags |= flags
-    program_data.block_addresses = []
-    program_data.block_line0s = []
-    program_data.block_line0s_dirtyidx = 0
+    program_data.block_line_count_dirty_addresses = set()
     program_data.post_segment_addresses = {}
 
     program_data.loader_system_name = file_info.system.system_name
     program_data.loader_relocatable_addresses = set()
-    program_data.loader_relocated_addresses = dict()
 
     program_data.file_name = file_name
     input_file.seek(0, os.SEEK_END)
@@ -1581,7 +1968,9 @@ def api_load_file(input_file, new_options, file_name, work_state=None):
     program_data.loader_entrypoint_offset = file_info.entrypoint_offset
     for i in range(len(segments)):
         loaderlib.cache_segment_data(input_file, segments, i)
-    loaderlib.relocate_segment_data(segments, data_types, file_info.relocations_by_segment_id, program_data.loader_relocatable_addresses, program_data.loader_relocated_addresses)
+    relocated_addresses = {} # type: Dict[int, Set[int]]
+    loaderlib.relocate_segment_data(segments, data_types, file_info.relocations_by_segment_id, program_data.loader_relocatable_addresses, relocated_addresses)
+    program_data.loader_relocated_addresses = disassembly_data.CrossReferences(relocated_addresses)
 
     # Start disassembling.
     entrypoint_address = loaderlib.get_segment_address(segments, program_data.loader_entrypoint_segment_id) + program_data.loader_entrypoint_offset
@@ -1603,9 +1992,9 @@ def api_load_file(input_file, new_options, file_name, work_state=None):
         block.segment_offset = 0
         block.address = address
         block.length = data_length
-        program_data.block_addresses.append(block.address)
-        program_data.block_line0s.append(None)
         program_data.blocks.append(block)
+        program_data.block_line_count_dirty_addresses.add(block.address)
+        disassembly_data.program_data_update_block_data_type_counts(program_data, disassembly_data.DATA_TYPE_DATA32, 1, block.length)
 
         on_block_created(program_data, block)
 
@@ -1617,9 +2006,9 @@ def api_load_file(input_file, new_options, file_name, work_state=None):
             block.segment_offset = data_length
             block.address = address + data_length
             block.length = segment_length - data_length
-            program_data.block_addresses.append(block.address)
-            program_data.block_line0s.append(None)
             program_data.blocks.append(block)
+            program_data.block_line_count_dirty_addresses.add(block.address)
+            disassembly_data.program_data_update_block_data_type_counts(program_data, disassembly_data.DATA_TYPE_DATA32, 1, block.length)
 
             on_block_created(program_data, block)
 
@@ -2150,6 +2539,7 @@ def onload_set_disassemblylib_functions(program_data):
     program_data.dis_get_operand_values_func = arch.function_get_operand_values
     program_data.dis_get_operand_value_func = arch.function_get_operand_value
     program_data.dis_disassemble_one_line_func = arch.function_disassemble_one_line
+    program_data.dis_disassemble_range_func = arch.disassemble_range
     program_data.dis_disassemble_as_data_func = arch.function_disassemble_as_data
     program_data.dis_get_default_symbol_name_func = arch.function_get_default_symbol_name
     program_data.dis_constant_pc_offset = arch.constant_pc_offset
@@ -2172,10 +2562,14 @@ def onload_make_address_ranges(program_data):
                 break
         else:
             program_data.address_ranges.append((new_address0, new_addressN-1, set([segment_id])))
+    # Ordered by address, for bisection.
+    program_data.address_ranges.sort(key=lambda address_range: address_range[0])
+    program_data.address_range_starts = [ address0 for (address0, addressN, segment_ids) in program_data.address_ranges ]
+    program_data.address_range_ends = [ addressN for (address0, addressN, segment_ids) in program_data.address_ranges ]
 
 def onload_cache_uncertain_references(program_data):
-    """ line_count_rlock """
     # type: (disassembly_data.ProgramData) -> None    
+    # Locking: line_count_lock, held for writing.
     is_binary_file = (program_data.flags & disassembly_data.PDF_BINARY_FILE) == disassembly_data.PDF_BINARY_FILE
     for block in program_data.blocks:
         data_type = disassembly_data.get_block_data_type(block)
@@ -2183,6 +2577,7 @@ def onload_cache_uncertain_references(program_data):
             block.references = _locate_uncertain_code_references(program_data, block.address, is_binary_file, block)
         elif is_binary_file:
             block.references = _locate_uncertain_data_references(program_data, block.address, block)
+    disassembly_data.program_data_index_uncertain_references(program_data)
 
 
 def api_is_segment_data_cached(program_data):
@@ -2203,17 +2598,22 @@ def on_block_data_type_change(program_data, block, old_data_type, new_data_type,
     if program_data.block_data_type_events is not None:
         program_data.block_data_type_events.append((block, old_data_type, new_data_type, old_length))
 
+def get_load_stats(program_data):
+    # type: (disassembly_data.ProgramData) -> Dict[str, int]
+    """ Statistics about the current state of the disassembly, from the running data type counts. """
+    return {
+        "block_count": len(program_data.blocks),
+        "code_blocks": program_data.data_type_block_counts[disassembly_data.DATA_TYPE_CODE],
+        "code_bytes": program_data.data_type_byte_counts[disassembly_data.DATA_TYPE_CODE],
+        "file_size": program_data.file_size,
+    }
+
 def DEBUG_log_load_stats(program_data):
     # type: (disassembly_data.ProgramData) -> None
 
     # Log debug statistics
-    num_code_blocks = 0
-    num_code_bytes = 0
-    for block in program_data.blocks:
-        if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE:
-            num_code_bytes += block.length
-            num_code_blocks += 1
-    logger.debug("Initial result, code bytes: %d, code blocks: %d", num_code_bytes, num_code_blocks)
+    stats = get_load_stats(program_data)
+    logger.debug("Initial result, code bytes: %d, code blocks: %d", stats["code_bytes"], stats["code_blocks"])
 
 def DEBUG_locate_potential_code_blocks(program_data):
     # type: (disassembly_data.ProgramData) -> List[disassembly_data.SegmentBlock]
@@ -2244,7 +2644,7 @@ class DisassemblyApi(object):
 
     def get_code_block_info_for_address(self, address):
         # type: (int) -> Union[None, InstructionEntry]
-        with line_count_rlock:
+        with line_count_lock.read:
             return api_get_code_block_info_for_address(self._program_data, address)
 
     def set_data_type_at_address(self, address, data_type, work_state=None):
@@ -2258,7 +2658,7 @@ class DisassemblyApi(object):
 
     def get_line_number_for_address(self, address):
         # type: (int) -> Union[None, int]
-        with line_count_rlock:
+        with line_count_lock.read:
             return get_line_number_for_address(self._program_data, address)
 
     def get_address_for_line_number(self, line_number):
@@ -2266,7 +2666,7 @@ class DisassemblyApi(object):
         return api_get_address_for_line_number(self._program_data, line_number)
 
     def get_referenced_symbol_addresses_for_line_number(self, line_number: int) -> List[Tuple[int, int]]:
-        with line_count_rlock:
+        with line_count_lock.read:
             result = get_code_block_info_for_line_number(self._program_data, line_number)
             if result is not None:
                 discard_address, match = result
@@ -2295,6 +2695,39 @@ class DisassemblyApi(object):
         # type: (int, int) -> str
         return api_get_file_line(self._program_data, line_idx, column_idx)
 
+    def get_file_line_row(self, line_idx):
+        # type: (int) -> Tuple[str, ...]
+        return get_file_line_row(self._program_data, line_idx)
+
+    def get_file_lines(self, line0, line_count):
+        # type: (int, int) -> List[Tuple[str, ...]]
+        return api_get_file_lines(self._program_data, line0, line_count)
+
+    def search_file_lines(self, text, line_idx, direction, is_regex=False, work_state=None):
+        # type: (str, int, int, bool, WorkState) -> Union[None, int]
+        return search_file_lines(self._program_data, text, line_idx, direction, is_regex, work_state)
+
+    def update_search_index(self, line_count):
+        # type: (int) -> bool
+        return api_update_search_index(self._program_data, line_count)
+
+    def export_source_code(self, f, work_state=None, worker_count=1):
+        # type: (io.IOBase, WorkState, int) -> bool
+        return api_export_source_code(self._program_data, f, work_state, worker_count)
+
+    def get_file_line_cache_stats(self):
+        # type: () -> Dict[str, Any]
+        return self._program_data.file_line_cache.get_stats()
+
+    def get_instruction_cache_stats(self):
+        # type: () -> Dict[str, Any]
+        return self._program_data.instruction_cache.get_stats()
+
+    def set_instruction_cache_budget(self, max_instructions):
+        # type: (int) -> None
+        with line_count_lock.write:
+            _demote_instruction_entries(self._program_data, self._program_data.instruction_cache.set_max_instructions(max_instructions))
+
     def insert_reference_address(self, referring_address):
         # type: (int) -> None
         is_binary_file = (self._program_data.flags & disassembly_data.PDF_BINARY_FILE) == disassembly_data.PDF_BINARY_FILE
@@ -2323,6 +2756,9 @@ class DisassemblyApi(object):
                     was_new_symbol = process_pending_symbol_address(self._program_data, referred_address)
 
                     line0 = get_line_number_for_address(self._program_data, referring_address)
+                    with line_count_lock.write, line_cache_lock:
+                        self._program_data.file_line_cache.invalidate_lines(line0, 1)
+                        self._program_data.search_index.invalidate_lines(line0, 1)
                     if self._program_data.post_line_change_func:
                         self._program_data.post_line_change_func(line0, 0)
 
@@ -2338,6 +2774,10 @@ class DisassemblyApi(object):
         # type: (int) -> Set[int]
         return api_get_referring_addresses(self._program_data, address)
 
+    def get_references_from_range(self, address0, addressN):
+        # type: (int, int) -> List[Tuple[int, int]]
+        return get_references_from_range(self._program_data, address0, addressN)
+
     def get_entrypoint_address(self):
         # type: () -> int
         return loaderlib.get_segment_address(self._program_data.loader_segments, self._program_data.loader_entrypoint_segment_id) + self._program_data.loader_entrypoint_offset
@@ -2352,26 +2792,27 @@ class DisassemblyApi(object):
 
     def get_address_for_symbol(self, symbol_name):
         # type: (str) -> int
-        symbol_name = symbol_name.lower()
-        for k, v in self._program_data.symbols_by_address.items():
-            if v.lower() == symbol_name:
-                return k
+        return get_address_for_symbol(self._program_data, symbol_name)
 
     def set_symbol_for_address(self, address, symbol_label):
         # type: (int, str) -> bool
         return set_symbol_for_address(self._program_data, address, symbol_label)
 
+    def remove_symbol_for_address(self, address):
+        # type: (int) -> bool
+        return remove_symbol_for_address(self._program_data, address)
+
     def get_symbol_for_address(self, address, absolute_info=None):
         # type: (int, Tuple[int, int]) -> str
-        with line_count_rlock:
+        with line_count_lock.read:
             return get_symbol_for_address(self._program_data, address, absolute_info)
 
     def get_symbols(self):
         return self._program_data.symbols_by_address.items()
 
     def get_next_block_line_number(self, data_type, line_idx, direction_offset=1, op_func=operator.eq):
-        """ line_count_rlock """
         # type: (int, int, int, Callable[[Any, Any], int]) -> int
+        # Locking: line_count_lock, held for reading.
         block, block_idx = lookup_block_by_line_count(self._program_data, line_idx)
         block_idx += direction_offset
         while block_idx < len(self._program_data.blocks) and block_idx >= 0:
@@ -2379,28 +2820,20 @@ class DisassemblyApi(object):
                 return get_block_line_number(self._program_data, block_idx)
             block_idx += direction_offset
 
-    def get_uncertain_data_references(self):
-        # type: () -> List[UncertainReference]
-        results = [] # type: List[UncertainReference]
-        for block in self._program_data.blocks:
-            data_type = disassembly_data.get_block_data_type(block)
-            if data_type != disassembly_data.DATA_TYPE_CODE and block.references:
-                results.extend(block.references)
-        return results
-
-    def get_uncertain_code_references(self):
-        # type: () -> List[UncertainReference]
-        results = [] # type: List[UncertainReference]
-        for block in self._program_data.blocks:
-            data_type = disassembly_data.get_block_data_type(block)
-            if data_type == disassembly_data.DATA_TYPE_CODE and block.references:
-                results.extend(block.references)
-        return results
+    def get_uncertain_data_references(self, address0=None, addressN=None):
+        # type: (int, int) -> List[UncertainReference]
+        references = get_uncertain_references_in_range(self._program_data.uncertain_data_references, address0, addressN)
+        return get_uncertain_reference_rows(self._program_data, references)
+
+    def get_uncertain_code_references(self, address0=None, addressN=None):
+        # type: (int, int) -> List[UncertainReference]
+        references = get_uncertain_references_in_range(self._program_data.uncertain_code_references, address0, addressN)
+        return get_uncertain_reference_rows(self._program_data, references)
 
     def get_uncertain_references_by_address(self, address):
         # type: (int) -> List[UncertainReference]
         block, block_idx = lookup_block_by_address(self._program_data, address)
-        return block.references
+        return get_uncertain_reference_rows(self._program_data, block.references or [])
 
     ## Events.
 
@@ -2455,6 +2888,10 @@ class DisassemblyApi(object):
     def get_file_size(self):
         return self._program_data.file_size
 
+    def get_load_stats(self):
+        # type: () -> Dict[str, int]
+        return get_load_stats(self._program_data)
+
     def get_file_name(self):
         return self._program_data.file_name
 
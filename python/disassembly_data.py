@@ -4,9 +4,15 @@
     Licensed using the MIT license.
 """
 
+import array
+import bisect
+import collections
 import io
+import itertools
+import re
+import threading
 
-from typing import List, Any, Tuple
+from typing import List, Set, Any, Tuple, Dict, Iterable, Sequence
 
 ## ProgramData related.
 
@@ -89,6 +95,90 @@ def set_block_data_type(block, data_type):
     block.flags &= ~(DATA_TYPE_BITMASK << DATA_TYPE_BIT0)
     block.flags |= get_data_type_block_flags(data_type)
 
+def program_data_count_block_data_types(program_data):
+    """ Recalculate the running per-data type block and byte counts from the block list. """
+    block_counts = [ 0 ] * (DATA_TYPE_DATA32 + 1)
+    byte_counts = [ 0 ] * (DATA_TYPE_DATA32 + 1)
+    for block in program_data.blocks:
+        data_type = get_block_data_type(block)
+        block_counts[data_type] += 1
+        byte_counts[data_type] += block.length
+    program_data.data_type_block_counts = block_counts
+    program_data.data_type_byte_counts = byte_counts
+
+def program_data_update_block_data_type_counts(program_data, data_type, block_delta, byte_delta):
+    program_data.data_type_block_counts[data_type] += block_delta
+    program_data.data_type_byte_counts[data_type] += byte_delta
+
+def program_data_index_symbols(program_data):
+    """ Rebuild the symbol name indexes from the symbols. """
+    program_data.symbol_addresses_by_name = {}
+    program_data.symbol_addresses_by_folded_name = {}
+    for address, symbol_label in program_data.symbols_by_address.items():
+        program_data.symbol_addresses_by_name[symbol_label] = address
+        program_data.symbol_addresses_by_folded_name.setdefault(symbol_label.lower(), []).append(address)
+
+def program_data_set_symbol(program_data, address, symbol_label):
+    """ Set or replace the symbol for the address, keeping the symbol name indexes in step. """
+    program_data_remove_symbol(program_data, address)
+    program_data.symbols_by_address[address] = symbol_label
+    program_data.symbol_addresses_by_name[symbol_label] = address
+    program_data.symbol_addresses_by_folded_name.setdefault(symbol_label.lower(), []).append(address)
+
+def program_data_remove_symbol(program_data, address):
+    """ Remove any symbol for the address, returning its label. """
+    symbol_label = program_data.symbols_by_address.pop(address, None)
+    if symbol_label is not None:
+        del program_data.symbol_addresses_by_name[symbol_label]
+        folded_name = symbol_label.lower()
+        addresses = program_data.symbol_addresses_by_folded_name[folded_name]
+        addresses.remove(address)
+        if not addresses:
+            del program_data.symbol_addresses_by_folded_name[folded_name]
+    return symbol_label
+
+def program_data_index_uncertain_references(program_data):
+    """ Rebuild the address ordered uncertain reference indexes from the block references. """
+    program_data.uncertain_code_references = []
+    program_data.uncertain_data_references = []
+    for block in program_data.blocks:
+        if block.references:
+            _get_uncertain_reference_index(program_data, get_block_data_type(block)).extend(block.references)
+    program_data.uncertain_code_references.sort()
+    program_data.uncertain_data_references.sort()
+
+def program_data_set_block_references(program_data, block, references):
+    """ Replace the references of the block, and those within its address range in the uncertain reference indexes. """
+    address0 = block.address
+    addressN = block.address + block.length
+    for references_index in (program_data.uncertain_code_references, program_data.uncertain_data_references):
+        del references_index[bisect.bisect_left(references_index, (address0,)):bisect.bisect_left(references_index, (addressN,))]
+    block.references = references
+    if references:
+        references_index = _get_uncertain_reference_index(program_data, get_block_data_type(block))
+        idx = bisect.bisect_left(references_index, (address0,))
+        references_index[idx:idx] = references
+
+def program_data_remove_block_reference(program_data, block, referring_address, referred_address):
+    """ Remove the given reference from the block, and the uncertain reference indexes.  Returns whether it was present. """
+    key = (referring_address, referred_address)
+    if not block.references:
+        return False
+    idx = bisect.bisect_left(block.references, key)
+    if idx == len(block.references) or block.references[idx][:2] != key:
+        return False
+    del block.references[idx]
+    references_index = _get_uncertain_reference_index(program_data, get_block_data_type(block))
+    idx = bisect.bisect_left(references_index, key)
+    if idx < len(references_index) and references_index[idx][:2] == key:
+        del references_index[idx]
+    return True
+
+def _get_uncertain_reference_index(program_data, data_type):
+    if data_type == DATA_TYPE_CODE:
+        return program_data.uncertain_code_references
+    return program_data.uncertain_data_references
+
 _block_event_func = None
 
 def set_block_event_func(f):
@@ -102,6 +192,12 @@ SLD_COMMENT_TRAILING = 2
 SLD_COMMENT_FULL_LINE = 3
 SLD_EQU_LOCATION_RELATIVE = 4
 
+## SegmentBlock instruction metadata bits.
+
+IMD_LENGTH_MASK = 0x3F
+IMD_TRAILING_LINE_TRAP = 0x40
+IMD_TRAILING_LINE_BRANCH = 0x80
+
 
 PDF_BINARY_FILE = 1
 
@@ -110,11 +206,13 @@ class ProgramData(object):
     def __init__(self):
         ## Persisted state.
         # Local:
-        self.branch_addresses = {}
-        self.reference_addresses = {}
+        "{ branched to address: addresses of the branching instructions, }"
+        self.branch_addresses = CrossReferences()
+        "{ referred address: addresses of the referring instructions, }"
+        self.reference_addresses = CrossReferences()
         self.symbols_by_address = {}
-        "List of blocks ordered by ascending address."
-        self.blocks = []
+        "Blocks ordered by ascending address."
+        self.blocks = BlockList()
         "Extra lines for the last block in a segment, for trailing labels."
         self.post_segment_addresses = None # {}
         "Default flags"
@@ -135,7 +233,7 @@ class ProgramData(object):
         self.loader_system_name = None
         self.loader_segments = []
         "{ relocated_address_n: [ address_of_reference_1, ... ], }"
-        self.loader_relocated_addresses = None # dict()
+        self.loader_relocated_addresses = None # CrossReferences()
         self.loader_relocatable_addresses = None # dict()
         self.loader_entrypoint_segment_id = None
         self.loader_entrypoint_offset = None
@@ -148,12 +246,8 @@ class ProgramData(object):
         # Local:
         "State the program data is in."
         self.state = STATE_LOADING
-        "List of ascending block addresses (used by bisect for address based lookups)."
-        self.block_addresses = None # type: List[int]
-        "List of ascending block first line numbers (used by bisect for line number based lookups)."
-        self.block_line0s = None # type: List[int]
-        "If list of first line numbers need recalculating, this is the entry to start at."
-        self.block_line0s_dirtyidx = 0
+        "Addresses of blocks with line counts that need updating in the block list."
+        self.block_line_count_dirty_addresses = None # type: Set[int]
         "Callback application can register to be notified."
         self.symbol_insert_func = None
         "Callback application can register to be notified."
@@ -164,14 +258,34 @@ class ProgramData(object):
         self.pre_line_change_func = None
         "Callback application can register to be notified."
         self.post_line_change_func = None
-        "List of segment address ranges, used to validate addresses."
+        "List of segment address ranges ordered by address, used to validate addresses."
         self.address_ranges = None # []
+        "The first and last addresses of each address range, for bisection."
+        self.address_range_starts = None # []
+        self.address_range_ends = None # []
         "Where the file was saved to, or loaded from."
         self.savefile_path = None
         "Newly created blocks, since this was set to non-None"
         self.new_block_events = None
         "Blocks that have had data type changes, since this was set to non-None"
         self.block_data_type_events = None
+        "Number of blocks of each data type, indexed by DATA_TYPE_*."
+        self.data_type_block_counts = [ 0 ] * (DATA_TYPE_DATA32 + 1)
+        "Number of bytes in blocks of each data type, indexed by DATA_TYPE_*."
+        self.data_type_byte_counts = [ 0 ] * (DATA_TYPE_DATA32 + 1)
+        "Recently rendered file lines."
+        self.file_line_cache = FileLineCache()
+        "Text of the file lines, for searching."
+        self.search_index = SearchIndex()
+        "Code blocks with recently used instruction entries materialised in their line data."
+        self.instruction_cache = InstructionCache()
+        "Symbol addresses by label.  Labels are unique."
+        self.symbol_addresses_by_name = {} # type: Dict[str, int]
+        "Symbol addresses by lower case label, in order of creation."
+        self.symbol_addresses_by_folded_name = {} # type: Dict[str, List[int]]
+        "Uncertain references of code and data blocks, as (referring address, referred address, flags) in address order."
+        self.uncertain_code_references = [] # type: List[Tuple[int, int, int]]
+        self.uncertain_data_references = [] # type: List[Tuple[int, int, int]]
 
         # disassemblylib:
         self.dis_is_final_instruction_func = None
@@ -181,6 +295,7 @@ class ProgramData(object):
         self.dis_get_operand_values_func = None
         self.dis_get_operand_value_func = None
         self.dis_disassemble_one_line_func = None
+        self.dis_disassemble_range_func = None
         self.dis_disassemble_as_data_func = None
         self.dis_constant_pc_offset = None
         self.dis_get_default_symbol_name_func = None
@@ -208,13 +323,17 @@ class SegmentBlock(object):
     length = None # type: int
     """ The data type of this block (DATA_TYPE_*) and more """
     flags = 0
-    """ DATA_TYPE_CODE: [ line0_match, ... lineN_match ].
+    """ DATA_TYPE_CODE: LineData of ( SLD_*, entry ).
         DATA_TYPE_ASCII: [ (offset, length), ... ]. """
-    line_data = None # type: List[Any]
+    line_data = None # type: Any
     """ Calculated number of lines. """
     line_count = 0
     """ Cached potential address references. """
-    references = None # type: List[Tuple[int, int, str]]
+    references = None # type: List[Tuple[int, int, int]]
+    """ DATA_TYPE_CODE: Calculated index of the lines and bytes of line_data entries. """
+    line_index = None # type: BlockLineIndex
+    """ DATA_TYPE_CODE: The length and IMD_* flags of each instruction in line_data, in order, as decoded. """
+    instruction_metadata = None # type: bytearray
 
     def __init__(self, copy_block=None):
         if copy_block is not None:
@@ -237,6 +356,702 @@ class SegmentBlock(object):
         new_block.line_data = self.line_data
         new_block.line_count = self.line_count
         new_block.references = self.references
+        new_block.line_index = self.line_index
+        new_block.instruction_metadata = self.instruction_metadata
+
+
+class LineData(object):
+    """
+    The line data of a code block, stored by column.  Each entry has a SLD_* type id and a block
+    offset, which is meaningful for instructions and relative locations.  Comment text, and the
+    instructions which have been disassembled, are held in a side table by entry index.
+
+    Entries are read as ( type_id, entry ) tuples, where the entry is the instruction if it has
+    been disassembled, the comment text, or otherwise the block offset.
+
+    The offsets are stored relative to the start of the block they were created for.  Blocks
+    that are split off later only record where they start within it, in `base_offset`.
+    """
+    __slots__ = ("type_ids", "offsets", "base_offset", "entries")
+
+    def __init__(self, type_ids=None, offsets=None, base_offset=0, entries=None):
+        self.type_ids = array.array("B") if type_ids is None else type_ids
+        self.offsets = array.array("I") if offsets is None else offsets
+        self.base_offset = base_offset
+        self.entries = {} if entries is None else entries # type: Dict[int, Any]
+
+    def __len__(self):
+        return len(self.type_ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx0, idxN, step = idx.indices(len(self.type_ids))
+            if step != 1:
+                raise ValueError("line data slices must be contiguous")
+            entries = { k - idx0: v for (k, v) in self.entries.items() if k >= idx0 and k < idxN }
+            return LineData(self.type_ids[idx0:idxN], self.offsets[idx0:idxN], self.base_offset, entries)
+        if idx < 0:
+            idx += len(self.type_ids)
+        entry = self.entries.get(idx, None)
+        if entry is None:
+            entry = self.offsets[idx] - self.base_offset
+        return self.type_ids[idx], entry
+
+    def __iter__(self):
+        entries = self.entries
+        base_offset = self.base_offset
+        for idx, (type_id, offset) in enumerate(zip(self.type_ids, self.offsets)):
+            entry = entries.get(idx, None)
+            yield type_id, (offset - base_offset if entry is None else entry)
+
+    def append(self, type_id, value):
+        """ Add an entry, with a block offset for instructions and relative locations, or otherwise the comment text. """
+        if isinstance(value, int):
+            self.offsets.append(value + self.base_offset)
+        else:
+            self.entries[len(self.type_ids)] = value
+            self.offsets.append(self.base_offset)
+        self.type_ids.append(type_id)
+
+    def append_instruction(self, block_offset, match):
+        self.entries[len(self.type_ids)] = match
+        self.offsets.append(block_offset + self.base_offset)
+        self.type_ids.append(SLD_INSTRUCTION)
+
+    def insert(self, idx, type_id, value):
+        if self.entries:
+            self.entries = { (k + 1 if k >= idx else k): v for (k, v) in self.entries.items() }
+        if isinstance(value, int):
+            self.offsets.insert(idx, value + self.base_offset)
+        else:
+            self.entries[idx] = value
+            self.offsets.insert(idx, self.base_offset)
+        self.type_ids.insert(idx, type_id)
+
+    def rebase(self, block_offset):
+        """ Make the block offsets relative to a later point in the block, where it has been split. """
+        self.base_offset += block_offset
+
+    def get_block_offset(self, idx):
+        return self.offsets[idx] - self.base_offset
+
+    def get_block_offsets(self):
+        # type: () -> array.array
+        """ The block offset of each entry, where comments have none and get zero. """
+        if self.base_offset == 0:
+            return self.offsets
+        base_offset = self.base_offset
+        return array.array("I", [ max(0, offset - base_offset) for offset in self.offsets ])
+
+    def get_instruction(self, idx):
+        """ The instruction entry if it has been disassembled, otherwise None. """
+        return self.entries.get(idx, None)
+
+    def set_instruction(self, idx, match):
+        self.entries[idx] = match
+
+    def get_instruction_count(self):
+        """ The number of instruction entries which have been disassembled. """
+        type_ids = self.type_ids
+        return sum(1 for idx in self.entries if type_ids[idx] == SLD_INSTRUCTION)
+
+    def demote_instructions(self):
+        """ Discard the instruction entries which have been disassembled, leaving only their block offsets. """
+        type_ids = self.type_ids
+        self.entries = { k: v for (k, v) in self.entries.items() if type_ids[k] != SLD_INSTRUCTION }
+
+
+class BlockLineIndex(object):
+    """
+    The positions of the entries in a code block's line data which occupy lines, for bisecting
+    by line or by byte offset.  Trailing comments do not occupy lines, and are not included.
+    """
+
+    def __init__(self):
+        "Index of the entry in the block line data."
+        self.entry_indexes = array.array("I")
+        "The first line of the entry, relative to the first line after any block header."
+        self.line_offsets = array.array("I")
+        "The number of instruction bytes in the block preceding the entry."
+        self.byte_offsets = array.array("I")
+        "The number of lines the entries occupy."
+        self.line_count = 0
+
+
+class FileLineCache(object):
+    """
+    A bounded least recently used cache of rendered file lines, keyed by line number.  Each
+    row holds the text of all the columns of the line.  It is only accessed with the
+    line_cache_lock held.
+    """
+
+    """ How many rendered lines are retained. """
+    MAX_ROWS = 4096
+
+    def __init__(self, max_rows=None):
+        self.max_rows = self.MAX_ROWS if max_rows is None else max_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._rows = collections.OrderedDict() # type: collections.OrderedDict
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, line_idx):
+        row = self._rows.get(line_idx, None)
+        if row is None:
+            self.misses += 1
+        else:
+            self._rows.move_to_end(line_idx)
+            self.hits += 1
+        return row
+
+    def insert(self, line_idx, row):
+        self._rows[line_idx] = row
+        while len(self._rows) > self.max_rows:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate_lines(self, line0, line_count=None):
+        """ Discard the rows for the given lines, or all lines from `line0` on if no count is given. """
+        if line_count is None:
+            line_idxs = [ line_idx for line_idx in self._rows if line_idx >= line0 ]
+        elif line_count < len(self._rows):
+            line_idxs = [ line_idx for line_idx in range(line0, line0 + line_count) if line_idx in self._rows ]
+        else:
+            line_idxs = [ line_idx for line_idx in self._rows if line_idx >= line0 and line_idx < line0 + line_count ]
+        for line_idx in line_idxs:
+            del self._rows[line_idx]
+        self.invalidations += len(line_idxs)
+
+    def clear(self):
+        self.invalidations += len(self._rows)
+        self._rows.clear()
+
+    def get_stats(self):
+        # type: () -> Dict[str, Any]
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._rows),
+            "max_rows": self.max_rows,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / float(lookups) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class SearchIndex(object):
+    """
+    The lower cased search text of each file line, so that text searches need not render the
+    lines.  Lines which have not been rendered since they last changed have no text, and are
+    filled in by searches as they reach them or ahead of time by a background thread.  It is
+    only accessed with the line_cache_lock held, or the line_count_lock held for writing.
+
+    Symbol changes do not move lines, but change the text of the lines which show the symbol
+    or the address it replaces.  Rather than search for them on every change, the texts are
+    gathered and the lines which contain any of them are discarded on next use.
+    """
+
+    """ Symbol changes past this many texts, before next use, discard the text of all lines. """
+    MAX_PENDING_TEXTS = 64
+
+    def __init__(self):
+        self.lines = [] # type: List[str]
+        self._pending_texts = set() # type: Set[str]
+
+    def __len__(self):
+        return len(self.lines)
+
+    def resize(self, line_count):
+        """ Match the number of file lines, with any added lines having no text. """
+        lines = self.lines
+        if len(lines) < line_count:
+            lines.extend([ None ] * (line_count - len(lines)))
+        elif len(lines) > line_count:
+            del lines[line_count:]
+
+    def invalidate_lines(self, line0, line_count=None):
+        """ Discard the text for the given lines, or all lines from `line0` on if no count is given. """
+        if line_count is None:
+            del self.lines[line0:]
+        else:
+            self.replace_lines(line0, line_count, line_count)
+
+    def replace_lines(self, line0, old_line_count, new_line_count):
+        """ Replace the given lines with a number of lines with no text, moving any following lines. """
+        if line0 < len(self.lines):
+            self.lines[line0:line0 + old_line_count] = [ None ] * new_line_count
+
+    def invalidate_text(self, text):
+        """ Discard the text of the lines which contain the given text, on next use. """
+        if not self.lines:
+            return
+        self._pending_texts.add(text.lower())
+        if len(self._pending_texts) > self.MAX_PENDING_TEXTS:
+            self.lines[:] = [ None ] * len(self.lines)
+            self._pending_texts.clear()
+
+    def apply_pending_texts(self):
+        if not self._pending_texts:
+            return
+        match = re.compile("|".join(re.escape(text) for text in self._pending_texts)).search
+        lines = self.lines
+        for line_idx, text in enumerate(lines):
+            if text is not None and match(text):
+                lines[line_idx] = None
+        self._pending_texts.clear()
+
+    def get_stale_line(self, line0=0, lineN=None):
+        """ The first line from `line0` on, and before any `lineN`, which has no text, or None if there is none. """
+        try:
+            return self.lines.index(None, line0, len(self.lines) if lineN is None else lineN)
+        except ValueError:
+            return None
+
+
+class InstructionCache(object):
+    """
+    A bounded least recently used record of the code blocks which have materialised instruction
+    entries in their line data, and how many each has.  When more instructions are materialised
+    than the budget allows, the least recently used blocks are returned to have their entries
+    demoted back to block offsets.  Export workers render concurrently, so access is locked.
+    """
+
+    """ How many materialised instructions are retained. """
+    MAX_INSTRUCTIONS = 262144
+
+    def __init__(self, max_instructions=None):
+        self.max_instructions = self.MAX_INSTRUCTIONS if max_instructions is None else max_instructions
+        self.instruction_count = 0
+        self.materialisations = 0
+        self.demotions = 0
+        self._blocks = collections.OrderedDict() # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.instruction_count
+
+    def touch(self, block):
+        with self._lock:
+            if block in self._blocks:
+                self._blocks.move_to_end(block)
+
+    def insert(self, block, count):
+        """ Record the materialisation of more instructions in the block, returning the blocks to demote. """
+        with self._lock:
+            self.materialisations += count
+            self._blocks[block] = self._blocks.get(block, 0) + count
+            self._blocks.move_to_end(block)
+            self.instruction_count += count
+            return self._evict()
+
+    def set_count(self, block, count):
+        """ Replace the number of instructions materialised in the block, after its line data was divided or replaced. """
+        with self._lock:
+            self.instruction_count += count - self._blocks.pop(block, 0)
+            if count:
+                self._blocks[block] = count
+
+    def set_max_instructions(self, max_instructions):
+        """ Change the budget, returning the blocks to demote. """
+        with self._lock:
+            self.max_instructions = max_instructions
+            return self._evict()
+
+    def _evict(self):
+        # The most recently used block is kept, even if it alone exceeds the budget.
+        demoted_blocks = []
+        while self.instruction_count > self.max_instructions and len(self._blocks) > 1:
+            block, count = self._blocks.popitem(last=False)
+            self.instruction_count -= count
+            self.demotions += count
+            demoted_blocks.append(block)
+        return demoted_blocks
+
+    def get_stats(self):
+        # type: () -> Dict[str, Any]
+        return {
+            "instructions": self.instruction_count,
+            "blocks": len(self._blocks),
+            "max_instructions": self.max_instructions,
+            "materialisations": self.materialisations,
+            "demotions": self.demotions,
+        }
+
+
+def _make_binary_indexed_tree(values):
+    tree = [ 0 ] + values
+    for i in range(1, len(tree)):
+        j = i + (i & -i)
+        if j < len(tree):
+            tree[j] += tree[i]
+    return tree
+
+def _binary_indexed_tree_add(tree, idx, delta):
+    i = idx + 1
+    while i < len(tree):
+        tree[i] += delta
+        i += i & -i
+
+def _binary_indexed_tree_sum(tree, idx):
+    """ The sum of the values preceding the given index. """
+    total = 0
+    i = idx
+    while i > 0:
+        total += tree[i]
+        i -= i & -i
+    return total
+
+def _binary_indexed_tree_bisect(tree, value):
+    """ The highest index where the preceding values sum to no more than the given value, and the remainder. """
+    idx = 0
+    step = 1
+    while step * 2 < len(tree):
+        step *= 2
+    while step:
+        if idx + step < len(tree) and tree[idx + step] <= value:
+            idx += step
+            value -= tree[idx]
+        step >>= 1
+    return idx, value
+
+
+class BlockList(object):
+    """
+    The blocks ordered by ascending address, along with the line count of each.
+
+    The blocks are held in chunks, along with the index of the first block in each chunk
+    and a binary indexed tree over the total line count of each chunk.  Changing the line
+    count of a block, indexing and lookups by address or line number are O(log n) along
+    with at most a chunk sized operation done by a builtin.  Inserting a block is a chunk
+    sized insertion done by a builtin, and an update of the following chunk first indexes.
+    """
+
+    "Chunks are split in half when they grow past this size."
+    MAX_CHUNK_SIZE = 1024
+
+    def __init__(self, blocks=None):
+        # type: (List[SegmentBlock]) -> None
+        blocks = [] if blocks is None else list(blocks)
+        chunk_size = self.MAX_CHUNK_SIZE // 2
+        self._chunks = [ blocks[i:i+chunk_size] for i in range(0, len(blocks), chunk_size) ] or [ [] ] # type: List[List[SegmentBlock]]
+        "The addresses of the blocks in each chunk (used by bisect for address based lookups)."
+        self._chunk_addresses = [ [ block.address for block in chunk ] for chunk in self._chunks ] # type: List[List[int]]
+        "The line counts of the blocks in each chunk."
+        self._chunk_line_counts = [ [ 0 ] * len(chunk) for chunk in self._chunks ] # type: List[List[int]]
+        self._length = len(blocks)
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._first_addresses = [ addresses[0] if addresses else 0 for addresses in self._chunk_addresses ]
+        self._first_indexes = [ 0 ] + list(itertools.accumulate(len(chunk) for chunk in self._chunks[:-1]))
+        self._line_count_tree = _make_binary_indexed_tree([ sum(line_counts) for line_counts in self._chunk_line_counts ])
+
+    def _locate(self, idx):
+        if idx < 0:
+            idx += self._length
+        if idx < 0 or idx > self._length:
+            raise IndexError("block index out of range")
+        chunk_idx = bisect.bisect_right(self._first_indexes, idx) - 1
+        return chunk_idx, idx - self._first_indexes[chunk_idx]
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._chunks)
+
+    def __getitem__(self, idx):
+        chunk_idx, offset = self._locate(idx)
+        return self._chunks[chunk_idx][offset]
+
+    def insert(self, idx, block):
+        # type: (int, SegmentBlock) -> None
+        chunk_idx, offset = self._locate(idx)
+        chunk = self._chunks[chunk_idx]
+        chunk.insert(offset, block)
+        self._chunk_addresses[chunk_idx].insert(offset, block.address)
+        self._chunk_line_counts[chunk_idx].insert(offset, 0)
+        self._length += 1
+        if len(chunk) > self.MAX_CHUNK_SIZE:
+            split_offset = len(chunk) // 2
+            for chunks in (self._chunks, self._chunk_addresses, self._chunk_line_counts):
+                chunks.insert(chunk_idx + 1, chunks[chunk_idx][split_offset:])
+                del chunks[chunk_idx][split_offset:]
+            self._rebuild_index()
+        else:
+            first_indexes = self._first_indexes
+            for i in range(chunk_idx + 1, len(first_indexes)):
+                first_indexes[i] += 1
+            if offset == 0:
+                self._first_addresses[chunk_idx] = block.address
+
+    def append(self, block):
+        # type: (SegmentBlock) -> None
+        self.insert(self._length, block)
+
+    def bisect_address(self, address):
+        """ Equivalent to bisect.bisect_right() on the list of block addresses. """
+        chunk_idx = bisect.bisect_right(self._first_addresses, address) - 1
+        if chunk_idx < 0:
+            return 0
+        offset = bisect.bisect_right(self._chunk_addresses[chunk_idx], address)
+        return self._first_indexes[chunk_idx] + offset
+
+    def lookup_address(self, address):
+        # type: (int) -> Tuple[SegmentBlock, int]
+        """ The block the address lies within and its index, with the same result for preceding addresses as indexing by -1. """
+        chunk_idx = bisect.bisect_right(self._first_addresses, address) - 1
+        if chunk_idx < 0:
+            return self._chunks[-1][-1], -1
+        offset = bisect.bisect_right(self._chunk_addresses[chunk_idx], address) - 1
+        return self._chunks[chunk_idx][offset], self._first_indexes[chunk_idx] + offset
+
+    def get_line_count(self, idx):
+        chunk_idx, offset = self._locate(idx)
+        return self._chunk_line_counts[chunk_idx][offset]
+
+    def set_line_count(self, idx, line_count):
+        chunk_idx, offset = self._locate(idx)
+        line_counts = self._chunk_line_counts[chunk_idx]
+        delta = line_count - line_counts[offset]
+        if delta != 0:
+            line_counts[offset] = line_count
+            _binary_indexed_tree_add(self._line_count_tree, chunk_idx, delta)
+
+    def get_line_number(self, idx):
+        """ The total line count of the blocks preceding the given block index. """
+        chunk_idx, offset = self._locate(idx)
+        return _binary_indexed_tree_sum(self._line_count_tree, chunk_idx) + sum(self._chunk_line_counts[chunk_idx][:offset])
+
+    def bisect_line_number(self, line_number):
+        """ Equivalent to bisect.bisect_right() on the list of first line numbers for each block. """
+        if line_number < 0:
+            return 0
+        chunk_idx, line_number = _binary_indexed_tree_bisect(self._line_count_tree, line_number)
+        if chunk_idx == len(self._chunks):
+            return self._length
+        # The line lies within this chunk, find how many of its blocks precede it.
+        offset = bisect.bisect_right(list(itertools.accumulate(self._chunk_line_counts[chunk_idx])), line_number)
+        return min(self._first_indexes[chunk_idx] + offset + 1, self._length)
+
+    def lookup_line_number(self, line_number):
+        # type: (int) -> Tuple[SegmentBlock, int]
+        """ The block the line lies within and its index, with the same result for preceding lines as indexing by -1. """
+        block_idx = self.bisect_line_number(line_number) - 1
+        return self[block_idx], block_idx
+
+
+class CrossReferences(object):
+    """
+    A mapping of addresses to the addresses associated with them, such as a referred address to
+    the addresses which refer to it.  Keys may have no values.  It is read like a dictionary of sets, but stored in a
+    compressed sparse row layout: the sorted distinct keys, the start of each key's row in the
+    values and the values, sorted within each row.  A dictionary of the row of each key is built
+    for lookups.  A reverse index in the same layout is built when the keys for a value, or for a
+    range of values, are first looked up, and is then kept up to date with each change.
+
+    Additions are held in a pending mapping which lookups also consult, and merged into the rows
+    in bulk once there are enough of them, or when the rows are needed as a whole.  Removals are
+    made in bulk, directly to the rows.
+    """
+
+    "Pending additions are merged into the rows when they exceed this, or an eighth of the values."
+    MIN_PENDING_VALUES = 1024
+
+    def __init__(self, mapping=None):
+        # type: (Dict[int, Set[int]]) -> None
+        self.row_keys = array.array("I")
+        self.row_starts = array.array("I", [ 0 ])
+        self.row_values = array.array("I")
+        self._pending = {} # type: Dict[int, Set[int]]
+        self._pending_count = 0
+        self._reverse = None # type: CrossReferences
+        self._row_indexes = None # type: Dict[int, int]
+        if mapping:
+            self.update(mapping)
+
+    def _get_row_indexes(self):
+        # Bisecting the keys is several times slower than a dictionary lookup, which matters for
+        # the lookups made for every rendered operand.
+        if self._row_indexes is None:
+            self._row_indexes = { key: idx for (idx, key) in enumerate(self.row_keys) }
+        return self._row_indexes
+
+    def _get_row(self, key):
+        idx = self._get_row_indexes().get(key, None)
+        if idx is not None:
+            return self.row_values[self.row_starts[idx]:self.row_starts[idx+1]]
+
+    def add(self, key, value):
+        # type: (int, int) -> None
+        row = self._get_row(key)
+        if row is not None and value in row:
+            return
+        values = self._pending.setdefault(key, set())
+        if value not in values:
+            values.add(value)
+            self._pending_count += 1
+            if self._reverse is not None:
+                self._reverse.add(value, key)
+            if self._pending_count > max(self.MIN_PENDING_VALUES, len(self.row_values) >> 3):
+                self.compact()
+
+    def update(self, mapping):
+        # type: (Dict[int, Set[int]]) -> None
+        """ Add the values of each key in a dictionary of sets, in bulk. """
+        for key, values in mapping.items():
+            row = self._get_row(key)
+            pending_values = self._pending.setdefault(key, set())
+            pending_count = len(pending_values)
+            pending_values.update(values if row is None else (value for value in values if value not in row))
+            self._pending_count += len(pending_values) - pending_count
+        if self._reverse is not None:
+            reverse_mapping = {} # type: Dict[int, Set[int]]
+            for key, values in mapping.items():
+                for value in values:
+                    reverse_mapping.setdefault(value, set()).add(key)
+            self._reverse.update(reverse_mapping)
+        self.compact()
+
+    def remove_items(self, items):
+        # type: (Iterable[Tuple[int, int]]) -> None
+        """ Remove the given ( key, value ) pairs, in bulk.  Keys left with no values are removed. """
+        self.compact()
+        removed_values = {} # type: Dict[int, Set[int]]
+        for key, value in items:
+            removed_values.setdefault(key, set()).add(value)
+        rows = {} # type: Dict[int, List[int]]
+        removed_items = []
+        for key, values in removed_values.items():
+            row = self._get_row(key)
+            if row is None or values.isdisjoint(row):
+                continue
+            # Keys may be added with no values, but are not left with none.
+            rows[key] = [ value for value in row if value not in values ] or None
+            removed_items.extend((value, key) for value in row if value in values)
+        if removed_items:
+            self._replace_rows(rows)
+            if self._reverse is not None:
+                self._reverse.remove_items(removed_items)
+
+    def compact(self):
+        """ Merge the pending additions into the rows. """
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = {}
+        self._pending_count = 0
+        rows = {} # type: Dict[int, List[int]]
+        for key, values in pending.items():
+            row = self._get_row(key)
+            if row is not None:
+                values.update(row)
+            rows[key] = sorted(values)
+        self._replace_rows(rows)
+
+    def _replace_rows(self, rows):
+        # type: (Dict[int, List[int]]) -> None
+        """ Replace the rows of the given keys with the given sorted values, or remove them where None. """
+        row_keys, row_starts, row_values = self.row_keys, self.row_starts, self.row_values
+        new_row_keys = array.array("I")
+        new_row_starts = array.array("I", [ 0 ])
+        new_row_values = array.array("I")
+
+        def copy_rows(idx0, idxN):
+            if idxN > idx0:
+                value_delta = len(new_row_values) - row_starts[idx0]
+                new_row_keys.extend(row_keys[idx0:idxN])
+                new_row_values.extend(row_values[row_starts[idx0]:row_starts[idxN]])
+                new_row_starts.extend(row_start + value_delta for row_start in row_starts[idx0+1:idxN+1])
+
+        idx = 0
+        for key in sorted(rows):
+            values = rows[key]
+            key_idx = bisect.bisect_left(row_keys, key, idx)
+            copy_rows(idx, key_idx)
+            if key_idx < len(row_keys) and row_keys[key_idx] == key:
+                key_idx += 1
+            if values is not None:
+                new_row_keys.append(key)
+                new_row_values.extend(values)
+                new_row_starts.append(len(new_row_values))
+            idx = key_idx
+        copy_rows(idx, len(row_keys))
+
+        self.row_keys, self.row_starts, self.row_values = new_row_keys, new_row_starts, new_row_values
+        self._row_indexes = None
+
+    def __len__(self):
+        self.compact()
+        return len(self.row_keys)
+
+    def __iter__(self):
+        self.compact()
+        return iter(self.row_keys)
+
+    def __contains__(self, key):
+        return key in self._get_row_indexes() or key in self._pending
+
+    def __getitem__(self, key):
+        values = self.get(key)
+        if values is None:
+            raise KeyError(key)
+        return values
+
+    def get(self, key, default=None):
+        # type: (int, Any) -> Sequence[int]
+        """ The sorted values of the key. """
+        row = self._get_row(key)
+        if self._pending and key in self._pending:
+            return sorted(self._pending[key].union(row or ()))
+        return default if row is None else row
+
+    def items(self):
+        self.compact()
+        row_starts, row_values = self.row_starts, self.row_values
+        for idx, key in enumerate(self.row_keys):
+            yield key, row_values[row_starts[idx]:row_starts[idx+1]]
+
+    def get_items_in_range(self, key0, keyN):
+        # type: (int, int) -> List[Tuple[int, int]]
+        """ The ( key, value ) pairs of the keys within the range, in key order. """
+        self.compact()
+        row_keys, row_starts, row_values = self.row_keys, self.row_starts, self.row_values
+        idx0 = bisect.bisect_left(row_keys, key0)
+        idxN = bisect.bisect_left(row_keys, keyN, idx0)
+        items = []
+        for idx in range(idx0, idxN):
+            key = row_keys[idx]
+            items.extend((key, value) for value in row_values[row_starts[idx]:row_starts[idx+1]])
+        return items
+
+    def get_reverse(self):
+        # type: () -> CrossReferences
+        """ The mapping of each value to the keys it is associated with. """
+        if self._reverse is None:
+            self.compact()
+            row_keys, row_starts, row_values = self.row_keys, self.row_starts, self.row_values
+            reverse_mapping = {} # type: Dict[int, Set[int]]
+            for idx, key in enumerate(row_keys):
+                for value in row_values[row_starts[idx]:row_starts[idx+1]]:
+                    reverse_mapping.setdefault(value, set()).add(key)
+            self._reverse = CrossReferences(reverse_mapping)
+        return self._reverse
+
+    def get_keys(self, value):
+        # type: (int) -> Sequence[int]
+        """ The sorted keys the value is associated with. """
+        return self.get_reverse().get(value, ())
+
+    def get_reverse_items_in_range(self, value0, valueN):
+        # type: (int, int) -> List[Tuple[int, int]]
+        """ The ( value, key ) pairs of the values within the range, in value order. """
+        return self.get_reverse().get_items_in_range(value0, valueN)
 
 
 class NewProjectOptions:
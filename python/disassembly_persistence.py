@@ -4,10 +4,12 @@
     Licensed using the MIT license.
 """
 
+import array
 import io
 import logging
 import os
 import struct
+import sys
 import time
 
 from disassembly_data import *
@@ -32,54 +34,83 @@ def write_SegmentBlock(f, block, pc_offset):
 
     if line_data_count > 0:
         if get_block_data_type(block) == DATA_TYPE_CODE:
-            block_offset = 0
-            for i, (type_id, entry) in enumerate(block.line_data):
-                persistence.write_uint8(f, type_id)
-                if type_id == SLD_INSTRUCTION:
-                    if type(entry) is int:
-                        persistence.write_uint16(f, entry)
-                        # The length of this instruction is not stored, so we calculate it relative to the next one.
-                        j = i+1
-                        while j < len(block.line_data):
-                            next_type_id, next_entry = block.line_data[j]
-                            if next_type_id == SLD_INSTRUCTION:
-                                if type(next_entry) is int:
-                                    block_offset = next_entry
-                                else:
-                                    block_offset = next_entry.pc - pc_offset
-                                break
-                            j += 1
-                    else:
-                        persistence.write_uint16(f, block_offset)
-                        block_offset += entry.num_bytes
-                elif type_id == SLD_EQU_LOCATION_RELATIVE:
-                    persistence.write_uint32(f, entry) # block offset
-                elif type_id in (SLD_COMMENT_TRAILING, SLD_COMMENT_FULL_LINE):
-                    persistence.write_string(f, entry) # string
-                else:
-                    logger.error("Trying to save a savefile, did not know how to handle entry of type_id: %d, entry value: %s", type_id, entry)
-
-def read_SegmentBlock(f):
+            # Disassembly hunk version 4: the line data columns as raw buffers, followed by the comments.
+            line_data = block.line_data
+            f.write(line_data.type_ids.tobytes())
+            write_uint32_array(f, line_data.get_block_offsets())
+            comments = [ (idx, entry) for (idx, entry) in sorted(line_data.entries.items()) if line_data.type_ids[idx] in (SLD_COMMENT_TRAILING, SLD_COMMENT_FULL_LINE) ]
+            persistence.write_uint32(f, len(comments))
+            for idx, text in comments:
+                persistence.write_uint32(f, idx)
+                persistence.write_string(f, text)
+            # Disassembly hunk version 3: the instruction metadata, if it has been obtained.
+            instruction_metadata = block.instruction_metadata or b""
+            persistence.write_uint32(f, len(instruction_metadata))
+            persistence.write_bytes(f, instruction_metadata, len(instruction_metadata))
+
+def read_SegmentBlock(f, hunk_version):
     block = SegmentBlock()
     bytes_to_read = struct.calcsize(SEGMENTBLOCK_PACK_FORMAT)
     block.segment_id, block.segment_offset, block.address, block.length, block.flags, block.line_count, line_data_count = struct.unpack(SEGMENTBLOCK_PACK_FORMAT, f.read(bytes_to_read))
 
     if line_data_count > 0:
         if get_block_data_type(block) == DATA_TYPE_CODE:
-            block.line_data = [ None ] * line_data_count
-            for i in range(line_data_count):
-                type_id = persistence.read_uint8(f)
-                if type_id == SLD_INSTRUCTION:
-                    block_offset = persistence.read_uint16(f)
-                    block.line_data[i] = (type_id, block_offset)
-                elif type_id == SLD_EQU_LOCATION_RELATIVE:
-                    block_offset = persistence.read_uint32(f)
-                    block.line_data[i] = (type_id, block_offset)
-                elif type_id in (SLD_COMMENT_TRAILING, SLD_COMMENT_FULL_LINE):
-                    text = persistence.read_string(f)
-                    block.line_data[i] = (type_id, text)
+            if hunk_version >= 4:
+                type_ids = array.array("B")
+                type_ids.frombytes(f.read(line_data_count))
+                entries = {}
+                block.line_data = LineData(type_ids, read_uint32_array(f, line_data_count), 0, entries)
+                for i in range(persistence.read_uint32(f)):
+                    idx = persistence.read_uint32(f)
+                    entries[idx] = persistence.read_string(f)
+            else:
+                block.line_data = LineData()
+                for i in range(line_data_count):
+                    type_id = persistence.read_uint8(f)
+                    if type_id == SLD_INSTRUCTION:
+                        block.line_data.append(type_id, persistence.read_uint16(f))
+                    elif type_id == SLD_EQU_LOCATION_RELATIVE:
+                        block.line_data.append(type_id, persistence.read_uint32(f))
+                    elif type_id in (SLD_COMMENT_TRAILING, SLD_COMMENT_FULL_LINE):
+                        block.line_data.append(type_id, persistence.read_string(f))
+            if hunk_version >= 3:
+                num_bytes = persistence.read_uint32(f)
+                if num_bytes:
+                    block.instruction_metadata = bytearray(persistence.read_bytes(f, num_bytes))
     return block
 
+def read_uint32_array(f, count):
+    # type: (io.IOBase, int) -> array.array
+    v = array.array("I")
+    v.frombytes(f.read(count * v.itemsize))
+    if sys.byteorder != "little":
+        v.byteswap()
+    return v
+
+def write_uint32_array(f, v):
+    # type: (io.IOBase, array.array) -> None
+    if sys.byteorder != "little":
+        v = array.array(v.typecode, v)
+        v.byteswap()
+    f.write(v.tobytes())
+
+def read_CrossReferences(f):
+    # type: (io.IOBase) -> CrossReferences
+    cross_references = CrossReferences()
+    key_count = persistence.read_uint32(f)
+    cross_references.row_keys = read_uint32_array(f, key_count)
+    cross_references.row_starts = read_uint32_array(f, key_count + 1)
+    cross_references.row_values = read_uint32_array(f, cross_references.row_starts[-1])
+    return cross_references
+
+def write_CrossReferences(f, cross_references):
+    # type: (io.IOBase, CrossReferences) -> None
+    cross_references.compact()
+    persistence.write_uint32(f, len(cross_references.row_keys))
+    write_uint32_array(f, cross_references.row_keys)
+    write_uint32_array(f, cross_references.row_starts)
+    write_uint32_array(f, cross_references.row_values)
+
 def read_segment_list(f):
     num_bytes = persistence.read_uint32(f)
     data_start_offset = f.tell()
@@ -134,9 +165,9 @@ SAVEFILE_HUNK_DISASSEMBLY = 2005           # General disassembly state.
 CURRENT_HUNK_VERSIONS = {
     SAVEFILE_HUNK_SOURCEDATA: 1,
     SAVEFILE_HUNK_SOURCEDATAINFO: 1,
-    SAVEFILE_HUNK_LOADER: 2,
+    SAVEFILE_HUNK_LOADER: 3,
     SAVEFILE_HUNK_LOADERINTERNAL: 1,
-    SAVEFILE_HUNK_DISASSEMBLY: 2,
+    SAVEFILE_HUNK_DISASSEMBLY: 5,
 }
 
 # 4: Save file ID.
@@ -195,8 +226,8 @@ def save_project(f, program_data, save_options):
 
 
 def save_disassembly_hunk(f, program_data):
-    persistence.write_dict_uint32_to_set_of_uint32s(f, program_data.branch_addresses)
-    persistence.write_dict_uint32_to_set_of_uint32s(f, program_data.reference_addresses)
+    write_CrossReferences(f, program_data.branch_addresses)
+    write_CrossReferences(f, program_data.reference_addresses)
     persistence.write_dict_uint32_to_string(f, program_data.symbols_by_address)
     persistence.write_dict_uint32_to_list_of_uint32s(f, program_data.post_segment_addresses)
     persistence.write_uint32(f, program_data.flags)
@@ -209,7 +240,7 @@ def save_disassembly_hunk(f, program_data):
 def save_loader_hunk(f, program_data):
     persistence.write_string(f, program_data.loader_system_name)
     write_segment_list(f, program_data.loader_segments)
-    persistence.write_dict_uint32_to_set_of_uint32s(f, program_data.loader_relocated_addresses)
+    write_CrossReferences(f, program_data.loader_relocated_addresses)
     persistence.write_set_of_uint32s(f, program_data.loader_relocatable_addresses)
     persistence.write_uint16(f, program_data.loader_entrypoint_segment_id)
     persistence.write_uint32(f, program_data.loader_entrypoint_offset)
@@ -542,9 +573,9 @@ def load_project(f, work_state=None):
         offset0 = f.tell()
         actual_hunk_version = persistence.read_uint16(f)
         if SAVEFILE_HUNK_DISASSEMBLY == hunk_id:
-            load_disassembly_hunk(f, program_data)
+            load_disassembly_hunk(f, program_data, actual_hunk_version)
         elif SAVEFILE_HUNK_LOADER == hunk_id:
-            load_loader_hunk(f, program_data)
+            load_loader_hunk(f, program_data, actual_hunk_version)
         elif SAVEFILE_HUNK_LOADERINTERNAL == hunk_id:
             load_loaderinternaldata_hunk(f, program_data)
         elif SAVEFILE_HUNK_SOURCEDATAINFO == hunk_id:
@@ -574,38 +605,47 @@ def load_project(f, work_state=None):
         if len(program_data.loader_relocatable_addresses):
             logger.info("Re-extracting relocations from embedded source file.")
             file_info, data_types = loaderlib.load_file(f, None, file_offset=sourcedata_offset, file_length=sourcedata_length)
-            loaderlib.relocate_segment_data(segments, data_types, file_info.relocations_by_segment_id, program_data.loader_relocatable_addresses, program_data.loader_relocated_addresses)
+            relocated_addresses = {}
+            loaderlib.relocate_segment_data(segments, data_types, file_info.relocations_by_segment_id, program_data.loader_relocatable_addresses, relocated_addresses)
+            program_data.loader_relocated_addresses.update(relocated_addresses)
         program_data.input_file_cached = True
 
     logger.info("Project loaded")
     return program_data
 
-def load_disassembly_hunk(f, program_data):
-    program_data.branch_addresses = persistence.read_dict_uint32_to_set_of_uint32s(f)
-    program_data.reference_addresses = persistence.read_dict_uint32_to_set_of_uint32s(f)
+def load_disassembly_hunk(f, program_data, hunk_version):
+    if hunk_version >= 5:
+        program_data.branch_addresses = read_CrossReferences(f)
+        program_data.reference_addresses = read_CrossReferences(f)
+    else:
+        program_data.branch_addresses = CrossReferences(persistence.read_dict_uint32_to_set_of_uint32s(f))
+        program_data.reference_addresses = CrossReferences(persistence.read_dict_uint32_to_set_of_uint32s(f))
     program_data.symbols_by_address = persistence.read_dict_uint32_to_string(f)
+    program_data_index_symbols(program_data)
     program_data.post_segment_addresses = persistence.read_dict_uint32_to_list_of_uint32s(f)
+    for addresses in program_data.post_segment_addresses.values():
+        addresses.sort()
     program_data.flags = persistence.read_uint32(f)
     program_data.processor_id = persistence.read_uint32(f)
 
     # Reconstitute the segment block list.
     num_blocks = persistence.read_uint32(f)
-    program_data.blocks = [ None ] * num_blocks
+    blocks = [ None ] * num_blocks
     for i in range(num_blocks):
-        program_data.blocks[i] = read_SegmentBlock(f)
+        blocks[i] = read_SegmentBlock(f, hunk_version)
+    program_data.blocks = BlockList(blocks)
 
     ## POST PROCESSING
-    # Rebuild the segment block list indexing lists.
-    program_data.block_addresses = [ 0 ] * num_blocks
-    program_data.block_line0s_dirtyidx = 0
-    program_data.block_line0s = program_data.block_addresses[:]
-    for i in range(num_blocks):
-        program_data.block_addresses[i] = program_data.blocks[i].address
+    # The line counts in the block list get calculated on demand.
+    program_data.block_line_count_dirty_addresses = set(block.address for block in blocks)
 
-def load_loader_hunk(f, program_data):
+def load_loader_hunk(f, program_data, hunk_version):
     program_data.loader_system_name = persistence.read_string(f)
     program_data.loader_segments = read_segment_list(f)
-    program_data.loader_relocated_addresses = persistence.read_dict_uint32_to_set_of_uint32s(f)
+    if hunk_version >= 3:
+        program_data.loader_relocated_addresses = read_CrossReferences(f)
+    else:
+        program_data.loader_relocated_addresses = CrossReferences(persistence.read_dict_uint32_to_set_of_uint32s(f))
     program_data.loader_relocatable_addresses = persistence.read_set_of_uint32s(f)
     program_data.loader_entrypoint_segment_id = persistence.read_uint16(f)
     program_data.loader_entrypoint_offset = persistence.read_uint32(f)
@@ -5,6 +5,7 @@
 """
 
 import threading
+import time
 import traceback
 
 
@@ -12,6 +13,9 @@ class WorkState(object):
     completeness = 0.0
     description = "[set a description]"
     cancelled = False
+    "Minimum number of seconds between throttled updates."
+    update_interval = 0.1
+    last_update_time = 0.0
 
     def get_completeness(self): return self.completeness
     def set_completeness(self, f): self.completeness = f
@@ -21,6 +25,128 @@ class WorkState(object):
     def is_cancelled(self): return self.cancelled
     def check_exit_update(self, f, s): self.set_completeness(f); self.set_description(s); return self.cancelled
 
+    def check_exit_throttled_update(self, f, s):
+        """ As check_exit_update, but only updates if enough time has passed since the last throttled update. """
+        t = time.time()
+        if t - self.last_update_time >= self.update_interval:
+            self.last_update_time = t
+            self.set_completeness(f)
+            self.set_description(s)
+        return self.cancelled
+
+
+class _ReadWriteLockMode(object):
+    """ One way of holding a readers-writer lock, for use in `with` statements. """
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release()
+
+
+class ReadWriteLock(object):
+    """
+    A lock which any number of threads can hold for reading at once, or one thread alone can
+    hold for writing.  Both are reentrant, and the thread holding it for writing can also take it
+    for reading.  A thread holding it only for reading cannot take it for writing, as two threads
+    doing so would each wait for the other to stop reading.
+
+    Threads waiting to write are let in ahead of threads which are not yet reading.  A writer
+    which holds the lock for each step of a prolonged change, rather than the whole of it, lets
+    the waiting readers in between the steps.
+
+        with lock.read: ...
+        with lock.write: ...
+
+    Readers which do not need to wait for a writer do not take the mutex, relying on each
+    dictionary operation being atomic under the global interpreter lock.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        "How many times each reading thread, other than the writer, holds the lock for reading."
+        self.read_depths = {}
+        self.writer_ident = None
+        self.writer_depth = 0
+        "How many times the writer holds the lock for reading."
+        self.writer_read_depth = 0
+        self.writers_waiting = 0
+
+        self.read = _ReadWriteLockMode(self.acquire_read, self.release_read)
+        self.write = _ReadWriteLockMode(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        ident = threading.get_ident()
+        if self.writer_ident == ident:
+            self.writer_read_depth += 1
+            return
+        # A reader registers before checking for writers, and a writer marks itself as waiting
+        # before checking for readers, so at least one of them sees the other.
+        read_depths = self.read_depths
+        read_depth = read_depths.get(ident, 0)
+        read_depths[ident] = read_depth + 1
+        if read_depth or (self.writer_ident is None and not self.writers_waiting):
+            return
+        with self.mutex:
+            del read_depths[ident]
+            self.condition.notify_all()
+            while self.writer_ident is not None or self.writers_waiting:
+                self.condition.wait()
+            read_depths[ident] = 1
+
+    def release_read(self):
+        ident = threading.get_ident()
+        if self.writer_ident == ident:
+            self.writer_read_depth -= 1
+            return
+        read_depths = self.read_depths
+        read_depth = read_depths[ident] - 1
+        if read_depth:
+            read_depths[ident] = read_depth
+            return
+        del read_depths[ident]
+        if self.writers_waiting:
+            with self.mutex:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        ident = threading.get_ident()
+        if self.writer_ident == ident:
+            self.writer_depth += 1
+            return
+        if ident in self.read_depths:
+            raise RuntimeError("lock held for reading cannot be taken for writing")
+        with self.mutex:
+            self.writers_waiting += 1
+            try:
+                while self.writer_ident is not None or self.read_depths:
+                    self.condition.wait()
+                # Only stop waiting once new readers will see the lock is held.
+                self.writer_ident = ident
+                self.writer_depth = 1
+            finally:
+                self.writers_waiting -= 1
+
+    def release_write(self):
+        ident = threading.get_ident()
+        if self.writer_ident != ident:
+            raise RuntimeError("lock not held for writing by this thread")
+        self.writer_depth -= 1
+        if self.writer_depth == 0:
+            with self.mutex:
+                self.writer_ident = None
+                # Reading begun while writing continues after it, and now counts as any other.
+                if self.writer_read_depth:
+                    self.read_depths[ident] = self.writer_read_depth
+                    self.writer_read_depth = 0
+                self.condition.notify_all()
+
 
 class WorkerThread(threading.Thread):
     def __init__(self, *args, **kwargs):
@@ -4,8 +4,16 @@
     Licensed using the MIT license.
 """
 
+import hashlib
 import logging
+import os
+import pickle
+import sys
+import threading
+from typing import Dict
+
 from . import constants
+from . import util
 
 logger = logging.getLogger("disassemblylib")
 
@@ -19,27 +27,145 @@ def get_processor_ids():
     ]
 
 def get_processor(processor_id):
+    """
+    Get the fully built architecture object for the given processor.  These are shared by
+    every caller and should be treated as read-only once built.
+    """
+    arch = _processor_registry.get(processor_id, None)
+    if arch is None:
+        with _processor_registry_lock:
+            arch = _processor_registry.get(processor_id, None)
+            if arch is None:
+                arch = _create_processor(processor_id)
+                if arch is not None:
+                    _processor_registry[processor_id] = arch
+    return arch
+
+def clear_processor_cache():
+    """ Discard the built architecture objects, so that the next use builds them anew. """
+    with _processor_registry_lock:
+        _processor_registry.clear()
+
+def clear_caches():
+    """ Discard the results cached while decoding, for any architecture. """
+    util.clear_memoize_caches()
+    util.decode_cache.clear()
+    with _processor_registry_lock:
+        for arch in _processor_registry.values():
+            arch.clear_caches()
+
+def get_cache_stats():
+    """ The statistics of each of the caches used while decoding, by name. """
+    stats = util.get_memoize_stats()
+    stats["decode_cache"] = util.decode_cache.get_stats()
+    return stats
+
+
+_processor_registry = {} # type: Dict[int, util.ArchInterface]
+_processor_registry_lock = threading.Lock()
+
+def _get_user_cache_directory():
+    """ The directory the user's cached files are kept in, following the convention of the platform. """
+    if sys.platform == "win32":
+        base_path = os.environ.get("LOCALAPPDATA", None) or os.path.expanduser(os.path.join("~", "AppData", "Local"))
+    elif sys.platform == "darwin":
+        base_path = os.path.expanduser(os.path.join("~", "Library", "Caches"))
+    else:
+        base_path = os.environ.get("XDG_CACHE_HOME", None) or os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(base_path, "peasauce")
+
+""" The directory precompiled instruction tables are cached in, or None to not cache them. """
+TABLE_CACHE_DIRECTORY = os.path.join(_get_user_cache_directory(), "tables")
+TABLE_CACHE_VERSION = 1
+
+def _create_processor(processor_id):
     import loaderlib
     if processor_id == loaderlib.constants.PROCESSOR_65c816:
+        from . import arch65c816 as arch_module
         from .arch65c816 import Arch65c816 as ArchClass
         from .arch65c816 import instruction_table
         from .arch65c816 import operand_type_table
     elif processor_id == loaderlib.constants.PROCESSOR_M680x0:
+        from . import archm68k as arch_module
         from .archm68k import ArchM68k as ArchClass
         from .archm68k import instruction_table
         from .archm68k import operand_type_table
     elif processor_id == loaderlib.constants.PROCESSOR_MIPS:
+        from . import archmips as arch_module
         from .archmips import ArchMIPS as ArchClass
         from .archmips import instruction_table
         from .archmips import operand_type_table
     elif processor_id == loaderlib.constants.PROCESSOR_Z80:
+        from . import archmips as arch_module
         from .archmips import ArchZ80 as ArchClass
         from .archmips import instruction_table
         from .archmips import operand_type_table
     else:
         logger.error("get_processor: %s unknown", processor_id)
+        return None
 
     arch = ArchClass()
     arch.set_operand_type_table(operand_type_table)
-    arch.set_instruction_table(instruction_table)
+    source_hash = _get_table_source_hash(arch_module)
+    if not _load_cached_tables(arch, source_hash):
+        arch.set_instruction_table(instruction_table)
+        _save_cached_tables(arch, source_hash)
     return arch
+
+def _get_table_source_hash(arch_module):
+    # The tables are the product of both the architecture definition and the processing of it.
+    h = hashlib.sha1()
+    h.update(str(TABLE_CACHE_VERSION).encode("ascii"))
+    for module in (arch_module, util):
+        with open(module.__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _get_table_cache_path(arch):
+    return os.path.join(TABLE_CACHE_DIRECTORY, arch.__class__.__name__ +".tables.pikl")
+
+def _load_cached_tables(arch, source_hash):
+    if TABLE_CACHE_DIRECTORY is None:
+        return False
+    file_path = _get_table_cache_path(arch)
+    if not os.path.exists(file_path):
+        return False
+    try:
+        with open(file_path, "rb") as f:
+            data = pickle.load(f)
+    except Exception:
+        logger.debug("get_processor: unable to read table cache '%s'", file_path, exc_info=True)
+        return False
+    if data.get("source_hash", None) != source_hash:
+        logger.debug("get_processor: stale table cache '%s'", file_path)
+        return False
+    arch.table_instructions = data["table_instructions"]
+    arch.table_dispatch = data["table_dispatch"]
+    arch.table_decode_plans = {}
+    return True
+
+def _save_cached_tables(arch, source_hash):
+    if TABLE_CACHE_DIRECTORY is None:
+        return
+    data = {
+        "source_hash": source_hash,
+        "table_instructions": arch.table_instructions,
+        "table_dispatch": arch.table_dispatch,
+    }
+    file_path = _get_table_cache_path(arch)
+    # Write to a temporary file and move it into place, in case other processes are loading it.
+    temp_file_path = "%s.%d.tmp" % (file_path, os.getpid())
+    try:
+        if not os.path.exists(TABLE_CACHE_DIRECTORY):
+            os.makedirs(TABLE_CACHE_DIRECTORY)
+        with open(temp_file_path, "wb") as f:
+            pickle.dump(data, f, -1)
+        os.replace(temp_file_path, file_path)
+    except (IOError, OSError):
+        # The cache is optional, so an unwritable cache directory only means the tables are processed each time.
+        logger.debug("get_processor: unable to write table cache '%s'", file_path, exc_info=True)
+        try:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+        except OSError:
+            pass
@@ -62,6 +62,7 @@ class ArchM68k(ArchInterface):
     constant_endian_types = ">"
     constant_word_size = 16
     constant_pc_offset = 2
+    constant_pc_independent_decoding = True
     constant_operand_type_general_label = "EA"
 
     """
@@ -389,6 +390,31 @@ class ArchM68k(ArchInterface):
         elif char == "L":
             return self._get_long(data, idx)
 
+    def _resolve_specific_ea_key(self, mode_bits, register_bits, operand_ea_mask):
+        """ Identify the specific EA mode, given the bits in the instruction and the EA modes allowed by the operand. """
+        cache_key = mode_bits, register_bits, operand_ea_mask
+        try:
+            return self._specific_ea_keys[cache_key]
+        except KeyError:
+            pass
+        specific_ea_key = None
+        for i, line in enumerate(self.table_operand_types):
+            if operand_ea_mask & (1 << i) and line[EAMI_MATCH_FIELDS][EAMI_MATCH_MODE] == mode_bits:
+                if line[EAMI_MATCH_FIELDS][EAMI_MATCH_REG] != "Rn" and line[EAMI_MATCH_FIELDS][EAMI_MATCH_REG] != register_bits:
+                    continue
+                specific_ea_key = line[EAMI_LABEL]
+                break
+        self._specific_ea_keys[cache_key] = specific_ea_key
+        return specific_ea_key
+
+    def set_operand_type_table(self, table_data):
+        super(ArchM68k, self).set_operand_type_table(table_data)
+        self._specific_ea_keys = {}
+
+    def clear_caches(self):
+        super(ArchM68k, self).clear_caches()
+        self._specific_ea_keys.clear()
+
     def _decode_operand(self, data, data_idx, operand_idx, I, O):
         """
             data            The data stream.
@@ -397,31 +423,6 @@ class ArchM68k(ArchInterface):
             I               Instruction match.
             O               Current operand for the given instruction.
         """
-        def _data_word_lookup(data_words, text):
-            """
-            An instruction has N data words.  Something has defined it's value to be one of these, for a given size.
-            e.g. A variable may refer to I1.W, which means the first data word.
-            Note that extra/data words are effectively 1-indexed, as the 0 entry is for word read for the instruction.
-            """
-            size_idx = text.find(".")
-            if size_idx > 0:
-                size_char = text[size_idx+1]
-                word_idx = int(text[1:size_idx])
-                if size_char == "B":
-                    if data_words[word_idx] & ~0xFF: return # Sanity check.
-                    return data_words[word_idx] & 0xFF, 8
-                elif size_char == "W":
-                    return data_words[word_idx], 16
-                elif size_char == "L":
-                    return (data_words[word_idx] << 16) + data_words[word_idx+1], 32
-
-        def _resolve_specific_ea_key(mode_bits, register_bits, operand_ea_mask):
-            for i, line in enumerate(self.table_operand_types):
-                if operand_ea_mask & (1 << i) and line[EAMI_MATCH_FIELDS][EAMI_MATCH_MODE] == mode_bits:
-                    if line[EAMI_MATCH_FIELDS][EAMI_MATCH_REG] != "Rn" and line[EAMI_MATCH_FIELDS][EAMI_MATCH_REG] != register_bits:
-                        continue
-                    return line[EAMI_LABEL]
-
         if O.specification.key == OPERAND_KEY_REGISTER_LIST:
             T2 = I.opcodes[1-operand_idx]
             word, size_char = _data_word_lookup(I.data_words, O.vars["xxx"])
@@ -483,7 +484,7 @@ class ArchM68k(ArchInterface):
         operand_key = specific_key = O.specification.key
 
         if specific_key == "EA":
-            specific_key = O.key = _resolve_specific_ea_key(O.vars["mode"], O.vars["register"], I.table_ea_masks[operand_idx])
+            specific_key = O.key = self._resolve_specific_ea_key(O.vars["mode"], O.vars["register"], I.table_ea_masks[operand_idx])
             if specific_key is None:
                 #logger.debug("_decode_operand$%X: %s unresolved EA key mode:%s register:%s", I.pc, I.specification.key, _n2b(O.vars["mode"]), _n2b(O.vars["register"]))
                 return None
@@ -590,6 +591,24 @@ FmtTable = [
     [ _b2n("10"), "L" ],
 ]
 
+def _data_word_lookup(data_words, text):
+    """
+    An instruction has N data words.  Something has defined it's value to be one of these, for a given size.
+    e.g. A variable may refer to I1.W, which means the first data word.
+    Note that extra/data words are effectively 1-indexed, as the 0 entry is for word read for the instruction.
+    """
+    size_idx = text.find(".")
+    if size_idx > 0:
+        size_char = text[size_idx+1]
+        word_idx = int(text[1:size_idx])
+        if size_char == "B":
+            if data_words[word_idx] & ~0xFF: return # Sanity check.
+            return data_words[word_idx] & 0xFF, 8
+        elif size_char == "W":
+            return data_words[word_idx], 16
+        elif size_char == "L":
+            return (data_words[word_idx] << 16) + data_words[word_idx+1], 32
+
 OPERAND_KEY_REGISTER_LIST = "RL"
 OPERAND_KEY_DISPLACEMENT = "DISPLACEMENT"
 
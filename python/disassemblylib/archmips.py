@@ -36,6 +36,7 @@ class ArchMIPS(ArchInterface):
     constant_core_architecture_mask = IF_MIPS32
     constant_endian_types = ">"
     constant_word_size = 32
+    constant_dispatch_bits = 16
 
     """
     constant_table_bits = [
@@ -1,9 +1,11 @@
 from __future__ import print_function
 
+import collections
 import logging
 import re
 import struct
-from typing import Union, List, Dict, Tuple
+import threading
+from typing import Any, Union, List, Dict, Tuple
 
 logger = logging.getLogger("disassembler-util")
 
@@ -11,15 +13,85 @@ logger = logging.getLogger("disassembler-util")
 
 # See the end of the file for the __all__ definition.
 
-def memoize(function):
-    memo = {}
-    def wrapper(*args):
-        if args in memo:
-            return memo[args]
+class MemoizeCache(object):
+    """ A bounded least recently used cache of the results of a function, by its arguments. """
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict() # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, function, args):
+        with self._lock:
+            try:
+                rv = self._entries[args]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(args)
+                self.hits += 1
+                return rv
+        # The lock is not held, as the function may use other memoized functions.
         rv = function(*args)
-        memo[args] = rv
+        with self._lock:
+            self._entries[args] = rv
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
         return rv
-    return wrapper
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def get_stats(self):
+        # type: () -> Dict[str, int]
+        return {
+            "entries": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+""" The default bound on the number of results each memoized function retains. """
+MEMOIZE_MAX_SIZE = 10000
+
+_memoize_caches = [] # type: List[MemoizeCache]
+
+def memoize(function=None, max_size=None):
+    """
+    Cache the results of a function by its arguments.  This can be used as `@memoize`, or with
+    a bound on the number of retained results as `@memoize(max_size=N)`.  Memoized functions
+    should be defined at module level, as each has its cache registered for the lifetime of the
+    process.
+    """
+    def decorator(function):
+        cache = MemoizeCache(function.__module__ +"."+ function.__name__, MEMOIZE_MAX_SIZE if max_size is None else max_size)
+        _memoize_caches.append(cache)
+        def wrapper(*args):
+            return cache.get(function, args)
+        wrapper.cache = cache
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    if function is not None:
+        return decorator(function)
+    return decorator
+
+def get_memoize_stats():
+    # type: () -> Dict[str, Dict[str, int]]
+    """ The statistics of each memoized function, by name. """
+    return { cache.name: cache.get_stats() for cache in _memoize_caches }
+
+def clear_memoize_caches():
+    """ Discard the results cached by all memoized functions. """
+    for cache in _memoize_caches:
+        cache.clear()
 
 ## Instruction table columns.
 II_MASK = 0
@@ -67,55 +139,246 @@ def make_operand_mask(mask_string):
     return and_mask, cmp_mask
 
 
+class MatchVarsSchema(object):
+    """
+    The ordered variable names of a MatchVars.  Schemas are shared, with each reached by extending
+    the empty schema one variable name at a time.
+    """
+    __slots__ = ("names", "indexes", "extensions")
+
+    def __init__(self, names):
+        self.names = names # type: Tuple[str, ...]
+        self.indexes = { name: i for (i, name) in enumerate(names) } # type: Dict[str, int]
+        self.extensions = {} # type: Dict[str, MatchVarsSchema]
+
+    def extend(self, name):
+        schema = self.extensions.get(name, None)
+        if schema is None:
+            schema = self.extensions[name] = MatchVarsSchema(self.names + (name,))
+        return schema
+
+EMPTY_MATCH_VARS_SCHEMA = MatchVarsSchema(())
+
+def get_match_vars_schema(names):
+    schema = EMPTY_MATCH_VARS_SCHEMA
+    for name in names:
+        schema = schema.extend(name)
+    return schema
+
+
+class MatchVars(object):
+    """
+    The decoded variables of an instruction or operand.  This is used like a dictionary, but the
+    values are stored positionally against a schema shared with other uses of the same variables.
+    """
+    __slots__ = ("_schema", "_values")
+
+    def __init__(self, schema=EMPTY_MATCH_VARS_SCHEMA, values=None):
+        self._schema = schema # type: MatchVarsSchema
+        self._values = [] if values is None else values # type: List[Union[int, str]]
+
+    def __getitem__(self, name):
+        return self._values[self._schema.indexes[name]]
+
+    def __setitem__(self, name, value):
+        idx = self._schema.indexes.get(name, None)
+        if idx is None:
+            self._schema = self._schema.extend(name)
+            self._values.append(value)
+        else:
+            self._values[idx] = value
+
+    def __contains__(self, name):
+        return name in self._schema.indexes
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "MatchVars(%r)" % dict(self.items())
+
+    def get(self, name, default=None):
+        idx = self._schema.indexes.get(name, None)
+        if idx is None:
+            return default
+        return self._values[idx]
+
+    def keys(self):
+        return list(self._schema.names)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        # A copy, so that callers can update values as they iterate.
+        return list(zip(self._schema.names, self._values))
+
+
 class Match(object):
-    table_mask = None # type: str
-    table_extra_words = None # type: int
-    format = None # type: str
-    specification = None # type: Specification
+    __slots__ = ("table_mask", "table_extra_words", "table_ea_masks", "table_flags", "specification",
+        "data_words", "opcodes", "vars", "num_bytes", "pc", "data")
+
     description = None # type: str
-    data_words = None # type: List[int]
-    opcodes = None # type: List[MatchOpcode]
-    vars = None # type: Dict[str, Union[int, str]]
-    num_bytes = None # type: int
-    pc = None # type: int
-    data = None # type: str
+
+    def __init__(self):
+        self.table_mask = None # type: str
+        self.table_extra_words = None # type: int
+        self.table_ea_masks = None # type: List[int]
+        self.table_flags = None # type: int
+        self.specification = None # type: Specification
+        self.data_words = None # type: List[int]
+        self.opcodes = None # type: Tuple[MatchOpcode, ...]
+        self.vars = None # type: MatchVars
+        self.num_bytes = None # type: int
+        self.pc = None # type: int
+        self.data = None # type: bytes
+
+    @property
+    def format(self):
+        # type: () -> str
+        return self.specification.format
+
+    def copy_to_pc(self, pc):
+        # type: (int) -> Match
+        """ A copy of this match at a different location, sharing all its decoded state. """
+        M = Match.__new__(Match)
+        for attribute_name in Match.__slots__:
+            setattr(M, attribute_name, getattr(self, attribute_name))
+        M.pc = pc
+        return M
 
 class MatchOpcode(object):
-    # Overrides the one in the specification
-    key = None # type: str
-    format = None # type: str
-    specification = None # type: Specification
+    __slots__ = ("key", "specification", "vars", "register_list_masks")
+
     description = None # type: str
-    vars = None # type: Dict[str, Union[int, str]]
-    register_list_masks = None # type: Tuple[int,int]
+
+    def __init__(self):
+        # Overrides the one in the specification
+        self.key = None # type: str
+        self.specification = None # type: Specification
+        self.vars = None # type: MatchVars
+        self.register_list_masks = None # type: Tuple[int,int]
+
+    @property
+    def format(self):
+        # type: () -> str
+        return self.specification.format
+
+class DecodeCache(object):
+    """
+    A bounded least recently used cache of decoded instructions, keyed by architecture and the
+    instruction bytes.  The cached matches are shared as templates, which are copied with the
+    program counter of each new location they are found at.  They must not be modified.
+    """
+    """ How many different encodings of a given first instruction word are retained. """
+    MAX_ENCODINGS_PER_WORD = 8
+
+    def __init__(self, max_entries=8192):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (arch, word1) -> [ (instruction_bytes, match), ... ] in most recently used order.
+        self._entries = collections.OrderedDict() # type: collections.OrderedDict
+        self._entry_count = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, arch, word1, data, data_idx, pc):
+        # type: (ArchInterface, int, Any, int, int) -> Union[None, Match]
+        key = (arch, word1)
+        with self._lock:
+            encodings = self._entries.get(key, None)
+            if encodings is not None:
+                for i, (instruction_bytes, template) in enumerate(encodings):
+                    if data[data_idx:data_idx+len(instruction_bytes)] == instruction_bytes:
+                        if i > 0:
+                            del encodings[i]
+                            encodings.insert(0, (instruction_bytes, template))
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return template.copy_to_pc(pc)
+            self.misses += 1
+        return None
+
+    def insert(self, arch, word1, match):
+        # type: (ArchInterface, int, Match) -> None
+        key = (arch, word1)
+        with self._lock:
+            encodings = self._entries.get(key, None)
+            if encodings is None:
+                encodings = self._entries[key] = []
+            else:
+                self._entries.move_to_end(key)
+            encodings.insert(0, (match.data, match))
+            self._entry_count += 1
+            if len(encodings) > self.MAX_ENCODINGS_PER_WORD:
+                encodings.pop()
+                self._entry_count -= 1
+                self.evictions += 1
+            while self._entry_count > self.max_entries:
+                evicted_key, evicted_encodings = self._entries.popitem(last=False)
+                self._entry_count -= len(evicted_encodings)
+                self.evictions += len(evicted_encodings)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._entry_count = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def get_stats(self):
+        # type: () -> Dict[str, int]
+        return {
+            "entries": self._entry_count,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+""" The decode cache shared by all architectures. """
+decode_cache = DecodeCache()
+
 
 class Specification(object):
+    format = None # type: str
     key = None # type: str
     mask_char_vars = None # type: Dict[str, str]
     filter_keys = None # type: Union[None, List[str]]
+    vars_schema = None # type: MatchVarsSchema
 
 
+@memoize
+def get_substitution_vars(s):
+    """
+    Take a string of variable substitutions and convert it into the equivalent dictionary form.
+    e.g. "a=b&c=d&e=f" -> { "a": "b", "c": "d", "e": "f" }
+    """
+    d = {}
+    for candidate_string in s[1:-1].split("&"):
+        k, v = [ t.strip() for t in candidate_string.split("=") ]
+        d[k] = v
+    return d
+
 @memoize
 def _make_specification(format):
     """
     Parse a token into a key, substitutions to be made into the key and filters on which operand variants are legal.
     """
-    @memoize
-    def get_substitution_vars(s):
-        """
-        Take a string of variable substitutions and convert it into the equivalent dictionary form.
-        e.g. "a=b&c=d&e=f" -> { "a": "b", "c": "d", "e": "f" }
-        """
-        d = {}
-        for candidate_string in s[1:-1].split("&"):
-            k, v = [ t.strip() for t in candidate_string.split("=") ]
-            d[k] = v
-        return d
-
     # TYPE:CHAR
     # TYPE:CHAR(TYPE FILTER OPTION|...)
     # TYPE:VARLIST[FILTER_OPTION|...]
     spec = Specification()
+    spec.format = format
     spec.mask_char_vars = {}
 
     idx_typeN = format.find(":")
@@ -271,6 +534,84 @@ def process_instruction_list(_A, _list):
     return _list
 
 
+@memoize
+def get_instruction_format_parts(instr_format):
+    """ Split "INSTR OP1, OP2, ..." into [ "INSTR", "OP1, "OP2", ... ]. """
+    opcode_sidx = instr_format.find(" ")
+    if opcode_sidx == -1:
+        return [ instr_format ]
+    ret = [ instr_format[:opcode_sidx] ]
+    opcode_string = instr_format[opcode_sidx+1:]
+    opcode_bits = opcode_string.replace(" ", "").split(",")
+    ret.extend(opcode_bits)
+    return ret
+
+@memoize
+def get_instruction_format_specifications(instr_format):
+    """ Get the specification of the instruction, and those of each of its operands. """
+    instruction_parts = get_instruction_format_parts(instr_format)
+    operand_specifications = tuple(_make_specification(opcode_format) for opcode_format in instruction_parts[1:])
+    return _make_specification(instruction_parts[0]), operand_specifications
+
+_value_struct_format_chars = {
+    (64, False):   "Q",
+    (64, True):    "q",
+    (32, False):   "I",
+    (32, True):    "i",
+    (16, False):   "H",
+    (16, True):    "h",
+    (8,  False):   "B",
+    (8,  True):    "b",
+}
+
+_value_structs = {} # type: Dict[Tuple[str, int, bool], struct.Struct]
+
+def _get_value_struct(endian_type, bits, signed):
+    # Looked up for every value read, so a plain dictionary is used rather than a locking memoize cache.
+    key = endian_type, bits, signed
+    value_struct = _value_structs.get(key, None)
+    if value_struct is None:
+        value_struct = _value_structs[key] = struct.Struct(endian_type + _value_struct_format_chars[(bits, signed)])
+    return value_struct
+
+
+def make_instruction_dispatch_table(table_instructions, word_bits, dispatch_bits):
+    """
+    Precompute which instruction table entries can match a first instruction word, keyed by
+    the leading `dispatch_bits` bits of that word.  The candidates for each key retain the
+    order of the instruction table, so the first candidate that matches is the same entry a
+    linear scan of the instruction table would have matched.
+    """
+    shift = word_bits - dispatch_bits
+    key_mask = ((1 << dispatch_bits) - 1) << shift
+    candidates_by_key = [ [] for i in range(1 << dispatch_bits) ]
+    for entry in table_instructions:
+        and_mask, cmp_mask = entry[II_ANDMASK], entry[II_CMPMASK]
+        # Entries with known bits beyond the first word can never be matched by it.
+        if cmp_mask >> word_bits:
+            continue
+        fixed_bits = (cmp_mask & key_mask) >> shift
+        free_bits = (~and_mask & key_mask) >> shift
+        # Enumerate every combination of the variable bits within the key.
+        key_bits = free_bits
+        while True:
+            candidates_by_key[fixed_bits | key_bits].append(entry)
+            if key_bits == 0:
+                break
+            key_bits = (key_bits - 1) & free_bits
+
+    # Many keys share the same candidates, and the empty case is common.
+    shared_candidates = {}
+    dispatch_table = [ None ] * len(candidates_by_key)
+    for key, candidates in enumerate(candidates_by_key):
+        candidates_key = tuple(id(entry) for entry in candidates)
+        shared = shared_candidates.get(candidates_key)
+        if shared is None:
+            shared = shared_candidates[candidates_key] = tuple(candidates)
+        dispatch_table[key] = shared
+    return dispatch_table
+
+
 class IntrospectionHelperInterface(object):
     def __init__(self, api_state):
         self.api_state = api_state
@@ -311,6 +652,10 @@ class ArchInterface(object):
     constant_pc_offset = 0
     """ Constant: Method of filtered selection of multiple valid operand types. """
     constant_operand_type_general_label = None # type: Union[None, str]
+    """ Constant: How many leading bits of the first instruction word select instruction candidates.  None is the whole word. """
+    constant_dispatch_bits = None # type: Union[None, int]
+    """ Constant: Whether decoded instructions are independent of their address, and can be shared by the decode cache. """
+    constant_pc_independent_decoding = False
 
     constant_table_condition_code_names = None # type: Union[List[str], Dict[int, str]]
     constant_table_size_names = None # type: List[str]
@@ -319,6 +664,16 @@ class ArchInterface(object):
 
     """ Variable: The implicit (or user selected) endian type. """
     variable_endian_type = None # type: str
+    """ Variable: Whether instruction matching uses the dispatch table, rather than scanning the instruction table. """
+    variable_use_dispatch_table = True
+    """ Variable: Whether decoded instructions are shared through the decode cache. """
+    variable_use_decode_cache = True
+    """ Variable: Whether instruction variables are decoded using compiled plans, rather than interpreting the instruction table. """
+    variable_use_decode_plans = True
+
+    table_instructions = None # type: List[List[Any]]
+    table_dispatch = None # type: List[Tuple[List[Any], ...]]
+    table_decode_plans = None # type: Dict[str, Tuple[Any, ...]]
 
     # API: External use.
     """ Function: Identify if the given instruction alters the program counter. """
@@ -340,25 +695,86 @@ class ArchInterface(object):
     def function_disassemble_one_line(self, data, data_idx, data_abs_idx):
         """ Tokenise one disassembled instruction with its operands. """
 
+        use_decode_cache = self.variable_use_decode_cache and self.constant_pc_independent_decoding
+        if use_decode_cache:
+            word1 = self._get_word(data, data_idx)[0]
+            if word1 is not None:
+                M = decode_cache.lookup(self, word1, data, data_idx, data_abs_idx + self.constant_pc_offset)
+                if M is not None:
+                    return M, data_idx + M.num_bytes
+
         idx0 = data_idx
         M, data_idx = self._match_instructions(data, data_idx, data_abs_idx)
         if M is None:
             return None, idx0
 
-        # An instruction may have multiple words to it, before operand data..  e.g. MOVEM
-        for i in range(M.table_extra_words):
-            data_word, data_idx = self._get_word(data, data_idx)
-            M.data_words.append(data_word)
-
-        self._disassemble_vars_pass(M)
-        for operand_idx, O in enumerate(M.opcodes):
-            data_idx = self._decode_operand(data, data_idx, operand_idx, M, O)
-            if data_idx is None: # Disassembly failure.
-                return None, idx0
-        M.num_bytes = data_idx - idx0
-        M.data = data[idx0:data_idx]
+        data_idx = self._disassemble_match(data, idx0, data_idx, M)
+        if data_idx is None: # Disassembly failure.
+            return None, idx0
+        if use_decode_cache:
+            decode_cache.insert(self, M.data_words[0], M)
         return M, data_idx
 
+    def disassemble_range(self, data, start, end, base_address):
+        """
+        Tokenise the linear run of instructions starting at `start` and located at `base_address`,
+        yielding `(match, next_data_idx, is_final)` for each.  The run ends after a final instruction,
+        or at the first instruction starting at or after `end`.  Where an instruction cannot be
+        disassembled, `(None, data_idx, False)` is yielded for it and the run ends.
+
+        Note that the last instruction of the run may extend past `end`.
+        """
+        word_struct = _get_value_struct(self.variable_endian_type, self.constant_word_size, False)
+        word_size = word_struct.size
+        unpack_word = word_struct.unpack_from
+        if self.variable_use_dispatch_table and self.table_dispatch is not None:
+            dispatch_table = self.table_dispatch
+            dispatch_shift = self.constant_word_size - self.get_dispatch_bits()
+        else:
+            dispatch_table = None
+            candidates = self.table_instructions
+        is_final_instruction = self.function_is_final_instruction
+        use_decode_cache = self.variable_use_decode_cache and self.constant_pc_independent_decoding
+        data_length = len(data)
+        address_delta = base_address - start
+        pc_delta = address_delta + self.constant_pc_offset
+
+        preceding_match = None
+        data_idx = start
+        while data_idx < end:
+            if data_idx + word_size > data_length:
+                logger.error("Data out of bounds: data_offset=%d data_length=%d", data_idx, data_length)
+                yield None, data_idx, False
+                return
+
+            word1 = unpack_word(data, data_idx)[0]
+            M = None
+            if use_decode_cache:
+                M = decode_cache.lookup(self, word1, data, data_idx, data_idx + pc_delta)
+            if M is not None:
+                next_data_idx = data_idx + M.num_bytes
+            else:
+                if dispatch_table is not None:
+                    candidates = dispatch_table[word1 >> dispatch_shift]
+                M = self._match_instruction_word(word1, candidates, data_idx + address_delta)
+                if M is None:
+                    yield None, data_idx, False
+                    return
+
+                next_data_idx = self._disassemble_match(data, data_idx, data_idx + word_size, M)
+                if next_data_idx is None:
+                    yield None, data_idx, False
+                    return
+                if use_decode_cache:
+                    decode_cache.insert(self, word1, M)
+
+            is_final = is_final_instruction(M, preceding_match)
+            yield M, next_data_idx, is_final
+            if is_final:
+                return
+            preceding_match = M
+            data_idx = next_data_idx
+
     """ Function: . """
     function_disassemble_as_data = _unimplemented_function
     """ Function: . """
@@ -371,6 +787,17 @@ class ArchInterface(object):
     # API: Internal use.
     def set_instruction_table(self, table_data):
         self.table_instructions = process_instruction_list(self, table_data)
+        self.table_dispatch = make_instruction_dispatch_table(self.table_instructions, self.constant_word_size, self.get_dispatch_bits())
+        self.table_decode_plans = {}
+
+    def clear_caches(self):
+        """ Discard the results cached while decoding, which the tables can produce anew. """
+        self.table_decode_plans.clear()
+
+    def get_dispatch_bits(self):
+        if self.constant_dispatch_bits is None:
+            return self.constant_word_size
+        return self.constant_dispatch_bits
 
     def set_operand_type_table(self, table_data):
         self.table_operand_types = table_data
@@ -411,74 +838,164 @@ class ArchInterface(object):
         return self._get_value(data, data_idx, self.constant_word_size, False)
 
     def _get_value(self, data, data_idx, bits, signed):
-        k = (bits, signed)
-        d = {
-            (64, False):   "Q",
-            (64, True):    "q",
-            (32, False):   "I",
-            (32, True):    "i",
-            (16, False):   "H",
-            (16, True):    "h",
-            (8,  False):   "B",
-            (8,  True):    "b",
-        }
-        sfmt = self.variable_endian_type + d[k]
-        size = struct.calcsize(sfmt)
-        if data_idx + size <= len(data):
-            return struct.unpack(sfmt, data[data_idx:data_idx+size])[0], data_idx + size
+        value_struct = _get_value_struct(self.variable_endian_type, bits, signed)
+        if data_idx + value_struct.size <= len(data):
+            return value_struct.unpack_from(data, data_idx)[0], data_idx + value_struct.size
         return None, data_idx
 
     def _match_instructions(self, data, data_idx, data_abs_idx):
         """ Read one word from the stream, and return matching instructions by order of decreasing confidence. """
-        @memoize
-        def get_instruction_format_parts(instr_format):
-            """ Split "INSTR OP1, OP2, ..." into [ "INSTR", "OP1, "OP2", ... ]. """
-            opcode_sidx = instr_format.find(" ")
-            if opcode_sidx == -1:
-                return [ instr_format ]
-            ret = [ instr_format[:opcode_sidx] ]
-            opcode_string = instr_format[opcode_sidx+1:]
-            opcode_bits = opcode_string.replace(" ", "").split(",")
-            ret.extend(opcode_bits)
-            return ret
-
         word1, data_idx = self._get_word(data, data_idx)
         if word1 is None: # Disassembly failure
             logger.error("Data out of bounds: data_offset=%d data_length=%d", data_idx, len(data))
             return None, data_idx
 
-        M = None
-        for i, t in enumerate(self.table_instructions):
-            mask_string = t[II_MASK]
-            and_mask, cmp_mask = t[II_ANDMASK], t[II_CMPMASK]
-            if (word1 & and_mask) == cmp_mask:
-                instruction_parts = get_instruction_format_parts(t[II_NAME])
+        if self.variable_use_dispatch_table and self.table_dispatch is not None:
+            candidates = self.table_dispatch[word1 >> (self.constant_word_size - self.get_dispatch_bits())]
+        else:
+            candidates = self.table_instructions
+        return self._match_instruction_word(word1, candidates, data_abs_idx), data_idx
+
+    def _match_instruction_word(self, word1, candidates, data_abs_idx):
+        for t in candidates:
+            if (word1 & t[II_ANDMASK]) == t[II_CMPMASK]:
+                instruction_specification, operand_specifications = get_instruction_format_specifications(t[II_NAME])
 
                 M = Match()
                 # TODO(rmtew): Should not have pc?  Have address of instruction.
                 M.pc = data_abs_idx + self.constant_pc_offset
                 M.data_words = [ word1 ]
 
-                M.table_mask = mask_string
+                M.table_mask = t[II_MASK]
                 M.table_extra_words = t[II_EXTRAWORDS]
                 M.table_ea_masks = t[II_OPERANDMASKS]
                 M.table_flags = t[II_FLAGS]
 
-                M.format = instruction_parts[0]
-                M.specification = _make_specification(M.format)
-                M.opcodes = []
-                for i, opcode_format in enumerate(instruction_parts[1:]):
+                M.specification = instruction_specification
+                opcodes = []
+                for opcode_specification in operand_specifications:
                     T = MatchOpcode()
-                    T.format = opcode_format
-                    T.specification = _make_specification(T.format)
-                    M.opcodes.append(T)
-                break
+                    T.specification = opcode_specification
+                    opcodes.append(T)
+                M.opcodes = tuple(opcodes)
+                return M
 
-        return M, data_idx
+    def _disassemble_match(self, data, idx0, data_idx, M):
+        """ Decode the remainder of a matched instruction, returning the index after it or None on failure. """
+        # An instruction may have multiple words to it, before operand data..  e.g. MOVEM
+        for i in range(M.table_extra_words):
+            data_word, data_idx = self._get_word(data, data_idx)
+            M.data_words.append(data_word)
+
+        self._disassemble_vars_pass(M)
+        for operand_idx, O in enumerate(M.opcodes):
+            data_idx = self._decode_operand(data, data_idx, operand_idx, M, O)
+            if data_idx is None: # Disassembly failure.
+                return None
+        M.num_bytes = data_idx - idx0
+        # A copy, as a slice of a memoryview is larger and keeps the underlying data alive.
+        M.data = bytes(data[idx0:data_idx])
+        return data_idx
 
     def _disassemble_vars_pass(self, I):
-        def copy_values(mask_char_vars, char_vars):
-            d = {}
+        if self.variable_use_decode_plans:
+            plan = self.table_decode_plans.get(I.table_mask, None)
+            if plan is None:
+                plan = self.table_decode_plans[I.table_mask] = self._compile_vars_plan(I)
+            self._execute_vars_plan(I, plan)
+        else:
+            self._interpret_vars_pass(I)
+
+    def _compile_vars_plan(self, I):
+        """
+        Work out how each variable of the given matched instruction and its operands is decoded,
+        so that this is done once for each instruction table entry.
+        """
+        var_names = list(I.specification.mask_char_vars.values())
+        # Extend the base variable list for the instruction itself with any valid candidates from each applicable operand.
+        for O in I.opcodes:
+            for mask_var_name in O.specification.mask_char_vars.values():
+                if mask_var_name not in var_names:
+                    var_names.append(mask_var_name)
+        # The raw value for each variable is masked out of the instruction opcode.
+        var_fields = []
+        for mask_char in var_names:
+            if mask_char in I.table_mask:
+                mask, shift = get_mask_and_shift_from_mask_string(I.table_mask, mask_char)
+                var_fields.append((mask_char, mask, shift))
+        # The instruction size may be required by some operands.
+        size_value = None
+        idx0 = I.specification.key.rfind(".")
+        if idx0 != -1:
+            idxN = I.specification.key.find(".", idx0+1)
+            if idxN == -1: idxN = len(I.specification.key)
+            text = I.specification.key[idx0+1:idxN]
+            if text in self.constant_table_size_names:
+                size_value = self.constant_table_size_names.index(text)
+                var_fields = [ field for field in var_fields if field[0] != "z" ]
+
+        element_plans = []
+        for specification in [ I.specification ] + [ O.specification for O in I.opcodes ]:
+            var_ops = []
+            for var_name, char_string in specification.mask_char_vars.items():
+                if char_string[0] == "I": # Pending read, propagate for resolution when decoding this opcode
+                    var_ops.append((VPO_CONSTANT, char_string, None, None))
+                    continue
+                sections = char_string.rsplit(".", 1)
+                if len(sections) == 2:
+                    var_type = sections[1][0]
+                    var_bits = int(sections[1][1:])
+                    if var_type == "s":
+                        op_type = VPO_SIGNED
+                    elif var_type == "u":
+                        op_type = VPO_VALUE
+                    else:
+                        raise RuntimeError("Bad variable type")
+                    source_name = sections[0]
+                else:
+                    op_type, source_name, var_bits = VPO_VALUE, char_string, None
+                lookup_table = None
+                if var_name == "cc":
+                    lookup_table = self.constant_table_condition_code_names
+                elif var_name == "z":
+                    lookup_table = self.constant_table_size_names
+                elif var_name == "d":
+                    lookup_table = self.constant_table_direction_names
+                var_ops.append((op_type, source_name, var_bits, lookup_table))
+            if specification.vars_schema is None:
+                specification.vars_schema = get_match_vars_schema(specification.mask_char_vars)
+            element_plans.append((specification.vars_schema, tuple(var_ops)))
+        return tuple(var_fields), size_value, tuple(element_plans)
+
+    def _execute_vars_plan(self, I, plan):
+        var_fields, size_value, element_plans = plan
+        word = I.data_words[0]
+        var_values = {}
+        for mask_char, mask, shift in var_fields:
+            var_values[mask_char] = (word & mask) >> shift
+        if size_value is not None:
+            var_values["z"] = size_value
+
+        elements = [ I ]
+        elements.extend(I.opcodes)
+        for element, (vars_schema, var_ops) in zip(elements, element_plans):
+            values = []
+            for op_type, source_name, var_bits, lookup_table in var_ops:
+                if op_type == VPO_CONSTANT:
+                    values.append(source_name)
+                    continue
+                var_value = var_values[source_name]
+                if op_type == VPO_SIGNED:
+                    var_value = self._signed_value(var_value, bits=var_bits)
+                if lookup_table is not None:
+                    var_value = lookup_table[var_value]
+                values.append(var_value)
+            element.vars = MatchVars(vars_schema, values)
+
+    def _interpret_vars_pass(self, I):
+        def copy_values(specification, char_vars):
+            mask_char_vars = specification.mask_char_vars
+            values = []
             for var_name, char_string in mask_char_vars.items():
                 if char_string[0] == "I": # Pending read, propagate for resolution when decoding this opcode
                     var_value = char_string
@@ -491,7 +1008,7 @@ class ArchInterface(object):
                         if var_type == "s":
                             var_value = self._signed_value(var_value, bits=var_bits)
                         elif var_type != "u":
-                            raise RuntimeException("Bad variable type")
+                            raise RuntimeError("Bad variable type")
                     else:
                         var_value = char_vars[char_string]
 
@@ -501,8 +1018,10 @@ class ArchInterface(object):
                         var_value = self.constant_table_size_names[var_value]
                     elif var_name == "d":
                         var_value = self.constant_table_direction_names[var_value]
-                d[var_name] = var_value
-            return d
+                values.append(var_value)
+            if specification.vars_schema is None:
+                specification.vars_schema = get_match_vars_schema(mask_char_vars)
+            return MatchVars(specification.vars_schema, values)
 
         var_names = list(I.specification.mask_char_vars.values())
         # Extend the base variable list for the instruction itself with any valid candidates from each applicable operand.
@@ -522,9 +1041,9 @@ class ArchInterface(object):
             if text in self.constant_table_size_names:
                 var_values["z"] = self.constant_table_size_names.index(text)
         # For each element, gather the evaluated values for all of it's variables.
-        I.vars = copy_values(I.specification.mask_char_vars, var_values)
+        I.vars = copy_values(I.specification, var_values)
         for O in I.opcodes:
-            O.vars = copy_values(O.specification.mask_char_vars, var_values)
+            O.vars = copy_values(O.specification, var_values)
 
 
 if False:
@@ -669,6 +1188,11 @@ def get_masked_values_for_variables(value, mask_string, variable_chars=None):
     return var_values
 
 
+## Variable decode plan operations.
+VPO_CONSTANT = 0            # The variable is a pending read, and the specified text is passed through.
+VPO_VALUE = 1               # The variable is the masked value.
+VPO_SIGNED = 2              # The variable is the sign extended masked value.
+
 MAF_CODE = 1
 MAF_ABSOLUTE_ADDRESS = 2
 MAF_CONSTANT_VALUE = 4
@@ -683,15 +1207,17 @@ def generate_all():
     This is done in this function, so as not to introduce entries into the global dictionary.
     """
     l = [
-        "ArchInterface",
+        "ArchInterface", "DecodeCache", "decode_cache",
         "_b2n", "_n2b", "_make_specification",
         "update_mask_string", "get_mask_variables",
         "get_masked_value_for_variable", "set_masked_value_for_variable",
         "get_masked_values_for_variables", "get_mask_and_shift_from_mask_string",
-        "make_operand_mask", "memoize", "process_instruction_list", "signed_hex_string",
+        "get_instruction_format_parts", "get_instruction_format_specifications", "get_match_vars_schema",
+        "make_instruction_dispatch_table", "make_operand_mask", "memoize", "process_instruction_list", "signed_hex_string",
+        "MemoizeCache", "get_memoize_stats", "clear_memoize_caches",
     ]
     for k in globals().keys():
-        if k.startswith("II_") or k.startswith("EAMI") or k.startswith("IFX_") or k.startswith("MAF_"):
+        if k.startswith("II_") or k.startswith("EAMI") or k.startswith("IFX_") or k.startswith("MAF_") or k.startswith("VPO_"):
             l.append(k)
     return l
 
@@ -14,6 +14,7 @@ reproducing the same logic.
 
 import operator
 import os
+import threading
 import types
 import weakref
 from typing import Any
@@ -36,6 +37,7 @@ ERRMSG_INPUT_FILE_NOT_FOUND = "Input file not found."
 ERRMSG_INPUT_FILE_CHECKSUM_MISMATCH = "File does not match (checksum differs)"
 ERRMSG_INPUT_FILE_SIZE_DIFFERS = "File does not match (size differs)"
 ERRMSG_INVALID_LABEL_NAME = "Invalid label name"
+ERRMSG_INVALID_SEARCH_PATTERN = "Invalid regular expression"
 
 ERRMSG_BUG_UNKNOWN_ADDRESS = "Unable to determine address at current line, this is a bug."
 ERRMSG_BUG_NO_OPERAND_SELECTION_MECHANISM = "Too many valid operands, this is a bug."
@@ -46,6 +48,13 @@ import re
 
 RE_LABEL = re.compile("([\.]*[a-zA-Z_]+[a-zA-Z0-9_\.]*)$")
 
+""" How many lines the background search indexing renders at a time, and how long it waits for lines to change once all are indexed. """
+SEARCH_INDEX_BATCH_SIZE = 256
+SEARCH_INDEX_IDLE_DELAY = 0.5
+""" How many threads render source code ahead of it being written, when exporting.  Rendering
+    holds the GIL, so more than one only helps where writing is slow. """
+EXPORT_WORKER_COUNT = 1
+
 
 class ClientAPI(object):
     def __init__(self, owner):
@@ -142,11 +151,13 @@ class EditorState(object):
 
     def __init__(self):
         self.worker_thread = disassembly_util.WorkerThread()
+        self.search_index_stop_event = None # type: threading.Event
         self.clients = weakref.WeakSet()
         self.reset_state(None)
 
     def on_app_exit(self):
         self.worker_thread.stop()
+        self._stop_search_indexing()
 
     def register_client(self, client):
         self.clients.add(client)
@@ -162,6 +173,7 @@ class EditorState(object):
         return disassembly_persistence.check_is_project_file(input_file)
 
     def reset_state(self, acting_client):
+        self._stop_search_indexing()
         self.disassembly_state = None
         self.line_number = 0
         self.last_selected_operand = None
@@ -234,19 +246,21 @@ class EditorState(object):
         return self.get_source_code_for_line_number(acting_client, line_idx)
 
     def get_source_code_for_line_number(self, acting_client, line_idx):
-        code_string = self.disassembly_state.get_file_line(line_idx, disassembly.LI_INSTRUCTION)
-        operands_text = self.disassembly_state.get_file_line(line_idx, disassembly.LI_OPERANDS)
+        row = self.disassembly_state.get_file_line_row(line_idx)
+        code_string = row[disassembly.LI_INSTRUCTION]
+        operands_text = row[disassembly.LI_OPERANDS]
         if len(operands_text):
             code_string += " "+ operands_text
         return code_string
 
     def get_row_for_line_number(self, acting_client, line_idx):
+        row = self.disassembly_state.get_file_line_row(line_idx)
         return [
-            self.disassembly_state.get_file_line(line_idx, disassembly.LI_OFFSET),
-            self.disassembly_state.get_file_line(line_idx, disassembly.LI_BYTES),
-            self.disassembly_state.get_file_line(line_idx, disassembly.LI_LABEL),
-            self.disassembly_state.get_file_line(line_idx, disassembly.LI_INSTRUCTION),
-            self.disassembly_state.get_file_line(line_idx, disassembly.LI_OPERANDS),
+            row[disassembly.LI_OFFSET],
+            row[disassembly.LI_BYTES],
+            row[disassembly.LI_LABEL],
+            row[disassembly.LI_INSTRUCTION],
+            row[disassembly.LI_OPERANDS],
         ]
 
     def get_referring_addresses_for_address(self, acting_client, address):
@@ -283,6 +297,11 @@ class EditorState(object):
             return ""
         return self.disassembly_state.get_file_line(row, column)
 
+    def get_file_lines(self, acting_client, line0, line_count):
+        if self.disassembly_state is None:
+            return []
+        return self.disassembly_state.get_file_lines(line0, line_count)
+
     def set_selected_operand(self, acting_client, operand_index):
         line_index = self.get_line_number(acting_client)
         operand_count = self.get_operand_count(acting_client, line_index)
@@ -369,8 +388,25 @@ class EditorState(object):
         line_number = self.disassembly_state.get_line_number_for_address(address)
         self.set_line_number(acting_client, line_number)
 
+    def _start_search_indexing(self):
+        """ Index the text of the file lines in the background, so that searches need not render them. """
+        disassembly_state = self.disassembly_state
+        stop_event = self.search_index_stop_event = threading.Event()
+        def index_lines():
+            while not stop_event.is_set():
+                if not disassembly_state.update_search_index(SEARCH_INDEX_BATCH_SIZE):
+                    stop_event.wait(SEARCH_INDEX_IDLE_DELAY)
+        thread = threading.Thread(target=index_lines)
+        thread.daemon = True
+        thread.start()
+
+    def _stop_search_indexing(self):
+        if self.search_index_stop_event is not None:
+            self.search_index_stop_event.set()
+            self.search_index_stop_event = None
+
     def search_text(self, acting_client):
-        result = acting_client.request_text("Find what?", "Text:", self.last_search_text or "")
+        result = acting_client.request_text("Find what?", "Text, or /regular expression/:", self.last_search_text or "")
         if result is None:
             return
         self.last_search_text = result
@@ -492,11 +528,14 @@ class EditorState(object):
         for client in self.clients:
             client.event_uncertain_reference_modification(client is acting_client, data_type_from, data_type_to, address, length)
 
-    def get_uncertain_code_references(self, acting_client):
-        return self.disassembly_state.get_uncertain_code_references()
+    def get_uncertain_code_references(self, acting_client, address0=None, addressN=None):
+        return self.disassembly_state.get_uncertain_code_references(address0, addressN)
+
+    def get_uncertain_data_references(self, acting_client, address0=None, addressN=None):
+        return self.disassembly_state.get_uncertain_data_references(address0, addressN)
 
-    def get_uncertain_data_references(self, acting_client):
-        return self.disassembly_state.get_uncertain_data_references()
+    def get_load_stats(self, acting_client):
+        return self.disassembly_state.get_load_stats()
 
     def get_uncertain_references_by_address(self, acting_client, address):
         return self.disassembly_state.get_uncertain_references_by_address(address)
@@ -586,30 +625,22 @@ class EditorState(object):
         self._prolonged_action(acting_client, "TITLE_DATA_TYPE_CHANGE", "TEXT_GENERIC_PROCESSING", self.disassembly_state.set_data_type_at_address, address, data_type, can_cancel=False)
 
     def _search_text(self, acting_client, direction, work_state=None):
+        # Text between slashes is searched for as a regular expression.
+        search_text = self.last_search_text
+        is_regex = len(search_text) > 2 and search_text.startswith("/") and search_text.endswith("/")
+        if is_regex:
+            search_text = search_text[1:-1]
         # Start after the current line.
         line_number = self.get_line_number(acting_client) + direction
-        line_count = self.get_line_count(acting_client)
-        result_lower_case = self.last_search_text.lower()
-        while line_number >= 0 and line_number < line_count and not work_state.is_cancelled():
-            text = self.disassembly_state.get_file_line(line_number, disassembly.LI_LABEL)
-            text += " "+ self.disassembly_state.get_file_line(line_number, disassembly.LI_INSTRUCTION)
-            text += " "+ self.disassembly_state.get_file_line(line_number, disassembly.LI_OPERANDS)
-            if disassembly.DEBUG_ANNOTATE_DISASSEMBLY:
-                text += " "+ self.disassembly_state.get_file_line(line_number, disassembly.LI_ANNOTATIONS)
-
-            if result_lower_case in text.lower():
-                break
-            line_number += direction
-            if direction == 1:
-                work_state.set_completeness(line_number / float(line_count))
-            else:
-                work_state.set_completeness((line_count - line_number) / float(line_count))
-            work_state.set_description("Line %d" % line_number)
-        else:
+        try:
+            line_number = self.disassembly_state.search_file_lines(search_text, line_number, direction, is_regex, work_state)
+        except re.error:
+            return ERRMSG_INVALID_SEARCH_PATTERN
+        if work_state.is_cancelled():
+            return None
+        if line_number is None:
             return ERRMSG_NO_IDENTIFIABLE_DESTINATION
-        # We broke out on a match.
-        if not work_state.is_cancelled():
-            return line_number
+        return line_number
 
     def load_file(self, acting_client):
         self.reset_state(acting_client)
@@ -716,6 +747,7 @@ class EditorState(object):
             for client in self.clients:
                 client.event_post_line_change(client is acting_client, line0, line_count)
         self.disassembly_state.set_post_line_change_func(_post_line_change_callback)
+        self._start_search_indexing()
 
         for client in self.clients:
             client.event_load_successful(client is acting_client)
@@ -743,22 +775,14 @@ class EditorState(object):
         if self.state_id != EditorState.STATE_LOADED:
             return ERRMSG_TODO_BAD_STATE_FUNCTIONALITY
 
-        line_count = self.disassembly_state.get_file_line_count()
-
         # Prompt for save file name.
         save_file = acting_client.request_code_save_file()
         if save_file is not None:
-            for i in range(line_count):
-                label_text = self.disassembly_state.get_file_line(i, disassembly.LI_LABEL)
-                instruction_text = self.disassembly_state.get_file_line(i, disassembly.LI_INSTRUCTION)
-                operands_text = self.disassembly_state.get_file_line(i, disassembly.LI_OPERANDS)
-                if label_text:
-                    save_file.write(label_text)
-                if instruction_text or operands_text:
-                    save_file.write("\t")
-                    save_file.write(instruction_text)
-                if operands_text:
-                    save_file.write("\t")
-                    save_file.write(operands_text)
-                save_file.write("\n")
+            return self._prolonged_action(acting_client, "TITLE_EXPORTING_SOURCE_CODE", "TEXT_GENERIC_PROCESSING", self._export_source_code, save_file)
+
+    def _export_source_code(self, save_file, work_state=None):
+        # The file is closed once the export returns, whether it completed, was cancelled or failed.
+        try:
+            return self.disassembly_state.export_source_code(save_file, work_state, EXPORT_WORKER_COUNT)
+        finally:
             save_file.close()
@@ -202,6 +202,10 @@ class DataTypes(object):
         except:
             pass
 
+    def uint32_values(self, bytes, idx, count):
+        """ Decode `count` consecutive 32 bit values starting at `idx` in one call. """
+        return struct.unpack_from("%s%dI" % (self._endian_char, count), bytes, idx)
+
     def uint32_value_as_string(self, v):
         if self.endian_id == constants.ENDIAN_BIG:
             return struct.pack(">I", v)
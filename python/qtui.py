@@ -154,14 +154,48 @@ class BaseItemModel(QtCore.QAbstractItemModel):
 
 
 class DisassemblyItemModel(BaseItemModel):
+    """ How many rows are fetched together, when the view asks for one not already fetched. """
+    PAGE_ROW_COUNT = 64
+
     def __init__(self, columns, parent):
         super(DisassemblyItemModel, self).__init__(columns, parent)
 
+        self._page_row0 = 0
+        self._page_rows = []
+
     def rowCount(self, parent=None):
         return self.window.editor_state.get_line_count(self.window.editor_client)
 
+    def _clear_page(self):
+        self._page_rows = []
+
     def _lookup_cell_value(self, row, column):
-        return self.window.editor_state.get_file_line(self.window.editor_client, row, column)
+        if row < self._page_row0 or row >= self._page_row0 + len(self._page_rows):
+            self._page_row0 = row - row % self.PAGE_ROW_COUNT
+            self._page_rows = self.window.editor_state.get_file_lines(self.window.editor_client, self._page_row0, self.PAGE_ROW_COUNT)
+            if row >= self._page_row0 + len(self._page_rows):
+                return ""
+        return self._page_rows[row - self._page_row0][column]
+
+    def _data_ready(self):
+        self._clear_page()
+        super(DisassemblyItemModel, self)._data_ready()
+
+    def _clear_data(self):
+        self._clear_page()
+        super(DisassemblyItemModel, self)._clear_data()
+
+    def _begin_row_change(self, row, row_count):
+        self._clear_page()
+        super(DisassemblyItemModel, self)._begin_row_change(row, row_count)
+
+    def _end_row_change(self, row, row_count):
+        self._clear_page()
+        super(DisassemblyItemModel, self)._end_row_change(row, row_count)
+
+    def _data_changed(self, start_x, start_y, end_x, end_y):
+        self._clear_page()
+        super(DisassemblyItemModel, self)._data_changed(start_x, start_y, end_x, end_y)
 
 
 class CustomItemModel(BaseItemModel):
@@ -1193,6 +1227,8 @@ class MainWindow(QtWidgets.QMainWindow):
         logger.info("on_disassembly_symbol_added: %x %s", symbol_address, symbol_label)
 
         self._add_rows_to_model(self.symbols_model, [ (symbol_address, symbol_label), ])
+        # Any line may refer to the symbol address, and will need to be fetched again to show it.
+        self.list_model._clear_page()
 
         self.symbols_table.resizeColumnsToContents()
         self.symbols_table.horizontalHeader().setStretchLastSection(True)
@@ -1203,6 +1239,7 @@ class MainWindow(QtWidgets.QMainWindow):
         logger.info("on_disassembly_symbol_removed: UNTESTED %x %s", symbol_address, symbol_label)
 
         self._remove_address_range_from_model(self.symbols_model, symbol_address, 1)
+        self.list_model._clear_page()
 
         self.symbols_table.resizeColumnsToContents()
         self.symbols_table.horizontalHeader().setStretchLastSection(True)
@@ -13,6 +13,7 @@ class BaseResource(object):
 class EnglishStrings(BaseResource):
     TEXT_GENERIC_LOADING = "Loading"
     TEXT_GENERIC_PROCESSING = "Processing"
+    TEXT_EXPORT_WRITING_LINES = "Writing lines"
     TEXT_LOAD_ANALYSING_FILE = "Analysing file"
     TEXT_LOAD_CONVERTING_PROJECT_FILE = "Converting project to latest version"
     TEXT_LOAD_DISASSEMBLY_PASS = "Disassembly pass"
@@ -20,6 +21,7 @@ class EnglishStrings(BaseResource):
     TEXT_LOAD_READING_PROJECT_DATA = "Reading project data"
 
     TITLE_DATA_TYPE_CHANGE = "Data type change"
+    TITLE_EXPORTING_SOURCE_CODE = "Exporting source code"
     TITLE_LOADING_FILE = "Loading file"
     TITLE_LOADING_PROJECT = "Loading project"
     TITLE_SEARCHING = "Searching"
@@ -8,10 +8,15 @@
 Unit testing.
 """
 
+import bisect
+import io
 import logging
 import os
 import random
 import sys
+import tempfile
+import threading
+import time
 import types
 import unittest
 
@@ -19,6 +24,8 @@ from Qt import QtCore, QtGui, QtWidgets
 
 import disassembly
 import disassembly_data
+import disassembly_persistence
+import disassembly_util
 import editor_state
 import qtui
 import toolapi
@@ -38,6 +45,303 @@ class CORE_ProgramData_TestCase(unittest.TestCase):
         disassembly_data.program_data_set_state(self.program_data, disassembly_data.STATE_LOADED)
         self.assertEqual(self.program_data.state, disassembly_data.STATE_LOADED)
 
+    def _check_symbol_indexes(self):
+        symbol_addresses_by_name = self.program_data.symbol_addresses_by_name
+        symbol_addresses_by_folded_name = self.program_data.symbol_addresses_by_folded_name
+        disassembly_data.program_data_index_symbols(self.program_data)
+        self.assertEqual(symbol_addresses_by_name, self.program_data.symbol_addresses_by_name)
+        self.assertEqual(dict((k, sorted(v)) for (k, v) in symbol_addresses_by_folded_name.items()),
+            dict((k, sorted(v)) for (k, v) in self.program_data.symbol_addresses_by_folded_name.items()))
+
+    def test_symbol_indexes(self):
+        """The symbol name indexes stay in step with the symbols as they are set, renamed and removed."""
+        disassembly_data.program_data_set_symbol(self.program_data, 0x100, "main")
+        disassembly_data.program_data_set_symbol(self.program_data, 0x200, "Main")
+        disassembly_data.program_data_set_symbol(self.program_data, 0x300, "exit")
+        self._check_symbol_indexes()
+        self.assertEqual(0x200, self.program_data.symbol_addresses_by_name["Main"])
+        self.assertEqual([ 0x100, 0x200 ], self.program_data.symbol_addresses_by_folded_name["main"])
+
+        disassembly_data.program_data_set_symbol(self.program_data, 0x100, "start")
+        self._check_symbol_indexes()
+        self.assertNotIn("main", self.program_data.symbol_addresses_by_name)
+        self.assertEqual([ 0x200 ], self.program_data.symbol_addresses_by_folded_name["main"])
+
+        self.assertEqual("Main", disassembly_data.program_data_remove_symbol(self.program_data, 0x200))
+        self.assertEqual(None, disassembly_data.program_data_remove_symbol(self.program_data, 0x200))
+        self._check_symbol_indexes()
+        self.assertNotIn("main", self.program_data.symbol_addresses_by_folded_name)
+        self.assertEqual({ 0x100: "start", 0x300: "exit" }, self.program_data.symbols_by_address)
+
+
+class CORE_BlockList_TestCase(unittest.TestCase):
+    def _make_block(self, address):
+        block = disassembly_data.SegmentBlock()
+        block.address = address
+        return block
+
+    def _check_against_lists(self, block_list, blocks, line_counts):
+        """The block list should give the same results as the lists it replaces."""
+        addresses = [ block.address for block in blocks ]
+        line_numbers = []
+        line_number = 0
+        for line_count in line_counts:
+            line_numbers.append(line_number)
+            line_number += line_count
+        self.assertEqual(len(blocks), len(block_list))
+        self.assertEqual(blocks, list(block_list))
+        for idx, line_number in enumerate(line_numbers):
+            self.assertIs(blocks[idx], block_list[idx])
+            self.assertEqual(line_number, block_list.get_line_number(idx))
+        for line_number in range(-1, line_number + 2):
+            block_idx = bisect.bisect_right(line_numbers, line_number)
+            self.assertEqual(block_idx, block_list.bisect_line_number(line_number))
+            self.assertEqual((blocks[block_idx-1], block_idx-1), block_list.lookup_line_number(line_number))
+        for address in range(addresses[0] - 1, addresses[-1] + 2, 7):
+            block_idx = bisect.bisect_right(addresses, address)
+            self.assertEqual(block_idx, block_list.bisect_address(address))
+            self.assertEqual((blocks[block_idx-1], block_idx-1), block_list.lookup_address(address))
+        for address in addresses:
+            self.assertEqual(bisect.bisect_right(addresses, address), block_list.bisect_address(address))
+
+    def test_random_modification(self):
+        random.seed(0)
+        blocks = [ self._make_block(i * 1000) for i in range(50) ]
+        line_counts = [ 0 ] * len(blocks)
+        block_list = disassembly_data.BlockList(blocks)
+        # Make sure the insertions split the chunks.
+        block_list.MAX_CHUNK_SIZE = 8
+        self._check_against_lists(block_list, blocks, line_counts)
+        for i in range(300):
+            idx = random.randrange(len(blocks))
+            line_count = random.randint(0, 5)
+            if random.random() < 0.3 and blocks[idx].address + 1 < blocks[idx+1].address:
+                # Insert a block between existing ones, in the same way a block split does.
+                block = self._make_block((blocks[idx].address + blocks[idx+1].address) // 2)
+                blocks.insert(idx + 1, block)
+                line_counts.insert(idx + 1, 0)
+                block_list.insert(idx + 1, block)
+            else:
+                line_counts[idx] = line_count
+                block_list.set_line_count(idx, line_count)
+            self._check_against_lists(block_list, blocks, line_counts)
+
+    def test_append(self):
+        block_list = disassembly_data.BlockList()
+        self.assertEqual(0, len(block_list))
+        self.assertEqual(0, block_list.bisect_address(100))
+        blocks = []
+        for i in range(20):
+            blocks.append(self._make_block(i * 10))
+            block_list.append(blocks[-1])
+        self.assertEqual(blocks, list(block_list))
+        self.assertIs(blocks[-1], block_list[-1])
+
+
+class CORE_LineData_TestCase(unittest.TestCase):
+    def _make_line_data(self):
+        line_data = disassembly_data.LineData()
+        expected_entries = []
+        for block_offset in range(0, 40, 4):
+            line_data.append_instruction(block_offset, None)
+            expected_entries.append((disassembly_data.SLD_INSTRUCTION, block_offset))
+        line_data.insert(3, disassembly_data.SLD_COMMENT_FULL_LINE, "comment")
+        expected_entries.insert(3, (disassembly_data.SLD_COMMENT_FULL_LINE, "comment"))
+        line_data.insert(6, disassembly_data.SLD_EQU_LOCATION_RELATIVE, 14)
+        expected_entries.insert(6, (disassembly_data.SLD_EQU_LOCATION_RELATIVE, 14))
+        return line_data, expected_entries
+
+    def test_split(self):
+        """The line data should read the same as the list of entries it replaces, as it is split and rebased."""
+        line_data, expected_entries = self._make_line_data()
+        self.assertEqual(expected_entries, list(line_data))
+        self.assertEqual(expected_entries[-1], line_data[-1])
+        self.assertEqual(10, line_data.type_ids.count(disassembly_data.SLD_INSTRUCTION))
+
+        split_line_data = line_data[5:]
+        split_line_data.rebase(16)
+        del line_data.type_ids[5:]
+        del line_data.offsets[5:]
+        self.assertEqual(expected_entries[:5], list(line_data))
+        self.assertEqual([ (type_id, entry - 16 if type(entry) is int else entry) for (type_id, entry) in expected_entries[5:] ], list(split_line_data))
+        self.assertEqual(0, split_line_data.get_block_offset(0))
+
+    def test_persistence(self):
+        """Code block line data is saved as raw buffers, and loads with the same entries."""
+        block = disassembly_data.SegmentBlock()
+        block.segment_id = 0
+        block.segment_offset = 8
+        block.address = 0x1008
+        block.length = 32
+        block.line_count = 0
+        disassembly_data.set_block_data_type(block, disassembly_data.DATA_TYPE_CODE)
+        line_data, expected_entries = self._make_line_data()
+        block.line_data = line_data[2:]
+        block.line_data.rebase(8)
+        f = io.BytesIO()
+        disassembly_persistence.write_SegmentBlock(f, block, 0)
+        f.seek(0)
+        version = disassembly_persistence.CURRENT_HUNK_VERSIONS[disassembly_persistence.SAVEFILE_HUNK_DISASSEMBLY]
+        loaded_block = disassembly_persistence.read_SegmentBlock(f, version)
+        self.assertEqual(list(block.line_data), list(loaded_block.line_data))
+
+
+class CORE_CrossReferences_TestCase(unittest.TestCase):
+    def _check_against_mapping(self, cross_references, mapping):
+        """The cross references should give the same results as the dictionary of sets they replace."""
+        self.assertEqual(sorted(mapping), list(cross_references))
+        for key, values in mapping.items():
+            self.assertIn(key, cross_references)
+            self.assertEqual(sorted(values), list(cross_references[key]))
+        self.assertNotIn(1, cross_references)
+        self.assertEqual(None, cross_references.get(1))
+        items = sorted((key, value) for (key, values) in mapping.items() for value in values)
+        self.assertEqual([ item for item in items if 200 <= item[0] < 600 ], cross_references.get_items_in_range(200, 600))
+        reverse_items = sorted((value, key) for (key, value) in items)
+        self.assertEqual([ item for item in reverse_items if 200 <= item[0] < 600 ], cross_references.get_reverse_items_in_range(200, 600))
+        for value, key in reverse_items:
+            self.assertIn(key, cross_references.get_keys(value))
+
+    def test_random_modification(self):
+        random.seed(0)
+        mapping = { 100: set(), 102: { 4, 8 } }
+        cross_references = disassembly_data.CrossReferences(mapping)
+        # Make sure the additions get merged into the rows.
+        cross_references.MIN_PENDING_VALUES = 16
+        self._check_against_mapping(cross_references, mapping)
+        for i in range(300):
+            key, value = random.randrange(50) * 20, random.randrange(50) * 20
+            mapping.setdefault(key, set()).add(value)
+            cross_references.add(key, value)
+            if i % 10 == 0:
+                self._check_against_mapping(cross_references, mapping)
+        self._check_against_mapping(cross_references, mapping)
+
+    def test_random_removal(self):
+        """The reverse index is kept up to date as items are added and removed."""
+        random.seed(0)
+        mapping = { 100: set() }
+        cross_references = disassembly_data.CrossReferences(mapping)
+        cross_references.MIN_PENDING_VALUES = 16
+        self._check_against_mapping(cross_references, mapping)
+        for i in range(300):
+            key, value = random.randrange(30) * 20, random.randrange(30) * 20
+            if i % 3 == 0:
+                removed_items = [ (key, value), (key, value + 1), (100, value) ]
+                cross_references.remove_items(removed_items)
+                for removed_key, removed_value in removed_items:
+                    # Keys only go when their last value does.
+                    if removed_value in mapping.get(removed_key, ()):
+                        mapping[removed_key].remove(removed_value)
+                        if not mapping[removed_key]:
+                            del mapping[removed_key]
+            else:
+                mapping.setdefault(key, set()).add(value)
+                cross_references.add(key, value)
+            if i % 10 == 0:
+                self._check_against_mapping(cross_references, mapping)
+        self._check_against_mapping(cross_references, mapping)
+        rebuilt_cross_references = disassembly_data.CrossReferences(mapping)
+        self.assertEqual(list(rebuilt_cross_references.get_reverse().items()), list(cross_references.get_reverse().items()))
+
+    def test_persistence(self):
+        """Cross references are saved as raw buffers, and load with the same entries."""
+        mapping = { 100: set(), 102: { 4, 8 }, 2000: { 102 } }
+        cross_references = disassembly_data.CrossReferences(mapping)
+        cross_references.add(50, 60)
+        f = io.BytesIO()
+        disassembly_persistence.write_CrossReferences(f, cross_references)
+        f.seek(0)
+        loaded_cross_references = disassembly_persistence.read_CrossReferences(f)
+        self.assertEqual(list(cross_references.items()), list(loaded_cross_references.items()))
+        self.assertEqual([ (102, 2000) ], loaded_cross_references.get_reverse_items_in_range(100, 200))
+
+
+class CORE_ReadWriteLock_TestCase(unittest.TestCase):
+    def _run_thread(self, lock_mode, events, event_name):
+        def hold_lock():
+            with lock_mode:
+                events.append(event_name)
+        thread = threading.Thread(target=hold_lock)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_readers_share(self):
+        lock = disassembly_util.ReadWriteLock()
+        events = []
+        with lock.read:
+            # Another thread can read while this one is.
+            self._run_thread(lock.read, events, "read").join(5.0)
+            self.assertEqual([ "read" ], events)
+
+    def test_writer_excludes(self):
+        lock = disassembly_util.ReadWriteLock()
+        events = []
+        with lock.read:
+            writer = self._run_thread(lock.write, events, "write")
+            while not lock.writers_waiting:
+                time.sleep(0.001)
+            # The waiting writer is let in ahead of new readers.
+            reader = self._run_thread(lock.read, events, "read")
+            time.sleep(0.05)
+            self.assertEqual([], events)
+            # Reading is reentrant, even with a writer waiting.
+            with lock.read:
+                pass
+        writer.join(5.0)
+        reader.join(5.0)
+        self.assertEqual([ "write", "read" ], events)
+
+    def test_reentrancy(self):
+        lock = disassembly_util.ReadWriteLock()
+        with lock.write:
+            with lock.write:
+                with lock.read:
+                    pass
+            with lock.read:
+                pass
+        self.assertEqual(None, lock.writer_ident)
+        self.assertEqual({}, lock.read_depths)
+        with lock.read:
+            self.assertRaises(RuntimeError, lock.acquire_write)
+        self.assertRaises(RuntimeError, lock.release_write)
+        # Reading begun while writing continues after it.
+        lock.acquire_write()
+        lock.acquire_read()
+        lock.release_write()
+        self.assertEqual({ threading.get_ident(): 1 }, lock.read_depths)
+        lock.release_read()
+        self.assertEqual({}, lock.read_depths)
+
+    def test_exclusion(self):
+        """Readers should never see a writer part way through a change, while both hammer the lock."""
+        lock = disassembly_util.ReadWriteLock()
+        values = [ 0, 0 ]
+        errors = []
+        stop_event = threading.Event()
+
+        def read_values():
+            while not stop_event.is_set():
+                with lock.read:
+                    if values[0] != values[1]:
+                        errors.append(tuple(values))
+
+        readers = [ threading.Thread(target=read_values) for i in range(4) ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        for i in range(2000):
+            with lock.write:
+                values[0] += 1
+                time.sleep(0)
+                values[1] += 1
+        stop_event.set()
+        for reader in readers:
+            reader.join(5.0)
+        self.assertEqual([], errors)
+        self.assertEqual({}, lock.read_depths)
+
 
 class TOOL_ProjectCompatibility_TestCase(unittest.TestCase):
     def setUp(self):
@@ -141,6 +445,657 @@ class TOOL_UncertainReferenceModification_TestCase(unittest.TestCase):
                 break
 
 
+class TOOL_LoadStats_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def _get_rescanned_load_stats(self):
+        program_data = self.toolapiob.editor_state.disassembly_state._program_data
+        code_blocks = [ block for block in program_data.blocks if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE ]
+        return len(program_data.blocks), len(code_blocks), sum(block.length for block in code_blocks)
+
+    def test_running_counts_match_blocks(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        def check_load_stats():
+            stats = self.toolapiob.get_load_stats()
+            self.assertEqual(self._get_rescanned_load_stats(), (stats["block_count"], stats["code_blocks"], stats["code_bytes"]))
+        check_load_stats()
+        self.assertNotEqual(0, self.toolapiob.get_load_stats()["code_bytes"])
+
+        # Splitting and changing data types need to keep the running counts in step.
+        for address, type_name in ((0x2a4, "code"), (0x300, "32bit"), (0x400, "ascii"), (0x500, "8bit")):
+            self.toolapiob.set_datatype(address, type_name)
+            check_load_stats()
+
+
+class TOOL_CodeReferences_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_data_type_changes_update_references(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        referring_address, referred_address = max(program_data.branch_addresses.get_reverse_items_in_range(0, 0x1000))
+        self.assertEqual("code", self.toolapiob.get_data_type_for_address(referring_address))
+
+        # The branches made by code which is no longer code, are no longer made.
+        self.toolapiob.set_datatype(referring_address, "32bit")
+        self.assertNotIn(referring_address, disassembly_api.get_referring_addresses(referred_address))
+        self.assertNotIn(referring_address, program_data.branch_addresses.get_reverse())
+
+        self.toolapiob.set_datatype(referring_address, "code")
+        self.assertIn(referring_address, disassembly_api.get_referring_addresses(referred_address))
+        self.assertIn(referring_address, program_data.branch_addresses.get_reverse())
+
+
+class TOOL_UncertainReferenceEvents_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_data_type_change_broadcasts(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        # Changing the type of part of a block locates the uncertain references within that part.
+        BLOCK_ADDRESS = 0x182
+        disassembly_api.set_data_type_at_address(BLOCK_ADDRESS, disassembly_data.DATA_TYPE_DATA08)
+        disassembly_api.set_data_type_at_address(BLOCK_ADDRESS, disassembly_data.DATA_TYPE_DATA32)
+        block, block_idx = disassembly.lookup_block_by_address(program_data, BLOCK_ADDRESS)
+        self.assertEqual(BLOCK_ADDRESS, block.address)
+        self.assertNotEqual([], block.references)
+        old_references = block.references
+        events = []
+        disassembly_api.set_uncertain_reference_modification_func(lambda *args: events.append(args))
+
+        # The references are unchanged, but the rows rendered for them are not.
+        disassembly_api.set_data_type_at_address(BLOCK_ADDRESS, disassembly_data.DATA_TYPE_DATA16)
+        self.assertEqual(old_references, block.references)
+        self.assertIn((disassembly_data.DATA_TYPE_DATA32, disassembly_data.DATA_TYPE_DATA16, block.address, block.length), events)
+
+
+class TOOL_LineAddressMapping_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_code_line_address_round_trip(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        code_line_count = 0
+        for line_number in range(disassembly_api.get_file_line_count()):
+            address = disassembly_api.get_address_for_line_number(line_number)
+            if address is None or disassembly_api.get_data_type_for_address(address) != disassembly_data.DATA_TYPE_CODE:
+                continue
+            # Only an instruction's own line round trips, not its label, trailing blank line or relative labels.
+            instruction_text = disassembly_api.get_file_line(line_number, disassembly.LI_INSTRUCTION)
+            if instruction_text in ("", "EQU"):
+                continue
+            self.assertEqual(line_number, disassembly_api.get_line_number_for_address(address))
+            code_line_count += 1
+        self.assertNotEqual(0, code_line_count)
+
+
+class TOOL_KnownAddress_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_known_addresses(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        program_data = self.toolapiob.editor_state.disassembly_state._program_data
+        segments = program_data.loader_segments
+        last_segment_id = len(segments) - 1
+        address0 = loaderlib.get_segment_address(segments, 0)
+        addressN = loaderlib.get_segment_address(segments, last_segment_id) + loaderlib.get_segment_length(segments, last_segment_id)
+        # Segments are contiguous, and trailing labels are only allowed directly after the last.
+        addresses = list(range(address0 - 4, address0 + 4)) + list(range(addressN - 4, addressN + 4)) + [ 0, 0xFFFFFFFF ]
+        expected_results = [ address >= address0 and address <= addressN for address in addresses ]
+        program_data.post_segment_addresses = {}
+        self.assertEqual(expected_results, disassembly.check_known_addresses(program_data, addresses))
+        self.assertEqual({ last_segment_id: [ addressN ] }, program_data.post_segment_addresses)
+        program_data.post_segment_addresses = {}
+        self.assertEqual(expected_results, [ disassembly.check_known_address(program_data, address) for address in addresses ])
+        self.assertEqual({ last_segment_id: [ addressN ] }, program_data.post_segment_addresses)
+
+    def test_scan_known_address_words(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        program_data = self.toolapiob.editor_state.disassembly_state._program_data
+        segments = program_data.loader_segments
+        address0 = loaderlib.get_segment_address(segments, 0)
+        data = bytearray(loaderlib.get_segment_data(segments, 0))
+        # Plant addresses at both word phases, including the first and last possible offsets.
+        for data_idx, address in ((0, address0), (6, address0 + 2), (len(data) - 4, address0 + 4)):
+            data[data_idx:data_idx+4] = program_data.loader_data_types.uint32_value_as_string(address)
+        f = program_data.loader_data_types.uint32_value
+        for data_idx_start, data_idx_end in ((0, len(data)), (2, len(data) - 1), (6, 10), (6, 9), (0, 0)):
+            expected_pairs = [ (data_idx, f(data, data_idx)) for data_idx in range(data_idx_start, data_idx_end - 3, 2) if disassembly.check_known_address(program_data, f(data, data_idx)) ]
+            self.assertEqual(expected_pairs, disassembly._scan_known_address_words(program_data, data, data_idx_start, data_idx_end))
+
+
+class TOOL_UncertainReferences_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_source_code_rendered_on_demand(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        program_data = self.toolapiob.editor_state.disassembly_state._program_data
+        # The blocks only hold the addresses and match flags, and no source code text.
+        for block in program_data.blocks:
+            for entry in block.references or []:
+                self.assertEqual([ int, int, int ], [ type(v) for v in entry ])
+
+        code_references = self.toolapiob.get_uncertain_code_references()
+        self.assertTrue(len(code_references))
+        for (referring_address, referred_address, code_string) in code_references:
+            self.assertEqual(self.toolapiob.get_source_code_for_address(referring_address), code_string)
+            self.assertIn((referring_address, referred_address, code_string), self.toolapiob.editor_state.get_uncertain_references_by_address(self.toolapiob.editor_client, referring_address))
+
+
+    def test_uncertain_reference_indexes(self):
+        LOAD_ADDRESS = 0x10000
+        random.seed(0)
+        data = bytearray([ 0x4E, 0x75 ]) + bytearray(random.getrandbits(8) for i in range(0x1000))
+        for i in range(2, len(data) - 4, 38):
+            data[i:i+4] = bytearray([ 0, 1, (i >> 8) & 0xFF, i & 0xFE ])
+        input_file = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            input_file.write(data)
+            input_file.close()
+            result = self.toolapiob.load_binary_file(input_file.name, loaderlib.constants.PROCESSOR_M680x0, LOAD_ADDRESS, 0)
+        finally:
+            os.remove(input_file.name)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        program_data = self.toolapiob.editor_state.disassembly_state._program_data
+        def check_indexes():
+            code_references, data_references = [], []
+            for block in program_data.blocks:
+                if block.references:
+                    if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE:
+                        code_references.extend(block.references)
+                    else:
+                        data_references.extend(block.references)
+            self.assertEqual(sorted(code_references), program_data.uncertain_code_references)
+            self.assertEqual(sorted(data_references), program_data.uncertain_data_references)
+
+        check_indexes()
+        self.assertTrue(len(program_data.uncertain_data_references) > 50)
+        logging.disable(logging.ERROR)
+        try:
+            for address, type_name in ((0x10100, "32bit"), (0x10200, "ascii"), (0x10402, "code"), (0x10800, "16bit"), (0x10120, "code")):
+                self.toolapiob.set_datatype(address, type_name)
+                check_indexes()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        # Address windows include references from the first address, up to but excluding the last.
+        data_references = program_data.uncertain_data_references
+        address0, addressN = data_references[10][0], data_references[20][0]
+        window_rows = self.toolapiob.get_uncertain_data_references(address0, addressN)
+        self.assertEqual(data_references[10:20], [ (a, b, disassembly.MAF_ABSOLUTE_ADDRESS) for (a, b, code_string) in window_rows ])
+
+        referring_address, referred_address, flags = data_references[15]
+        block, block_idx = disassembly.lookup_block_by_address(program_data, referring_address)
+        self.assertTrue(disassembly_data.program_data_remove_block_reference(program_data, block, referring_address, referred_address))
+        self.assertFalse(disassembly_data.program_data_remove_block_reference(program_data, block, referring_address, referred_address))
+        self.assertNotIn((referring_address, referred_address, flags), program_data.uncertain_data_references)
+        check_indexes()
+
+
+class TOOL_InstructionCache_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_demoted_instructions_render_the_same(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        line_count = disassembly_api.get_file_line_count()
+        rows = [ disassembly._render_file_line(program_data, line_idx) for line_idx in range(line_count) ]
+        self.assertEqual(0, disassembly_api.get_instruction_cache_stats()["demotions"])
+
+        MAX_INSTRUCTIONS = 16
+        disassembly_api.set_instruction_cache_budget(MAX_INSTRUCTIONS)
+        self.assertEqual(rows, [ disassembly._render_file_line(program_data, line_idx) for line_idx in range(line_count) ])
+        stats = disassembly_api.get_instruction_cache_stats()
+        self.assertNotEqual(0, stats["demotions"])
+
+        # Only the most recently used block may be over the budget, and every real entry is accounted for.
+        instruction_counts = [ disassembly._count_instruction_entries(block.line_data) for block in program_data.blocks if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE ]
+        self.assertEqual(sum(instruction_counts), stats["instructions"])
+        self.assertTrue(stats["instructions"] <= max(MAX_INSTRUCTIONS, max(instruction_counts)))
+
+
+    def test_project_line_counting_does_not_decode(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        save_options = disassembly_api.get_save_project_options()
+        save_file = io.BytesIO()
+        with open(FILE_NAME, "rb") as save_options.input_file:
+            disassembly_api.save_project_file(save_file, save_options)
+        save_file.seek(0)
+        loaded_disassembly_api = disassembly.load_project_file(save_file, "gdbstop")
+
+        # The instruction lengths and line counts are persisted, so the line index needs no disassembly.
+        program_data = disassembly_api._program_data
+        loaded_program_data = loaded_disassembly_api._program_data
+        self.assertEqual(disassembly_api.get_file_line_count(), loaded_disassembly_api.get_file_line_count())
+        for block, loaded_block in zip(program_data.blocks, loaded_program_data.blocks):
+            if disassembly_data.get_block_data_type(block) == disassembly_data.DATA_TYPE_CODE:
+                self.assertEqual(block.instruction_metadata, loaded_block.instruction_metadata)
+                line_index = disassembly.get_block_line_index(program_data, block)
+                loaded_line_index = disassembly.get_block_line_index(loaded_program_data, loaded_block)
+                self.assertEqual(line_index.line_offsets, loaded_line_index.line_offsets)
+                self.assertEqual(line_index.byte_offsets, loaded_line_index.byte_offsets)
+        self.assertEqual(0, loaded_disassembly_api.get_instruction_cache_stats()["materialisations"])
+
+
+class TOOL_FileLineCache_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def _check_cached_lines(self):
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        for line_number in range(disassembly_api.get_file_line_count()):
+            cached_row = [ disassembly_api.get_file_line(line_number, column_idx) for column_idx in range(disassembly.LI_COLUMN_COUNT) ]
+            self.assertEqual(disassembly._render_file_line(program_data, line_number), cached_row)
+
+    def test_edits_invalidate_cached_lines(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        self._check_cached_lines()
+        stats = self.toolapiob.editor_state.disassembly_state.get_file_line_cache_stats()
+        self.assertNotEqual(0, stats["hits"])
+
+        # Each edit changes the lines of the block, and possibly the numbering of all following lines.
+        for address, type_name in ((0x2a4, "code"), (0x300, "32bit"), (0x400, "ascii"), (0x500, "8bit")):
+            self.toolapiob.set_datatype(address, type_name)
+            self._check_cached_lines()
+
+    def test_symbol_changes_invalidate_referring_lines(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        symbol_address = sorted(address for (address, label) in disassembly_api.get_symbols() if disassembly_api.get_referring_addresses(address))[0]
+        self._check_cached_lines()
+        # Only the lines of the symbol and those referring to it are discarded, not every cached line.
+        cached_line_count = len(program_data.file_line_cache)
+        disassembly.set_symbol_for_address(program_data, symbol_address, "renamed")
+        discarded_line_count = cached_line_count - len(program_data.file_line_cache)
+        self.assertGreater(discarded_line_count, 0)
+        self.assertLessEqual(discarded_line_count, len(disassembly_api.get_referring_addresses(symbol_address)) + 1)
+        self._check_cached_lines()
+        disassembly.remove_symbol_for_address(program_data, symbol_address)
+        self._check_cached_lines()
+
+    def test_file_lines_match_file_line(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+        self.toolapiob.set_datatype(0x400, "ascii")
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        line_count = disassembly_api.get_file_line_count()
+        expected_rows = [ tuple(disassembly._render_file_line(program_data, line_number)) for line_number in range(line_count) ]
+        # Some lines are cached beforehand, so that the batch mixes cached and rendered rows.
+        program_data.file_line_cache.clear()
+        for line_number in range(0, line_count, 7):
+            disassembly_api.get_file_line(line_number, disassembly.LI_OFFSET)
+        rows = []
+        for line0 in range(0, line_count, 100):
+            rows.extend(disassembly_api.get_file_lines(line0, 100))
+        self.assertEqual(expected_rows, rows)
+        # Ranges are clipped to the lines in the file.
+        self.assertEqual(expected_rows[-3:], disassembly_api.get_file_lines(line_count - 3, 10))
+        self.assertEqual([], disassembly_api.get_file_lines(line_count, 10))
+
+
+class TOOL_SearchIndex_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def _check_search_results(self, texts):
+        """The indexed search should find the same lines as searching the rendered lines."""
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        line_count = disassembly_api.get_file_line_count()
+        line_texts = [ disassembly._get_search_text(disassembly._render_file_line(program_data, line_number)) for line_number in range(line_count) ]
+        for text in texts:
+            matching_lines = [ line_number for (line_number, line_text) in enumerate(line_texts) if text.lower() in line_text ]
+            for line_number in (0, line_count // 3, line_count - 1):
+                following_lines = [ matching_line for matching_line in matching_lines if matching_line >= line_number ]
+                self.assertEqual(following_lines[0] if following_lines else None, disassembly_api.search_file_lines(text, line_number, 1))
+                preceding_lines = [ matching_line for matching_line in matching_lines if matching_line <= line_number ]
+                self.assertEqual(preceding_lines[-1] if preceding_lines else None, disassembly_api.search_file_lines(text, line_number, -1))
+
+    def test_index_follows_edits(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        while disassembly_api.update_search_index(256):
+            pass
+        texts = [ "jsr", "MOVE.L", "dc.b", "no such text" ]
+        self._check_search_results(texts)
+
+        # Each edit changes the lines of the block, and possibly the numbering of all following lines.
+        for address, type_name in ((0x2a4, "code"), (0x300, "32bit"), (0x400, "ascii")):
+            self.toolapiob.set_datatype(address, type_name)
+            self._check_search_results(texts)
+
+        symbol_address, symbol_label = sorted(disassembly_api.get_symbols())[1]
+        disassembly.set_symbol_for_address(program_data, symbol_address, "renamed")
+        self._check_search_results(texts + [ symbol_label, "renamed" ])
+        disassembly.remove_symbol_for_address(program_data, symbol_address)
+        self._check_search_results(texts + [ "renamed", "%x" % symbol_address ])
+
+    def test_regular_expressions(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        state = self.toolapiob.editor_state
+        state.line_number = 0
+        state.last_search_text = "/^ jsr/"
+        line_number = state._search_text(None, 1, work_state=disassembly_util.WorkState())
+        self.assertEqual("JSR", state.disassembly_state.get_file_line(line_number, disassembly.LI_INSTRUCTION))
+        self.assertEqual("", state.disassembly_state.get_file_line(line_number, disassembly.LI_LABEL))
+        state.last_search_text = "/(/"
+        self.assertEqual(editor_state.ERRMSG_INVALID_SEARCH_PATTERN, state._search_text(None, 1, work_state=disassembly_util.WorkState()))
+
+
+class TOOL_ConcurrentReads_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def test_reads_during_edits(self):
+        """Reads on other threads should not fail or see partial changes, while edits are made."""
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        program_data = disassembly_api._program_data
+        stop_event = threading.Event()
+        errors = []
+        read_counts = []
+
+        def read_lines(seed):
+            rng = random.Random(seed)
+            read_count = 0
+            try:
+                while not stop_event.is_set():
+                    line_count = disassembly_api.get_file_line_count()
+                    line0 = rng.randrange(line_count)
+                    rows = disassembly_api.get_file_lines(line0, 64)
+                    if not rows or len(rows) > 64 or any(len(row) != disassembly.LI_COLUMN_COUNT for row in rows):
+                        errors.append("bad rows for lines %d-%d" % (line0, line0 + 64))
+                    disassembly_api.search_file_lines("rts", line0, 1)
+                    disassembly.get_source_code_text(program_data, line0, 64)
+                    read_count += 1
+            except Exception as e:
+                errors.append(repr(e))
+            read_counts.append(read_count)
+
+        threads = [ threading.Thread(target=read_lines, args=(seed,)) for seed in range(4) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for address, type_name in ((0x2a4, "code"), (0x300, "32bit"), (0x400, "ascii"), (0x300, "16bit"), (0x400, "8bit"), (0x300, "code")):
+                self.toolapiob.set_datatype(address, type_name)
+                time.sleep(0.01)
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join(30.0)
+
+        self.assertEqual([], errors)
+        self.assertEqual(len(threads), len(read_counts))
+        self.assertTrue(all(read_counts))
+        # Whatever the readers cached should match the lines rendered now.
+        line_count = disassembly_api.get_file_line_count()
+        rendered_rows = [ tuple(row) for row in disassembly._render_file_lines(program_data, 0, line_count) ]
+        self.assertEqual(rendered_rows, disassembly_api.get_file_lines(0, line_count))
+        search_texts = [ disassembly._get_search_text(row) for row in rendered_rows ]
+        self.assertEqual(search_texts, disassembly.get_search_texts(program_data, 0, line_count))
+
+
+class TOOL_ExportSourceCode_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.toolapiob = toolapi.ToolAPI()
+
+    def tearDown(self):
+        self.toolapiob.on_app_exit()
+
+    def _get_expected_source_code(self):
+        disassembly_api = self.toolapiob.editor_state.disassembly_state
+        text = ""
+        for line_number in range(disassembly_api.get_file_line_count()):
+            label_text = disassembly_api.get_file_line(line_number, disassembly.LI_LABEL)
+            instruction_text = disassembly_api.get_file_line(line_number, disassembly.LI_INSTRUCTION)
+            operands_text = disassembly_api.get_file_line(line_number, disassembly.LI_OPERANDS)
+            if label_text:
+                text += label_text
+            if instruction_text or operands_text:
+                text += "\t"+ instruction_text
+            if operands_text:
+                text += "\t"+ operands_text
+            text += "\n"
+        return text
+
+    def test_export(self):
+        if "TESTDATA_PATH" not in os.environ:
+            self.fail("TESTDATA_PATH environment variable required")
+
+        FILE_NAME = os.path.join(os.environ["TESTDATA_PATH"], "amiga", "gdbstop")
+        if not os.path.exists(FILE_NAME):
+            self.fail("missing input file '%s'" % FILE_NAME)
+
+        result = self.toolapiob.load_file(FILE_NAME)
+        if type(result) is str:
+            self.fail("loading error ('%s')" % result)
+        expected_text = self._get_expected_source_code()
+
+        export_file = tempfile.NamedTemporaryFile(suffix=".s", delete=False)
+        export_file.close()
+        try:
+            self.assertTrue(self.toolapiob.export_source_code(export_file.name))
+            with open(export_file.name, "r") as f:
+                self.assertEqual(expected_text, f.read())
+        finally:
+            os.remove(export_file.name)
+
+        # Batches rendered ahead by a pool of workers are written in order.
+        old_batch_size = disassembly.EXPORT_LINE_BATCH_SIZE
+        disassembly.EXPORT_LINE_BATCH_SIZE = 10
+        try:
+            for worker_count in (1, 4):
+                f = io.BytesIO()
+                self.assertTrue(self.toolapiob.editor_state.disassembly_state.export_source_code(f, worker_count=worker_count))
+                self.assertEqual(expected_text, f.getvalue().decode("latin-1"))
+
+            # A cancelled export stops before writing further batches.
+            work_state = disassembly_util.WorkState()
+            work_state.cancel()
+            f = io.BytesIO()
+            self.assertFalse(self.toolapiob.editor_state.disassembly_state.export_source_code(f, work_state))
+            self.assertEqual(b"", f.getvalue())
+        finally:
+            disassembly.EXPORT_LINE_BATCH_SIZE = old_batch_size
+
+
 class QTUI_UncertainReferenceModification_TestCase(unittest.TestCase):
     def setUp(self):
         class Model(object):
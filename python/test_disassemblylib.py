@@ -3,16 +3,27 @@
 
 import logging
 import os
+import pickle
+import shutil
 import struct
+import tempfile
 import unittest
 
+import disassemblylib
 from disassemblylib import archmips, archm68k, util
+import loaderlib
 
 
 class BaseArchTestCase(unittest.TestCase):
     pass
 
 
+def first_matching_entry(table_instructions, word):
+    for entry in table_instructions:
+        if (word & entry[util.II_ANDMASK]) == entry[util.II_CMPMASK]:
+            return entry
+
+
 class ArchmipsTestCase(BaseArchTestCase):
     def setUp(self):
         self.arch = archmips.ArchMIPS()
@@ -45,6 +56,14 @@ class ArchmipsTestCase(BaseArchTestCase):
         self.arch.function_get_operand_string(match, match.opcodes[2])
 
 
+    def testDispatchTable(self):
+        # The dispatch table should select the same entry as a scan of the instruction table.
+        for word in range(0, 1 << 32, 0x10003):
+            dispatch_entry = first_matching_entry(self.arch.table_dispatch[word >> 16], word)
+            scan_entry = first_matching_entry(self.arch.table_instructions, word)
+            self.assertIs(dispatch_entry, scan_entry)
+
+
 class Archm68kTestCase(BaseArchTestCase):
     def setUp(self):
         self.arch = archm68k.ArchM68k()
@@ -91,6 +110,155 @@ class Archm68kTestCase(BaseArchTestCase):
         operand2 = self.arch.function_get_operand_string(match, match.opcodes[1], lookup_symbol)
         self.assertEquals(operand2, "D1-D4/A0-A3/A5")
 
+    def testDispatchTable(self):
+        self.arch.set_operand_type_table(archm68k.operand_type_table)
+        self.arch.set_instruction_table(archm68k.instruction_table)
+
+        # The dispatch table should select the same entry as a scan of the instruction table.
+        for word in range(1 << 16):
+            dispatch_entry = first_matching_entry(self.arch.table_dispatch[word], word)
+            scan_entry = first_matching_entry(self.arch.table_instructions, word)
+            self.assertIs(dispatch_entry, scan_entry)
+
+        # Disabling the dispatch table should fall back to the scan.
+        self.arch.variable_use_dispatch_table = False
+        match, next_data_idx = self.arch.function_disassemble_one_line(b"\x70\x01", 0, 0)
+        self.assertEqual("MOVEQ", self.arch.function_get_instruction_string(match, match.vars))
+
+
+
+class DecodePlanTestCase(unittest.TestCase):
+    def make_arch(self, use_decode_plans):
+        arch = archm68k.ArchM68k()
+        arch.set_operand_type_table(archm68k.operand_type_table)
+        arch.set_instruction_table(archm68k.instruction_table)
+        arch.variable_use_decode_cache = False
+        arch.variable_use_decode_plans = use_decode_plans
+        return arch
+
+    def disassemble_text(self, arch, data):
+        def lookup_symbol(address, absolute_info=None): return None
+        try:
+            match, data_idx = arch.function_disassemble_one_line(data, 0, 0x1000)
+        except Exception as e:
+            return e.__class__
+        if match is None:
+            return None
+        text = [ arch.function_get_instruction_string(match, match.vars), data_idx ]
+        for operand in match.opcodes:
+            try:
+                text.append(arch.function_get_operand_string(match, operand, lookup_symbol))
+            except Exception as e:
+                text.append(e.__class__)
+        return text
+
+    def testEquivalence(self):
+        # Compiled decode plans should give the same results as interpreting the instruction table.
+        planned_arch = self.make_arch(True)
+        interpreted_arch = self.make_arch(False)
+        for word in range(0, 0x10000, 3):
+            data = struct.pack(">HHHHH", word, 0x1234, 0x8765, 0x00FE, 0x4321)
+            self.assertEqual(self.disassemble_text(planned_arch, data), self.disassemble_text(interpreted_arch, data))
+
+
+class DecodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.arch = archm68k.ArchM68k()
+        self.arch.set_operand_type_table(archm68k.operand_type_table)
+        self.arch.set_instruction_table(archm68k.instruction_table)
+        util.decode_cache.clear()
+
+    def tearDown(self):
+        util.decode_cache.clear()
+
+    def testSharedDecoding(self):
+        # lea $10(pc), a0 ; lea $10(pc), a0
+        data = b"\x41\xFA\x00\x10\x41\xFA\x00\x10"
+        match1, data_idx = self.arch.function_disassemble_one_line(data, 0, 0x100)
+        match2, data_idx = self.arch.function_disassemble_one_line(data, data_idx, 0x104)
+        self.assertEqual(data_idx, 8)
+        self.assertEqual(util.decode_cache.misses, 1)
+        self.assertEqual(util.decode_cache.hits, 1)
+        # Only the address differs.
+        self.assertEqual(match1.pc + 4, match2.pc)
+        self.assertIs(match1.opcodes, match2.opcodes)
+        def lookup_symbol(address, absolute_info=None): return "%X" % address
+        self.assertEqual(self.arch.function_get_operand_string(match1, match1.opcodes[0], lookup_symbol), "(112,PC)")
+        self.assertEqual(self.arch.function_get_operand_string(match2, match2.opcodes[0], lookup_symbol), "(116,PC)")
+
+    def testDifferentEncodings(self):
+        # lea $10(pc), a0 ; lea $20(pc), a0
+        data = b"\x41\xFA\x00\x10\x41\xFA\x00\x20"
+        for match, data_idx, is_final in self.arch.disassemble_range(data, 0, len(data), 0):
+            pass
+        self.assertEqual(util.decode_cache.misses, 2)
+        self.assertEqual(util.decode_cache.hits, 0)
+
+    def testEviction(self):
+        cache = util.DecodeCache(max_entries=2)
+        for word1 in range(3):
+            match, data_idx = self.arch.function_disassemble_one_line(b"\x70\x00", 0, 0)
+            cache.insert(self.arch, word1, match)
+        self.assertEqual(cache.get_stats()["entries"], 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.lookup(self.arch, 0, b"\x70\x00", 0, 0))
+        self.assertIsNotNone(cache.lookup(self.arch, 2, b"\x70\x00", 0, 0))
+
+
+class ProcessorRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.original_cache_directory = disassemblylib.TABLE_CACHE_DIRECTORY
+        self.cache_directory = tempfile.mkdtemp()
+        disassemblylib.TABLE_CACHE_DIRECTORY = self.cache_directory
+        disassemblylib.clear_processor_cache()
+
+    def tearDown(self):
+        disassemblylib.TABLE_CACHE_DIRECTORY = self.original_cache_directory
+        disassemblylib.clear_processor_cache()
+        shutil.rmtree(self.cache_directory)
+
+    def testSharedInstance(self):
+        arch1 = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        arch2 = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        self.assertIs(arch1, arch2)
+
+    def testTableCache(self):
+        arch1 = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        self.assertEqual(len(os.listdir(self.cache_directory)), 1)
+
+        # A new instance should have the tables loaded from the cache.
+        disassemblylib.clear_processor_cache()
+        arch2 = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        self.assertIsNot(arch1, arch2)
+        self.assertEqual(arch1.table_instructions, arch2.table_instructions)
+        self.assertEqual(arch1.table_dispatch, arch2.table_dispatch)
+
+        # A cache from different source should be ignored.
+        disassemblylib.clear_processor_cache()
+        for file_name in os.listdir(self.cache_directory):
+            with open(os.path.join(self.cache_directory, file_name), "wb") as f:
+                pickle.dump({ "source_hash": "stale" }, f)
+        arch3 = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        self.assertEqual(arch1.table_instructions, arch3.table_instructions)
+
+    def testUnwritableTableCache(self):
+        # A regular file is in the way of the cache directory, so the tables cannot be cached.
+        blocking_file_path = os.path.join(self.cache_directory, "file")
+        open(blocking_file_path, "wb").close()
+        disassemblylib.TABLE_CACHE_DIRECTORY = os.path.join(blocking_file_path, "tables")
+        arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        self.assertIsNotNone(arch)
+        self.assertNotEqual(0, len(arch.table_instructions))
+        self.assertEqual([ "file" ], os.listdir(self.cache_directory))
+
+    def testClearCaches(self):
+        arch = disassemblylib.get_processor(loaderlib.constants.PROCESSOR_M680x0)
+        # MOVE.L D0, (A0)
+        arch.function_disassemble_one_line(b"\x20\x80", 0, 0)
+        self.assertNotEqual(0, len(arch._specific_ea_keys))
+        disassemblylib.clear_caches()
+        self.assertEqual(0, len(arch.table_decode_plans))
+        self.assertEqual(0, len(arch._specific_ea_keys))
 
 
 class UtilFunctionalityTestCase(unittest.TestCase):
@@ -105,6 +273,32 @@ class UtilFunctionalityTestCase(unittest.TestCase):
     mask1T_base_mask_string = "111"
     mask1L_base_mask_string = "1"
 
+    def test_memoize(self):
+        calls = []
+        @util.memoize(max_size=2)
+        def square(v):
+            calls.append(v)
+            return v * v
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [ 2, 3 ])
+        self.assertEqual(square.cache.hits, 1)
+        self.assertEqual(square.cache.misses, 2)
+
+        # The least recently used result is evicted when the bound is exceeded.
+        square(4)
+        self.assertEqual(square.cache.evictions, 1)
+        square(3)
+        self.assertEqual(calls, [ 2, 3, 4 ])
+        square(2)
+        self.assertEqual(calls, [ 2, 3, 4, 2 ])
+
+        stats = util.get_memoize_stats()[square.cache.name]
+        self.assertEqual(stats["entries"], 2)
+        util.clear_memoize_caches()
+        self.assertEqual(square.cache.get_stats()["entries"], 0)
+
     def test_get_mask_and_shift_from_mask_string(self):
         # When the mask character is not present.
         mask, shift = util.get_mask_and_shift_from_mask_string(self.mask1_template_string, "c")
@@ -57,6 +57,9 @@ class ToolEditorClient(editor_state.ClientAPI):
     def request_address(self, address: int) -> int:
         return self._goto_address_value
 
+    def request_code_save_file(self) -> IO[str]:
+        return open(self.owner_ref().get_export_file_path(), "w")
+
     # These can be ignored, as we have no GUI.
     def event_tick(self, active_client): pass
     def event_prolonged_action(self, active_client, title_msg_id, description_msg_id, can_cancel, step_count, abort_callback): pass
@@ -76,6 +79,7 @@ class ToolAPI(object):
 
     file_path = None # type: str
     input_file_path = None # type: str
+    export_file_path = None # type: str
 
     def __init__(self, editor_state_ob=None) -> None:
         self.editor_client = ToolEditorClient(self)
@@ -104,6 +108,10 @@ class ToolAPI(object):
         """ Called by the editor client. """
         return self.input_file_path
 
+    def get_export_file_path(self) -> str:
+        """ Called by the editor client. """
+        return self.export_file_path
+
     def load_binary_file(self, file_path, processor_id, load_address, entrypoint_offset, input_file_path=None):
         # Not ideal, but works for now.
         self.editor_client._binary_parameters = processor_id, load_address, entrypoint_offset
@@ -120,6 +128,13 @@ class ToolAPI(object):
             self.editor_state.reset_state(self.editor_client)
         return result
 
+    def export_source_code(self, file_path: str):
+        self.export_file_path = file_path
+        try:
+            return self.editor_state.export_source_code(self.editor_client)
+        finally:
+            self.export_file_path = None
+
     def _get_address(self):
         # type: () -> int
         return self.editor_state.get_address(self.editor_client)
@@ -147,11 +162,14 @@ class ToolAPI(object):
         elif type_name == "ascii":
             return self.editor_state.set_datatype_ascii(self.editor_client)
 
-    def get_uncertain_code_references(self):
-        return self.editor_state.get_uncertain_code_references(self.editor_client)
+    def get_uncertain_code_references(self, address0=None, addressN=None):
+        return self.editor_state.get_uncertain_code_references(self.editor_client, address0, addressN)
+
+    def get_uncertain_data_references(self, address0=None, addressN=None):
+        return self.editor_state.get_uncertain_data_references(self.editor_client, address0, addressN)
 
-    def get_uncertain_data_references(self):
-        return self.editor_state.get_uncertain_data_references(self.editor_client)
+    def get_load_stats(self):
+        return self.editor_state.get_load_stats(self.editor_client)
 
     def get_source_code_for_address(self, address):
         return self.editor_state.get_source_code_for_address(self.editor_client, address)